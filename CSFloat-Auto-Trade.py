@@ -1,15 +1,36 @@
 import asyncio
+import codecs
+import gzip
+import heapq
 import json
 import aiohttp
-import os,random
+import multiprocessing
+import hmac
+import os,queue,random,sys,time
+import sqlite3
+import weakref
+from bisect import bisect_left
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
 # from decimal import *
 from pathlib import Path
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
 from aiohttp_socks.connector import ProxyConnector
+try:
+    import aiodns # faster DNS lookups, without it the threaded resolver is used
+except ImportError:
+    aiodns = None
 from aiosteampy import SteamClient, AppContext
-from aiosteampy.utils import get_jsonable_cookies,JSONABLE_COOKIE_JAR
+from aiosteampy.utils import get_jsonable_cookies,update_session_cookies,JSONABLE_COOKIE_JAR
 from aiosteampy.client import SteamClientBase
-from aiosteampy.models import TradeOffer
+from aiosteampy.models import TradeOffer, EconItem
 from aiosteampy.helpers import restore_from_cookies
+from aiosteampy.exceptions import RateLimitExceeded
 from aiosteampy.mixins.guard import SteamGuardMixin  # Импортируем SteamGuard для подтверждения трейдов
 from aiosteampy.mixins.web_api import SteamWebApiMixin  # Импортируем WebApiMixin для работы с Web API
 from aiosteampy.constants import (
@@ -36,104 +57,557 @@ API_ACCEPT_TRADES_BULK = "https://csfloat.com/api/v1/trades/bulk/accept"  # Defi
 
 # Path to a file to save cookies, will be created at end of a script run if do not exist
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+CONFIG_FILE = Path(rf"{SCRIPT_DIR}/steam.json")
 COOKIE_FILE = Path(rf"{SCRIPT_DIR}/cookies.json")
 # if COOKIE_FILE.is_file():
 
 # Path to store processed trade IDs
 PROCESSED_TRADES_FILE = Path(rf"{SCRIPT_DIR}/processed_trades.json")
+# Path to the trade state database, processed_trades.json is imported into it once
+TRADE_STATE_FILE = Path(rf"{SCRIPT_DIR}/trade_state.sqlite3")
 
 # Инициализация SteamClient с необходимыми аргументами
 class MySteamClient(SteamClient, SteamWebApiMixin, SteamGuardMixin):
     pass
 
-def load_steam_config(config_path=rf"{SCRIPT_DIR}/steam.json"):
+def load_steam_config(config_path=CONFIG_FILE):
     with open(config_path, 'r') as file:
         return json.load(file)
     
-async def network_request_retry_template(methodToRun,actoinMessageErr,retryCountMax:int,retryWaitTime:float|int):
-    actoinMessageErr=str(actoinMessageErr)
-    retryCount=0
-    while True:
+SERVICE_CSFLOAT = "csfloat"
+SERVICE_STEAM = "steam"
+
+# Token bucket rate limiter: `rate` requests per second on average, bursts up to `capacity`. A rate of 0 disables limiting.
+class TokenBucket:
+    def __init__(self, rate: float | int, capacity: float | int | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.rate_changed = asyncio.Event() # wakes the waiting caller so a new rate applies right away
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def set_rate(self, rate: float | int, capacity: float | int | None = None):
+        self.refill()
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = min(self.tokens, self.capacity)
+        self.rate_changed.set()
+
+    async def acquire(self, tokens: float | int = 1):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                # The rate may be turned off while we wait
+                if self.rate <= 0:
+                    return
+                self.refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                self.rate_changed.clear()
+                try:
+                    await asyncio.wait_for(self.rate_changed.wait(), (tokens - self.tokens) / self.rate)
+                except asyncio.TimeoutError:
+                    pass
+
+async def acquire_rate_limit(rate_limiter: TokenBucket | None):
+    if rate_limiter:
+        await rate_limiter.acquire()
+
+# Wall time spent per stage of one check cycle.
+class StageTimings:
+    def __init__(self):
+        self.stages: dict[str, list[float]] = {}
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
         try:
-            methodToRun()
+            yield
+        finally:
+            self.stages.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def report(self):
+        if not self.stages:
             return
-        except aiohttp.ClientResponseError as http_err:
-            print(f"HTTP error occurred while {actoinMessageErr}: {http_err}")
-        except ConnectionError as connect_err:
-            print(f"connection error occurred while {actoinMessageErr}: {connect_err}")
-        except Exception as err:
-            print(f"Other error occurred while {actoinMessageErr}: {err}")
-        retryCount+=1
-        if retryCount >retryCountMax:
-            print("Failed too many times.")
-            return None
-        await asyncio.sleep(retryWaitTime)
+        print("Cycle timings: " + ", ".join(f"{stage} {sum(durations):.2f}s/{len(durations)} (max {max(durations):.2f}s)" for stage, durations in self.stages.items()))
+
+METRICS_NAMESPACE = "csfloat_auto_trade"
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_CYCLE_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+METRICS_OFFER_DELAY_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+METRICS_ENDPOINT_CSFLOAT_ACCEPT = "csfloat.accept"
+METRICS_ENDPOINT_STEAM_INVENTORY = "steam.inventory"
+METRICS_HELP = {
+    "request_duration_seconds": "Duration of CSFloat and Steam calls per endpoint, including rate limiter waits.",
+    "retry_events_total": "Retry engine events per endpoint: calls, errors, retries, rate_limited, failures, circuit_open.",
+    "cycle_duration_seconds": "Duration of a full trade check.",
+    "trades_total": "Trades seen, accepted, offered and confirmed.",
+    "offer_send_delay_seconds": "Time from a trade being accepted on CSFloat to its Steam trade offer being sent.",
+    "offer_deadline_misses_total": "Trades whose trade offer was sent, or failed, after the CSFloat send deadline.",
+    "single_flight_total": "Reads per endpoint by outcome: request (sent), shared (joined a request in flight), fresh (reused a recent result).",
+    "http_connections_total": "Connections of the shared HTTP pools per host: created (new socket) or reused (keep-alive).",
+}
+
+# Account of the running check in multi-account mode, added as a label to all metrics
+current_account: ContextVar[str | None] = ContextVar("current_account", default=None)
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# Prometheus-style counters and histograms. Disabled by default: every hook returns immediately until enable() is called.
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+
+    def enable(self):
+        self.enabled = True
+
+    @staticmethod
+    def label_key(labels: dict) -> tuple:
+        account = current_account.get()
+        if account:
+            labels["account"] = account
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, self.label_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: tuple = METRICS_LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, self.label_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def observe_request(self, endpoint: str, seconds: float, outcome: str):
+        if not self.enabled:
+            return
+        self.observe("request_duration_seconds", seconds, endpoint=endpoint, outcome=outcome)
+
+    @staticmethod
+    def format_labels(labels: tuple, extra: tuple = ()) -> str:
+        labels = labels + extra
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in labels) + "}"
+
+    # Prometheus text exposition format
+    def render(self) -> str:
+        lines = []
+        for metric_type, series in (("counter", self.counters), ("histogram", self.histograms)):
+            names = sorted({name for name, _ in series})
+            for name in names:
+                full_name = f"{METRICS_NAMESPACE}_{name}"
+                if name in METRICS_HELP:
+                    lines.append(f"# HELP {full_name} {METRICS_HELP[name]}")
+                lines.append(f"# TYPE {full_name} {metric_type}")
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name != name:
+                        continue
+                    if metric_type == "counter":
+                        lines.append(f"{full_name}{self.format_labels(labels)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + ("+Inf",), value.counts):
+                        cumulative += count
+                        lines.append(f"{full_name}_bucket{self.format_labels(labels, (('le', bound),))} {cumulative}")
+                    lines.append(f"{full_name}_sum{self.format_labels(labels)} {value.sum}")
+                    lines.append(f"{full_name}_count{self.format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Serves the metrics on http://host:port/metrics
+async def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    from aiohttp import web
+    async def handle_metrics(request):
+        return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics: serving http://{host}:{port}/metrics")
+    return runner
+
+RETRY_CSFLOAT_USER_INFO = "csfloat.user_info"
+RETRY_CSFLOAT_TRADES = "csfloat.trades"
+RETRY_CSFLOAT_ACCEPT = "csfloat.accept_bulk"
+RETRY_STEAM_SESSION = "steam.session"
+RETRY_STEAM_LOGIN = "steam.login"
+RETRY_STEAM_CONFIRM = "steam.confirm"
+RETRY_STEAM_TRADE_OFFER = "steam.trade_offer"
+RETRY_STEAM_TRADE_OFFERS = "steam.trade_offers"
+
+@dataclass
+class RetryPolicy:
+    max_retries: int = 5
+    base_delay: float = 2
+    max_delay: float = 60
+    backoff_factor: float = 2
+    jitter: float = 0.25  # +-25% of the delay
+    rate_limited_delay: float = 30  # used on 429 without a Retry-After header
+    circuit_failure_threshold: int = 10  # consecutive failed attempts before the service is skipped
+    circuit_reset_seconds: float = 120
+
+    def delay(self, retry_count: int) -> float:
+        delay = min(self.max_delay, self.base_delay * self.backoff_factor ** (retry_count - 1))
+        return round(delay * random.uniform(1 - self.jitter, 1 + self.jitter), 4)
+
+# Policies by endpoint, an endpoint without its own policy uses the policy of its service ("steam.confirm" -> "steam").
+DEFAULT_RETRY_POLICIES = {
+    SERVICE_CSFLOAT: RetryPolicy(),
+    RETRY_CSFLOAT_USER_INFO: RetryPolicy(max_retries=0),  # polled again by the scheduler
+    RETRY_CSFLOAT_ACCEPT: RetryPolicy(max_retries=2, base_delay=1, max_delay=10),  # the trades not accepted are tried again in the next check
+    SERVICE_STEAM: RetryPolicy(base_delay=5, max_delay=120),
+    RETRY_STEAM_LOGIN: RetryPolicy(base_delay=10, max_delay=300),
+}
+
+# Stops calling a service after too many consecutive failures, lets a single trial call through after `reset_seconds` (half-open)
+# and keeps the other calls blocked until the trial succeeds. A failed trial opens the circuit again.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None # the trial call of the half-open circuit
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_seconds:
+            return False
+        # A trial that never reported back (cancelled) doesn't block the circuit for longer than another window
+        if self.probe_started_at is not None and now - self.probe_started_at < self.reset_seconds:
+            return False
+        self.probe_started_at = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+
+    def record_failure(self) -> bool:
+        self.failures += 1
+        if self.failure_threshold > 0 and self.failures >= self.failure_threshold:
+            opened = self.opened_at is None or self.probe_started_at is not None
+            self.opened_at = time.monotonic()
+            self.probe_started_at = None
+            return opened
+        return False
+
+def get_retry_after(err: Exception) -> float | None:
+    if isinstance(err, RateLimitExceeded) and isinstance(err.__cause__, aiohttp.ClientResponseError):
+        err = err.__cause__
+    if not isinstance(err, aiohttp.ClientResponseError) or not err.headers:
+        return None
+    retry_after = err.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def is_rate_limited(err: Exception) -> bool:
+    return isinstance(err, RateLimitExceeded) or (isinstance(err, aiohttp.ClientResponseError) and err.status == 429)
+
+# Runs network calls with per-endpoint retry policies: exponential backoff with jitter, Retry-After on 429 and a circuit breaker per service.
+# Breakers and counters are kept per account (current_account), so one account's failing key or login doesn't stop the others.
+class RetryEngine:
+    def __init__(self, policies: dict[str, RetryPolicy] | None = None):
+        self.policies = dict(DEFAULT_RETRY_POLICIES)
+        if policies:
+            self.policies.update(policies)
+        self.breakers: dict[tuple[str | None, str], CircuitBreaker] = {} # (account, service) -> breaker
+        self.counters: dict[str | None, dict[str, dict[str, int]]] = {} # account -> endpoint -> counter -> value
+
+    def get_policy(self, endpoint: str) -> RetryPolicy:
+        return self.policies.get(endpoint) or self.policies.get(endpoint.split(".")[0]) or RetryPolicy()
+
+    def get_breaker(self, service: str) -> CircuitBreaker:
+        key = (current_account.get(), service)
+        if key not in self.breakers:
+            policy = self.get_policy(service)
+            self.breakers[key] = CircuitBreaker(policy.circuit_failure_threshold, policy.circuit_reset_seconds)
+        return self.breakers[key]
+
+    def count(self, endpoint: str, counter: str):
+        counters = self.counters.setdefault(current_account.get(), {}).setdefault(endpoint, {})
+        counters[counter] = counters.get(counter, 0) + 1
+        metrics.inc("retry_events_total", endpoint=endpoint, event=counter)
+
+    async def call(self, endpoint: str, action_message: str, func, *args, **kwargs):
+        policy = self.get_policy(endpoint)
+        service = endpoint.split(".")[0]
+        breaker = self.get_breaker(service)
+        retryCount=0
+        while True:
+            if not breaker.allow():
+                self.count(endpoint, "circuit_open")
+                print(f"{service} is failing, skipping {action_message} for {policy.circuit_reset_seconds} seconds.")
+                return None
+            self.count(endpoint, "calls")
+            started_at = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+                breaker.record_success()
+                metrics.observe_request(endpoint, time.perf_counter() - started_at, "ok")
+                return result
+            except aiohttp.ClientResponseError as http_err:
+                err = http_err
+                print(f"HTTP error occurred while {action_message}: {http_err}")
+            except ConnectionError as connect_err:
+                err = connect_err
+                print(f"connection error occurred while {action_message}: {connect_err}")
+            except Exception as other_err:
+                err = other_err
+                print(f"Other error occurred while {action_message}: {other_err}")
+            metrics.observe_request(endpoint, time.perf_counter() - started_at, "error")
+            self.count(endpoint, "errors")
+            if breaker.record_failure():
+                print(f"Too many errors from {service}, pausing its calls for {policy.circuit_reset_seconds} seconds.")
+            retryCount+=1
+            if retryCount >policy.max_retries:
+                self.count(endpoint, "failures")
+                if policy.max_retries:
+                    print("Failed too many times.")
+                return None
+            delay = policy.delay(retryCount)
+            if is_rate_limited(err):
+                self.count(endpoint, "rate_limited")
+                retry_after = get_retry_after(err)
+                delay = retry_after if retry_after is not None else max(delay, policy.rate_limited_delay)
+            self.count(endpoint, "retries")
+            await asyncio.sleep(delay)
+
+    # Counters of the current account
+    def report(self):
+        account_counters = self.counters.get(current_account.get()) or {}
+        lines = [f"{endpoint} " + " ".join(f"{counter}={value}" for counter, value in counters.items()) for endpoint, counters in account_counters.items() if set(counters) != {"calls"}]
+        if lines:
+            print("Retry counters: " + ", ".join(lines))
+
+    def apply_config(self, retry_policies_config: dict | None):
+        if not retry_policies_config:
+            return
+        for endpoint, policy_config in retry_policies_config.items():
+            try:
+                self.policies[endpoint] = RetryPolicy(**{**vars(self.get_policy(endpoint)), **policy_config})
+            except TypeError as err:
+                print(f"Couldn't load the retry policy from the config file: {endpoint}: {err}")
+        # Open circuits stay open unless their service's breaker settings changed
+        for key, breaker in list(self.breakers.items()):
+            policy = self.get_policy(key[1])
+            if (breaker.failure_threshold, breaker.reset_seconds) != (policy.circuit_failure_threshold, policy.circuit_reset_seconds):
+                del self.breakers[key]
+
+retry_engine = RetryEngine()
+
+async def network_request_retry(endpoint: str, action_message: str, func, *args, **kwargs):
+    return await retry_engine.call(endpoint, action_message, func, *args, **kwargs)
+
+# Concurrent reads of the same resource share one request in flight and its result, a result is reused for
+# `fresh_seconds` after it arrives. Keys start with a scope (CSFloat API key, Steam account), writes invalidate their scope.
+SINGLE_FLIGHT_FRESH_SECONDS = 1
+# Set around a call that must reach the server: it isn't answered from the fresh window and doesn't join a request already in flight
+single_flight_refresh: ContextVar[bool] = ContextVar("single_flight_refresh", default=False)
+
+class SingleFlight:
+    def __init__(self, fresh_seconds: float | int = SINGLE_FLIGHT_FRESH_SECONDS):
+        self.fresh_seconds = fresh_seconds
+        self.in_flight: dict[tuple, asyncio.Task] = {}
+        self.results: dict[tuple, tuple[float, object]] = {}
+
+    def apply_config(self, fresh_seconds: float | int | None):
+        if fresh_seconds is not None:
+            self.fresh_seconds = fresh_seconds
+        self.results.clear()
+
+    async def run(self, key: tuple, endpoint: str, func, *args, **kwargs):
+        refresh = single_flight_refresh.get()
+        result = self.results.get(key)
+        if not refresh and result is not None and time.monotonic() - result[0] <= self.fresh_seconds:
+            metrics.inc("single_flight_total", endpoint=endpoint, outcome="fresh")
+            return result[1]
+        task = None if refresh else self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda task: self.finish(key, task))
+            metrics.inc("single_flight_total", endpoint=endpoint, outcome="request")
+        else:
+            metrics.inc("single_flight_total", endpoint=endpoint, outcome="shared")
+        # A cancelled caller doesn't cancel the request the other callers are waiting for
+        return await asyncio.shield(task)
+
+    def finish(self, key: tuple, task: asyncio.Task):
+        failed = task.cancelled() or task.exception() is not None
+        if self.in_flight.get(key) is not task:
+            return  # invalidated while in flight
+        del self.in_flight[key]
+        now = time.monotonic()
+        self.results = {result_key: result for result_key, result in self.results.items() if now - result[0] <= self.fresh_seconds}
+        if not failed and task.result() is not None and self.fresh_seconds > 0:
+            self.results[key] = (now, task.result())
+
+    def invalidate(self, scope):
+        self.results = {key: result for key, result in self.results.items() if key[0] != scope}
+        self.in_flight = {key: task for key, task in self.in_flight.items() if key[0] != scope}
+
+single_flight = SingleFlight()
+
+def steam_single_flight_scope(steam_id) -> str:
+    return f"steam:{steam_id}"
+
 async def restore_from_cookies_prompt(cookies: JSONABLE_COOKIE_JAR, steam_client: "SteamClientBase"):
     await restore_from_cookies(cookies, steam_client)
     print("Restored Steam session from the cookie file.")
     print(f"Loaded Steam account: {steam_client.username}")
-    return
+    return True
+
 async def restore_from_cookies_retry(cookies: JSONABLE_COOKIE_JAR, steam_client: "SteamClientBase"):
-    retryCount=0
-    while True:
-        try:
-            await restore_from_cookies(cookies, steam_client)
-            print("Restored Steam session from the cookie file.")
-            print(f"Loaded Steam account: {steam_client.username}")
-            return
-        except aiohttp.ClientResponseError as http_err:
-            print(f"HTTP error occurred while restoring the Steam session from cookies: {http_err}")
-        except ConnectionError as connect_err:
-            print(f"connection error occurred while restoring the Steam session from cookies: {connect_err}")
-        except Exception as err:
-            print(f"Other error occurred while restoring the Steam session from cookies: {err}")
-        retryCount+=1
-        if retryCount >5:
-            print("Failed too many times.")
-            return None
-        await asyncio.sleep(5)
+    return await network_request_retry(RETRY_STEAM_SESSION, "restoring the Steam session from cookies", restore_from_cookies_prompt, cookies, steam_client)
 
 async def steam_client_login_retry(steam_client: "SteamClientBase"):
-    retryCount=0
-    while True:
-        try:
-            await steam_client.login()
+    async def login():
+        await steam_client.login()
+        print(f"Loaded Steam account: {steam_client.username}")
+        return True
+    return await network_request_retry(RETRY_STEAM_LOGIN, "logging in to Steam", login)
+
+# A cached session is trusted without a request to Steam while its access token stays valid for at least this long.
+STEAM_SESSION_EXPIRY_MARGIN_SECONDS = 600
+
+def cached_steam_session_expires_at(steam_client: "SteamClientBase") -> int | None:
+    try:
+        token = steam_client.access_token_decoded
+    except Exception:
+        return None
+    if not token or int(token.get("sub", 0)) != steam_client.steam_id:
+        return None
+    return token.get("exp")
+
+async def verify_steam_session_prompt(steam_client: "SteamClientBase"):
+    if await steam_client.is_session_alive():
+        print("Verified the cached Steam session.")
+        return True
+    print("The cached Steam session is no longer valid, logging in to Steam again.")
+    await steam_client.login(init_session=False)
+    print(f"Loaded Steam account: {steam_client.username}")
+    return False
+
+async def verify_steam_session_retry(steam_client: "SteamClientBase"):
+    return await network_request_retry(RETRY_STEAM_SESSION, "verifying the cached Steam session", verify_steam_session_prompt, steam_client)
+
+# Restores the Steam session from the cookie file. With fast_start, cookies whose access token has not expired are used
+# without a request to Steam and True is returned: the session is then verified on first use (see LazySteamClient).
+async def restore_steam_session(cookies: JSONABLE_COOKIE_JAR, steam_client: "SteamClientBase", fast_start: bool = True) -> bool:
+    if fast_start:
+        update_session_cookies(steam_client.session, cookies)
+        expires_at = cached_steam_session_expires_at(steam_client)
+        if expires_at is not None and expires_at - time.time() > STEAM_SESSION_EXPIRY_MARGIN_SECONDS:
+            print(f"Using the cached Steam session, valid until {datetime.fromtimestamp(expires_at, timezone.utc):%Y-%m-%d %H:%M} UTC.")
             print(f"Loaded Steam account: {steam_client.username}")
+            return True
+        print("The cached Steam session has expired or is about to, checking it with Steam.")
+    await restore_from_cookies_retry(cookies, steam_client)
+    return False
+
+# Steam client calls that need a logged in session. A session restored from cookies without a request to Steam
+# is verified once, before the first of these calls.
+STEAM_SESSION_CALLS = {"get_inventory", "make_trade_offer", "get_trade_offers", "get_trade_offer", "get_confirmations", "allow_multiple_confirmations", "confirm_trade_offer"}
+STEAM_SINGLE_FLIGHT_CALLS = {"get_inventory", "get_trade_offers", "get_trade_offer", "get_confirmations"}
+
+class LazySteamClient:
+    def __init__(self, client):
+        self.client = client
+        self.verified = False
+        self.lock = asyncio.Lock()
+
+    async def ensure_verified(self):
+        if self.verified:
             return
-        except aiohttp.ClientResponseError as http_err:
-            print(f"HTTP error occurred while logging in to Steam: {http_err}")
-        except ConnectionError as connect_err:
-            print(f"connection error occurred while logging in to Steam: {connect_err}")
-        except Exception as err:
-            print(f"Other error occurred while logging in to Steam: {err}")
-        retryCount+=1
-        if retryCount >5:
-            print("Failed too many times.")
-            return None
-        await asyncio.sleep(5)
-        
-async def confirm_trade_offer_retry(steam_client: "SteamClientBase", obj: int | TradeOffer):
-    retryCount=0
-    while True:
-        try:
-            print(f"Confirming trade offer {obj}.")
-            await steam_client.confirm_trade_offer(obj)
-            return
-        except aiohttp.ClientResponseError as http_err:
-            print(f"HTTP error occurred while confirming the trade offer: {http_err}")
-        except ConnectionError as connect_err:
-            print(f"connection error occurred while confirming the trade offer: {connect_err}")
-        except Exception as err:
-            print(f"Other error occurred while confirming the trade offer: {err}")
-        retryCount+=1
-        if retryCount >5:
-            print("Failed too many times.")
-            return None
-        await asyncio.sleep(5)
+        async with self.lock:
+            if not self.verified:
+                await verify_steam_session_retry(self.client)
+                self.verified = True
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if self.verified or name not in STEAM_SESSION_CALLS:
+            return attribute
+        async def verified_call(*args, **kwargs):
+            await self.ensure_verified()
+            return await attribute(*args, **kwargs)
+        return verified_call
+
+# Steam client whose reads go through single_flight, the other Steam calls change what they return and invalidate them
+class SingleFlightSteamClient:
+    def __init__(self, client):
+        self.client = client
+        self.scope = steam_single_flight_scope(client.steam_id)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name in STEAM_SINGLE_FLIGHT_CALLS:
+            async def shared_call(*args, **kwargs):
+                return await single_flight.run((self.scope, name, repr(args), repr(sorted(kwargs.items()))), f"steam.{name}", attribute, *args, **kwargs)
+            return shared_call
+        if name in STEAM_SESSION_CALLS:
+            async def invalidating_call(*args, **kwargs):
+                try:
+                    return await attribute(*args, **kwargs)
+                finally:
+                    single_flight.invalidate(self.scope)
+            return invalidating_call
+        return attribute
+
+async def confirm_trade_offer_retry(steam_client: "SteamClientBase", obj: int | TradeOffer, rate_limiter: TokenBucket | None = None):
+    async def confirm():
+        print(f"Confirming trade offer {obj}.")
+        await acquire_rate_limit(rate_limiter)
+        await steam_client.confirm_trade_offer(obj)
+        return True
+    return await network_request_retry(RETRY_STEAM_CONFIRM, "confirming the trade offer", confirm)
 
-def load_processed_trades():
-    if PROCESSED_TRADES_FILE.is_file():
-        with PROCESSED_TRADES_FILE.open("r") as f:
+def load_processed_trades(path: Path = PROCESSED_TRADES_FILE):
+    if path.is_file():
+        with path.open("r") as f:
             try:
                 return set(json.load(f))  # trade_id остаются строками
             except json.JSONDecodeError:
@@ -141,55 +615,350 @@ def load_processed_trades():
                 return set()
     return set()
 
-def save_processed_trades(processed_trades):
-    with PROCESSED_TRADES_FILE.open("w") as f:
-        json.dump(list(processed_trades), f, indent=2)
+TRADE_STATE_ACCEPTED = "accepted"
+TRADE_STATE_OFFER_SENT = "offer_sent"
+TRADE_STATE_CONFIRMED = "confirmed"
+TRADE_STATE_PROCESSED = "processed"  # imported from processed_trades.json
+TRADE_STATE_VERIFIED = "verified"
+TRADE_STATE_RANKS = {
+    TRADE_STATE_ACCEPTED: 1,
+    TRADE_STATE_OFFER_SENT: 2,
+    TRADE_STATE_CONFIRMED: 3,
+    TRADE_STATE_PROCESSED: 3,
+    TRADE_STATE_VERIFIED: 4,
+}
 
-async def get_user_info(session, csfloat_api_key):
-    headers = {'Authorization': csfloat_api_key}
-    try:
+# Status of an offer outbox entry: written before make_trade_offer is called, then updated with its result
+OUTBOX_PENDING = "pending"  # about to be sent, the result is unknown until resolved with Steam
+OUTBOX_SENT = "sent"        # offer created, waiting for its mobile confirmation
+OUTBOX_DONE = "done"        # offer confirmed, or Steam shows it past confirmation
+OUTBOX_FAILED = "failed"    # no offer exists, or it was declined, canceled or expired: its items can be offered again
+OUTBOX_UNFINISHED = (OUTBOX_PENDING, OUTBOX_SENT)
+# Finished entries are kept as long as their trades can still be on CSFloat (7 days of Steam trade protection and a margin)
+OUTBOX_KEEP_SECONDS = 8 * 86400
+OUTBOX_PRUNE_INTERVAL_SECONDS = 3600
+
+@dataclass
+class OutboxEntry:
+    entry_id: int
+    trade_ids: list[str]
+    asset_ids: list[int]
+    partner_id: int | None
+    status: str
+    offer_id: int | None
+    created_at: float
+
+# Lifecycle state of every trade the bot worked on, one row per trade in SQLite.
+# A state change is a single upsert, a trade never moves back to an earlier state, except a confirmed trade whose offer
+# was declined, canceled or expired: it is accepted again (reopen_trades) and gets a new offer. A check leaves out the
+# trades whose confirmed offer is still open, found through the cached states without a query per trade.
+# The offer outbox in the same database records every trade offer before it is sent, so a restart only has to
+# resolve its unfinished entries with Steam instead of matching the whole sent offer history.
+class TradeStateStore:
+    def __init__(self, path: Path = TRADE_STATE_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS trade_state (trade_id TEXT PRIMARY KEY, state TEXT NOT NULL, state_rank INTEGER NOT NULL, offer_id INTEGER, updated_at REAL NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS offer_outbox (entry_id INTEGER PRIMARY KEY AUTOINCREMENT, trade_ids TEXT NOT NULL, asset_ids TEXT NOT NULL, partner_id INTEGER, status TEXT NOT NULL, offer_id INTEGER, created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS offer_outbox_created_at ON offer_outbox (created_at)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS offer_outbox_unfinished ON offer_outbox (status) WHERE status IN ('pending', 'sent')")
+        # Offers of trades accepted before the outbox existed can only be found in the sent offer history.
+        self.connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('offer_outbox_since', ?)", (str(time.time()),))
+        self.outbox_since = float(self.connection.execute("SELECT value FROM meta WHERE key = 'offer_outbox_since'").fetchone()[0])
+        self.states: dict[str, str | None] = {}
+        self.outbox_pruned_at = 0.0
+
+    def get_state(self, trade_id) -> str | None:
+        trade_id = str(trade_id)
+        if trade_id not in self.states:
+            row = self.connection.execute("SELECT state FROM trade_state WHERE trade_id = ?", (trade_id,)).fetchone()
+            self.states[trade_id] = row[0] if row else None
+        return self.states[trade_id]
+
+    def __contains__(self, trade_id) -> bool:
+        return self.get_state(trade_id) is not None
+
+    # Keeps the cached states of the trades CSFloat still lists, the others (finished trades) are read from the database if asked again
+    def forget_states(self, keep_trade_ids=()):
+        keep_trade_ids = set(map(str, keep_trade_ids))
+        self.states = {trade_id: state for trade_id, state in self.states.items() if trade_id in keep_trade_ids}
+
+    # trade id -> (offer id, when it was confirmed) of the given trades whose offer is confirmed
+    def confirmed_offers(self, trade_ids) -> dict[str, tuple[int, float]]:
+        confirmed_trade_ids = [trade_id for trade_id in map(str, trade_ids) if self.get_state(trade_id) == TRADE_STATE_CONFIRMED]
+        confirmed = {}
+        for start in range(0, len(confirmed_trade_ids), 500):
+            chunk = confirmed_trade_ids[start:start + 500]
+            rows = self.connection.execute(f"SELECT trade_id, offer_id, updated_at FROM trade_state WHERE offer_id IS NOT NULL AND trade_id IN ({','.join('?' * len(chunk))})", chunk)
+            confirmed.update((trade_id, (offer_id, updated_at)) for trade_id, offer_id, updated_at in rows)
+        return confirmed
+
+    def reopen_trades(self, trade_ids):
+        rows = [(TRADE_STATE_ACCEPTED, TRADE_STATE_RANKS[TRADE_STATE_ACCEPTED], time.time(), trade_id, TRADE_STATE_CONFIRMED) for trade_id in map(str, trade_ids)]
+        self.connection.executemany("UPDATE trade_state SET state = ?, state_rank = ?, offer_id = NULL, updated_at = ? WHERE trade_id = ? AND state = ?", rows)
+        for row in rows:
+            self.states[row[3]] = TRADE_STATE_ACCEPTED
+
+    def set_states(self, trade_ids, state: str, offer_id: int | None = None):
+        state_rank = TRADE_STATE_RANKS[state]
+        rows = []
+        for trade_id in map(str, trade_ids):
+            current_state = self.get_state(trade_id)
+            if current_state is not None and (TRADE_STATE_RANKS[current_state] > state_rank or (current_state == state and offer_id is None)):
+                continue
+            rows.append((trade_id, state, state_rank, offer_id, time.time()))
+            self.states[trade_id] = state
+        if rows:
+            self.connection.executemany(
+                "INSERT INTO trade_state (trade_id, state, state_rank, offer_id, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(trade_id) DO UPDATE SET state = excluded.state, state_rank = excluded.state_rank, "
+                "offer_id = COALESCE(excluded.offer_id, trade_state.offer_id), updated_at = excluded.updated_at "
+                "WHERE excluded.state_rank >= trade_state.state_rank",
+                rows,
+            )
+
+    def outbox_add(self, trade_ids, asset_ids, partner_id: int | None) -> int:
+        now = time.time()
+        cursor = self.connection.execute(
+            "INSERT INTO offer_outbox (trade_ids, asset_ids, partner_id, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (json.dumps([str(trade_id) for trade_id in trade_ids]), json.dumps([int(asset_id) for asset_id in asset_ids]), partner_id, OUTBOX_PENDING, now, now),
+        )
+        return cursor.lastrowid
+
+    def outbox_set(self, entry_id: int, status: str, offer_id: int | None = None):
+        self.connection.execute(
+            "UPDATE offer_outbox SET status = ?, offer_id = COALESCE(?, offer_id), updated_at = ? WHERE entry_id = ?",
+            (status, offer_id, time.time(), entry_id),
+        )
+
+    def outbox_set_offers(self, offer_ids, status: str):
+        self.connection.executemany(
+            "UPDATE offer_outbox SET status = ?, updated_at = ? WHERE offer_id = ?",
+            [(status, time.time(), int(offer_id)) for offer_id in offer_ids],
+        )
+
+    def outbox_entries(self, where: str, params: tuple = ()) -> list[OutboxEntry]:
+        rows = self.connection.execute(f"SELECT entry_id, trade_ids, asset_ids, partner_id, status, offer_id, created_at FROM offer_outbox WHERE {where} ORDER BY entry_id", params)
+        return [OutboxEntry(entry_id, json.loads(trade_ids), json.loads(asset_ids), partner_id, status, offer_id, created_at) for entry_id, trade_ids, asset_ids, partner_id, status, offer_id, created_at in rows]
+
+    def outbox_unfinished(self) -> list[OutboxEntry]:
+        return self.outbox_entries("status IN (?, ?)", OUTBOX_UNFINISHED)
+
+    # Drops finished entries no trade on CSFloat can still refer to, at most once per OUTBOX_PRUNE_INTERVAL_SECONDS
+    def outbox_prune(self, keep_seconds: float = OUTBOX_KEEP_SECONDS):
+        if self.outbox_pruned_at and time.monotonic() - self.outbox_pruned_at < OUTBOX_PRUNE_INTERVAL_SECONDS:
+            return
+        self.outbox_pruned_at = time.monotonic()
+        cursor = self.connection.execute("DELETE FROM offer_outbox WHERE status IN (?, ?) AND updated_at < ?", (OUTBOX_DONE, OUTBOX_FAILED, time.time() - keep_seconds))
+        if cursor.rowcount:
+            print(f"Removed {cursor.rowcount} finished trade offers older than {keep_seconds / 86400:g} days from the outbox.")
+
+    # Items already offered (or possibly offered) by entries created since `since`, by partner account id.
+    def outbox_offered_asset_ids(self, since: float) -> dict[int | None, set[int]]:
+        offered: dict[int | None, set[int]] = {}
+        for entry in self.outbox_entries("created_at >= ? AND status != ?", (since, OUTBOX_FAILED)):
+            offered.setdefault(entry.partner_id, set()).update(entry.asset_ids)
+        return offered
+
+    # Outbox state a recorded cycle starts from: the unfinished entries and the recent ones, and the confirmed trades
+    # whose offers are checked again (recheck_confirmed_offers)
+    def outbox_snapshot(self, max_age_seconds: float) -> dict:
+        entries = self.outbox_entries("status IN (?, ?) OR created_at >= ?", (*OUTBOX_UNFINISHED, time.time() - max_age_seconds))
+        confirmed = self.connection.execute("SELECT trade_id, offer_id, updated_at FROM trade_state WHERE state = ? AND offer_id IS NOT NULL AND updated_at >= ?", (TRADE_STATE_CONFIRMED, time.time() - max_age_seconds))
+        return {"since": self.outbox_since, "entries": [vars(entry) for entry in entries], "confirmed": [list(row) for row in confirmed]}
+
+    def outbox_restore(self, snapshot: dict):
+        self.outbox_since = snapshot["since"]
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('offer_outbox_since', ?)", (str(self.outbox_since),))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO offer_outbox (entry_id, trade_ids, asset_ids, partner_id, status, offer_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(entry["entry_id"], json.dumps(entry["trade_ids"]), json.dumps(entry["asset_ids"]), entry["partner_id"], entry["status"], entry["offer_id"], entry["created_at"], entry["created_at"]) for entry in snapshot["entries"]],
+        )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO trade_state (trade_id, state, state_rank, offer_id, updated_at) VALUES (?, ?, ?, ?, ?)",
+            [(trade_id, TRADE_STATE_CONFIRMED, TRADE_STATE_RANKS[TRADE_STATE_CONFIRMED], offer_id, updated_at) for trade_id, offer_id, updated_at in snapshot.get("confirmed", ())],
+        )
+        self.states.clear()
+
+    def import_processed_trades(self, path: Path = PROCESSED_TRADES_FILE):
+        if self.connection.execute("SELECT value FROM meta WHERE key = 'processed_trades_imported'").fetchone():
+            return
+        processed_trades = load_processed_trades(path)
+        if processed_trades:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO trade_state (trade_id, state, state_rank, updated_at) VALUES (?, ?, ?, ?)",
+                [(str(trade_id), TRADE_STATE_PROCESSED, TRADE_STATE_RANKS[TRADE_STATE_PROCESSED], time.time()) for trade_id in processed_trades],
+            )
+            print(f"Imported {len(processed_trades)} processed trades from {path}.")
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('processed_trades_imported', ?)", (str(time.time()),))
+
+    def close(self):
+        self.connection.close()
+
+async def get_user_info(session, csfloat_api_key, rate_limiter: TokenBucket | None = None):
+    headers = csfloat_headers(csfloat_api_key)
+    async def fetch():
+        await acquire_rate_limit(rate_limiter)
         async with session.get(API_USER_INFO, headers=headers) as response:
             response.raise_for_status()
             return await response.json()
-    except aiohttp.ClientResponseError as http_err:
-        print(f"HTTP error occurred while fetching CSFloat user info: {http_err}")
-    except ConnectionError as connect_err:
-        print(f"connection error occurred while fetching CSFloat user info: {connect_err}")
-    except Exception as err:
-        print(f"Other error occurred while fetching CSFloat user info: {err}")
-    return None
+    return await single_flight.run((csfloat_api_key, RETRY_CSFLOAT_USER_INFO), RETRY_CSFLOAT_USER_INFO, network_request_retry, RETRY_CSFLOAT_USER_INFO, "fetching CSFloat user info", fetch)
+
+# Accepted or pending CSFloat trade with only the fields the bot uses.
+class Trade:
+    __slots__ = ('id', 'seller_id', 'buyer_id', 'asset_id', 'market_hash_name', 'trade_token', 'trade_url', 'accepted_at', 'verify_sale_at', 'state', 'wait_for_cancel_ping')
+
+    def __init__(self, id: str, seller_id: int, buyer_id: int, asset_id: int | None, market_hash_name: str | None, trade_token: str | None = None, trade_url: str | None = None, accepted_at: str | None = None, verify_sale_at: str | None = None, state: str | None = None, wait_for_cancel_ping: bool = False):
+        self.id = id
+        self.seller_id = seller_id
+        self.buyer_id = buyer_id
+        self.asset_id = asset_id
+        self.market_hash_name = market_hash_name
+        self.trade_token = trade_token
+        self.trade_url = trade_url
+        self.accepted_at = accepted_at
+        self.verify_sale_at = verify_sale_at
+        self.state = state
+        self.wait_for_cancel_ping = wait_for_cancel_ping
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Trade":
+        item = (data.get('contract') or {}).get('item') or {}
+        return cls(
+            id=str(data['id']),
+            seller_id=int(data['seller_id']),
+            buyer_id=int(data['buyer_id']),
+            asset_id=int(item['asset_id']) if item.get('asset_id') else None,
+            market_hash_name=item.get('market_hash_name'),
+            trade_token=data.get('trade_token'),
+            trade_url=data.get('trade_url'),
+            accepted_at=data.get('accepted_at'),
+            verify_sale_at=data.get('verify_sale_at'),
+            state=data.get('state'),
+            wait_for_cancel_ping=any2bool(data.get('wait_for_cancel_ping')),
+        )
+
+    def __repr__(self):
+        return f"Trade(id={self.id}, buyer_id={self.buyer_id}, asset_id={self.asset_id}, state={self.state}, accepted_at={self.accepted_at})"
 
-async def get_trades(session, csfloat_api_key):
-    headers = {'Authorization': csfloat_api_key}
-    retryCount=0
-    while True:
+TRADES_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Incremental reader of the /me/trades response: yields the objects of the top-level "trades" array one by one,
+# so the whole response body and its nested dicts never have to be held in memory at once.
+class TradesStreamParser:
+    def __init__(self, response, chunk_size: int = TRADES_STREAM_CHUNK_SIZE):
+        self.chunks = response.content.iter_chunked(chunk_size)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    async def read_more(self):
         try:
-            async with session.get(API_TRADES, headers=headers) as response:
-                response.raise_for_status()
-                trades_data = await response.json()
-                # print(trades_data)#debug
-                return trades_data
-        except aiohttp.ClientResponseError as http_err:
-            print(f"HTTP error occurred while fetching trades: {http_err}")
-        except ConnectionError as connect_err:
-            print(f"connection error occurred while fetching trades: {connect_err}")
-        except Exception as err:
-            print(f"Other error occurred while fetching trades: {err}")
-        retryCount+=1
-        if retryCount >5:
-            return None
-        await asyncio.sleep(5)
+            text = self.text_decoder.decode(await self.chunks.__anext__())
+        except StopAsyncIteration:
+            self.eof = True
+            text = self.text_decoder.decode(b'', final=True)
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+
+    # Next non-whitespace character, '' at the end of the stream.
+    async def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ''
+            await self.read_more()
+
+    async def expect(self, char: str):
+        if await self.peek() != char:
+            raise ValueError(f"Unexpected trades response: expected {char!r} at offset {self.pos}.")
+        self.pos += 1
+
+    async def decode_value(self):
+        await self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                await self.read_more()
+                continue
+            # A number at the end of the buffer may continue in the next chunk.
+            if end == len(self.buf) and not self.eof:
+                await self.read_more()
+                continue
+            self.pos = end
+            return value
+
+    async def iter_trades(self):
+        await self.expect('{')
+        while True:
+            char = await self.peek()
+            if char in ('}', ''):
+                return
+            if char == ',':
+                self.pos += 1
+                continue
+            key = await self.decode_value()
+            await self.expect(':')
+            if key != 'trades':
+                await self.decode_value()
+                continue
+            if await self.peek() != '[':
+                await self.decode_value()  # "trades": null
+                return
+            self.pos += 1
+            while True:
+                char = await self.peek()
+                if char == ']':
+                    self.pos += 1
+                    return
+                if char == ',':
+                    self.pos += 1
+                    continue
+                if char == '':
+                    raise ValueError("Unexpected end of trades response.")
+                yield await self.decode_value()
+
+# Parses the trades response while it is downloaded. Trades of other sellers and trades waiting for a cancel ping are skipped if my_steam_id is given.
+async def parse_trades_stream(response, my_steam_id: int | None = None, chunk_size: int = TRADES_STREAM_CHUNK_SIZE) -> list[Trade]:
+    trades = []
+    async for data in TradesStreamParser(response, chunk_size).iter_trades():
+        if my_steam_id is not None and (int(data.get('seller_id', 0)) != my_steam_id or any2bool(data.get('wait_for_cancel_ping'))):
+            continue
+        trades.append(Trade.from_json(data))
+    return trades
 
-async def accept_trade(session, csfloat_api_key, trade_id, trade_token):
+async def get_trades(session, csfloat_api_key, rate_limiter: TokenBucket | None = None, my_steam_id: int | None = None) -> list[Trade] | None:
+    headers = csfloat_headers(csfloat_api_key)
+    async def fetch():
+        await acquire_rate_limit(rate_limiter)
+        async with session.get(API_TRADES, headers=headers) as response:
+            response.raise_for_status()
+            trades_data = await parse_trades_stream(response, my_steam_id)
+            # print(trades_data)#debug
+            return trades_data
+    return await single_flight.run((csfloat_api_key, RETRY_CSFLOAT_TRADES, my_steam_id), RETRY_CSFLOAT_TRADES, network_request_retry, RETRY_CSFLOAT_TRADES, "fetching trades", fetch)
+
+async def accept_trade(session, csfloat_api_key, trade_id, trade_token, rate_limiter: TokenBucket | None = None):
     url = API_ACCEPT_TRADE.format(trade_id=trade_id)
-    headers = {
-        'Authorization': csfloat_api_key,
-        'Content-Type': 'application/json'
-    }
+    headers = csfloat_headers(csfloat_api_key, json_body=True)
     payload = {
         'trade_token': trade_token  # Передача trade_token в тело запроса, если требуется API
     }
+    started_at = time.perf_counter()
+    outcome = "error"
     try:
+        await acquire_rate_limit(rate_limiter)
         async with session.post(url, headers=headers, json=payload) as response:
             if response.status != 200:
                 # Логирование подробностей ошибки
@@ -197,6 +966,7 @@ async def accept_trade(session, csfloat_api_key, trade_id, trade_token):
                 print(f"Failed to accept trade {trade_id}. Status: {response.status}, Detail: {error_detail}")
                 return False
             result = await response.json()
+            outcome = "ok"
 
             return result
     except aiohttp.ClientResponseError as http_err:
@@ -205,179 +975,796 @@ async def accept_trade(session, csfloat_api_key, trade_id, trade_token):
         print(f"connection error occurred while accepting trade {trade_id}: {connect_err}")
     except Exception as err:
         print(f"Other error occurred while accepting trade {trade_id}: {err}")
+    finally:
+        single_flight.invalidate(csfloat_api_key)
+        metrics.observe_request(METRICS_ENDPOINT_CSFLOAT_ACCEPT, time.perf_counter() - started_at, outcome)
     return False
 
-async def accept_trades_bulk(session, csfloat_api_key, trade_ids: list[str]):
+# One bulk accept request, run by the retry engine (RETRY_CSFLOAT_ACCEPT): a failed request raises so the CSFloat circuit
+# breaker and the 429 Retry-After handling apply to it like to every other CSFloat call.
+async def accept_trades_bulk(session, csfloat_api_key, trade_ids: list[str], rate_limiter: TokenBucket | None = None):
     url = API_ACCEPT_TRADES_BULK
-    headers = {
-        'Authorization': csfloat_api_key,
-        'Content-Type': 'application/json'
-    }
+    headers = csfloat_headers(csfloat_api_key, json_body=True)
     payload = {
         "trade_ids": trade_ids
     }
     try:
+        await acquire_rate_limit(rate_limiter)
         async with session.post(url, headers=headers, json=payload) as response:
             if response.status != 200:
                 # Логирование подробностей ошибки
                 error_detail = await response.text()
                 print(f"Failed to accept trades. Status: {response.status}, Detail: {error_detail}")
-                return False
-            result = await response.json()
+            response.raise_for_status()
+            return await response.json()
+    finally:
+        single_flight.invalidate(csfloat_api_key)
 
-            return result
-    except aiohttp.ClientResponseError as http_err:
-        print(f"HTTP error occurred while accepting trades: {http_err}")
-    except ConnectionError as connect_err:
-        print(f"connection error occurred while accepting trades: {connect_err}")
-    except Exception as err:
-        print(f"Other error occurred while accepting trades: {err}")
-    return False
+# Finds which trades of one bulk accept request were accepted. The response lists the accepted trades; a successful
+# response without that list is taken as accepting all of them, a failed request as accepting none.
+def split_accept_result(trade_ids: list[str], accept_result) -> tuple[dict[str, dict], list[str]]:
+    if not accept_result:
+        return {}, list(trade_ids)
+    if not isinstance(accept_result, dict) or not isinstance(accept_result.get('trades'), list):
+        return {trade_id: {} for trade_id in trade_ids}, []
+    returned_trades = {str(trade.get('id')): trade for trade in accept_result['trades'] if isinstance(trade, dict)}
+    accepted_trades = {trade_id: returned_trades[trade_id] for trade_id in trade_ids if trade_id in returned_trades}
+    return accepted_trades, [trade_id for trade_id in trade_ids if trade_id not in accepted_trades]
+
+# Bulk accept split into chunks of chunk_size ids, sent `concurrency` at a time within the CSFloat rate limit.
+# A failed request is retried by the retry engine; the ids a successful response didn't accept are sent again, up to `attempts` times in total.
+ACCEPT_CHUNK_SIZE = 50
+ACCEPT_CONCURRENCY = 2
+ACCEPT_ATTEMPTS = 3
+ACCEPT_RETRY_DELAY_SECONDS = 1
+
+async def accept_trades_chunked(session, csfloat_api_key, trade_ids: list[str], chunk_size: int = ACCEPT_CHUNK_SIZE, concurrency: int = ACCEPT_CONCURRENCY, rate_limiter: TokenBucket | None = None, attempts: int = ACCEPT_ATTEMPTS) -> tuple[dict[str, dict], list[str]]:
+    chunk_size = max(1, chunk_size)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    accepted_trades: dict[str, dict] = {}
+    pending = list(trade_ids)
+    failed_requests: list[str] = [] # ids of requests that failed after the retries, left for the next check
+    async def accept_chunk(chunk: list[str]) -> list[str]:
+        async with semaphore:
+            accept_result = await network_request_retry(RETRY_CSFLOAT_ACCEPT, "accepting trades", accept_trades_bulk, session, csfloat_api_key, trade_ids=chunk, rate_limiter=rate_limiter)
+        if accept_result is None:
+            failed_requests.extend(chunk)
+            return []
+        chunk_accepted, chunk_failed = split_accept_result(chunk, accept_result)
+        accepted_trades.update(chunk_accepted)
+        return chunk_failed
+    for attempt in range(attempts):
+        if attempt:
+            print(f"Failed to accept {len(pending)} trades. Retrying them: {attempt}.")
+            await asyncio.sleep(ACCEPT_RETRY_DELAY_SECONDS * attempt)
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        failed_chunks = await asyncio.gather(*(accept_chunk(chunk) for chunk in chunks))
+        pending = [trade_id for chunk_failed in failed_chunks for trade_id in chunk_failed]
+        if not pending:
+            break
+    return accepted_trades, pending + failed_requests
+
+# Asset ids of accepted trades that were not in the Steam inventory. Their trade offers are skipped without Steam calls
+# until a fetched inventory holds the asset again or the entry expires and the offer is tried once more.
+MISSING_ASSET_RECHECK_SECONDS = 3600
+
+@dataclass
+class MissingAsset:
+    trade_ids: list[int]
+    missing_since: float
+    expires_at: float
+
+class MissingAssetCache:
+    def __init__(self, recheck_seconds: float | int = MISSING_ASSET_RECHECK_SECONDS):
+        self.recheck_seconds = recheck_seconds
+        self.assets: dict[int, MissingAsset] = {}
+
+    def add(self, asset_ids, trade_ids):
+        now = time.time()
+        for asset_id in asset_ids:
+            known = self.assets.get(asset_id)
+            self.assets[asset_id] = MissingAsset(list(trade_ids), known.missing_since if known else now, now + self.recheck_seconds)
+
+    # Known missing assets among asset_ids, expired entries don't count
+    def missing(self, asset_ids) -> list[int]:
+        now = time.time()
+        return [asset_id for asset_id in asset_ids if asset_id in self.assets and self.assets[asset_id].expires_at > now]
 
-async def csfloat_send_steam_trade(client: SteamClient, trade_id, buyer_steam_id=None, trade_url=None, asset_id=None, trade_token=None):
-    # Определение контекста игры, например, CS2
-    game_context = AppContext.CS2  # Убедитесь, что это правильный контекст для вашего предмета
+    def discard_present(self, inventory_asset_ids):
+        returned = [asset_id for asset_id in self.assets if asset_id in inventory_asset_ids]
+        for asset_id in returned:
+            del self.assets[asset_id]
+        if returned:
+            print(f"Items back in the inventory: {returned}")
 
+    # Entries of trades that are no longer waiting for an offer (cancelled or finished) are dropped
+    def prune(self, trade_ids: set[int]):
+        self.assets = {asset_id: asset for asset_id, asset in self.assets.items() if any(trade_id in trade_ids for trade_id in asset.trade_ids)}
+
+    def report(self):
+        for asset_id, asset in sorted(self.assets.items(), key=lambda item: item[1].missing_since):
+            print(f"  Trade {', '.join(map(str, asset.trade_ids))}: asset_id {asset_id} not in the inventory since {datetime.fromtimestamp(asset.missing_since, timezone.utc).isoformat()}")
+
+    # Times are saved relative to the snapshot, so a replay sees the same entries as expired or not
+    def snapshot(self) -> dict:
+        now = time.time()
+        return {"assets": [{"asset_id": asset_id, "trade_ids": asset.trade_ids, "missing_for": now - asset.missing_since, "expires_in": asset.expires_at - now} for asset_id, asset in self.assets.items()]}
+
+    def restore(self, snapshot: dict):
+        now = time.time()
+        self.assets = {entry["asset_id"]: MissingAsset(entry["trade_ids"], now - entry["missing_for"], now + entry["expires_in"]) for entry in snapshot["assets"]}
+
+# Inventory shared by all trade offers of one check cycle, indexed by asset_id.
+# It is refreshed when stale or when a lookup misses, sent assets are invalidated so they are not offered twice.
+class InventoryCache:
+    def __init__(self, client: SteamClient, app_context: AppContext = AppContext.CS2, ttl_seconds: float | int = 120, count: int = 2000, rate_limiter: TokenBucket | None = None, missing_assets: MissingAssetCache | None = None):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.missing_assets = missing_assets
+        self.app_context = app_context
+        self.ttl_seconds = ttl_seconds
+        self.count = count
+        self.items: dict[int, EconItem] = {}
+        self.given_asset_ids: set[int] = set()
+        self.fetched_at = 0.0
+        self.refresh_count = 0
+        self.lock = asyncio.Lock()
+
+    def is_stale(self):
+        return not self.fetched_at or time.monotonic() - self.fetched_at > self.ttl_seconds
+
+    # force: a lookup missed, the inventory must come from Steam and not from another caller's fresh single-flight result
+    async def refresh(self, force: bool = False):
+        await acquire_rate_limit(self.rate_limiter)
+        started_at = time.perf_counter()
+        refresh_token = single_flight_refresh.set(force)
+        try:
+            my_inv, _, _ = await self.client.get_inventory(self.app_context, count=self.count)
+        except Exception:
+            metrics.observe_request(METRICS_ENDPOINT_STEAM_INVENTORY, time.perf_counter() - started_at, "error")
+            raise
+        finally:
+            single_flight_refresh.reset(refresh_token)
+        metrics.observe_request(METRICS_ENDPOINT_STEAM_INVENTORY, time.perf_counter() - started_at, "ok")
+        self.items = {item.asset_id: item for item in my_inv if item.asset_id not in self.given_asset_ids}
+        if self.missing_assets is not None:
+            self.missing_assets.discard_present(self.items)
+        self.fetched_at = time.monotonic()
+        self.refresh_count += 1
+        print(f"Inventory loaded: {len(self.items)} items.")
+
+    async def get_items(self, asset_ids: list[int]) -> tuple[list[EconItem], list[int]]:
+        # Concurrent offers wait for a refresh already in progress instead of starting their own.
+        fetched_at = self.fetched_at
+        async with self.lock:
+            if self.is_stale():
+                await self.refresh()
+            missing = [tai for tai in asset_ids if tai not in self.items]
+            if missing and self.fetched_at == fetched_at:
+                await self.refresh(force=True)
+                missing = [tai for tai in asset_ids if tai not in self.items]
+        return [self.items[tai] for tai in asset_ids if tai in self.items], missing
+
+    def invalidate(self, asset_ids):
+        for tai in asset_ids:
+            self.items.pop(tai, None)
+            self.given_asset_ids.add(tai)
+
+async def csfloat_send_steam_trade(client: SteamClient, trade_id, buyer_steam_id=None, trade_url=None, asset_id=None, trade_token=None, inventory_cache: InventoryCache | None = None, rate_limiter: TokenBucket | None = None, trade_ids: list | None = None, trade_state_store: "TradeStateStore | None" = None):
     # Попытка найти предмет по asset_id
     asset_id = list(asset_id)
     if not asset_id:  #if all items to trade on csfloat are already included in created trade offers.
         print("Nothing to give for trade offer.")
         return False
+    if inventory_cache is None:
+        # Определение контекста игры, например, CS2
+        inventory_cache = InventoryCache(client, AppContext.CS2, rate_limiter=rate_limiter)
+    # Only the inventory fetch is retried blindly, a failed make_trade_offer may still have created the offer
+    async def get_items_to_give():
+        # Получение вашего инвентаря
+        return await inventory_cache.get_items(asset_id)
+    inventory_items = await network_request_retry(RETRY_STEAM_TRADE_OFFER, "loading the inventory for a trade offer", get_items_to_give)
+    if inventory_items is None:
+        return None
+    items_to_give, asset_id_missing = inventory_items
+
+    # Проверка структуры предметов в инвентаре
+    if not inventory_cache.items and not items_to_give:
+        print("Your inventory is empty or could not be loaded.")
+        return False
     
-    retryCount=0
-    while True:
-        try:
-            # Получение вашего инвентаря
-            my_inv, _, _ = await client.get_inventory(game_context,count=2000)
+    #wip compare to history offers
 
-            # Проверка структуры предметов в инвентаре
-            if not my_inv:
-                print("Your inventory is empty or could not be loaded.")
-                return False
-            
-            #wip compare to history offers
+    asset_id_len=len(asset_id)
+    # print(f"asset_id {asset_id}")
+    print(f"asset_id_len {asset_id_len}")
+    items_to_give_len=len(items_to_give)
+    # print(f"items_to_give {items_to_give}")
+    print(f"items_to_give_len {items_to_give_len}")
 
-            asset_id_len=len(asset_id)
-            # print(f"asset_id {asset_id}")
-            print(f"asset_id_len {asset_id_len}")
-            items_to_give=[]
-            try:
-                for tai in asset_id:
-                    items_to_give.append(next((item for item in my_inv if item.asset_id == tai)))
-                # items_to_give = list((item for item in my_inv if item.asset_id == asset_id))
-                items_to_give_len=len(items_to_give)
-                # print(f"items_to_give {items_to_give}")
-                print(f"items_to_give_len {items_to_give_len}")
-                
-                if asset_id_len!=items_to_give_len:
-                    print("Can't find all items to give.")
-                    return False
-
-            except ValueError:
-                # items_to_give = next((item for item in my_inv if item.asset_id == asset_id), None)
-                pass
-
-            if not items_to_give: #wip find missing items
-                if asset_id_len==1:
-                    print(f"Item with asset_id {asset_id} not found in the inventory.")
-                else:
-                    print(f"Item with asset_id {asset_id[0]} and {asset_id_len-1} other items not found in the inventory.")
-                # print(f"Предмет с asset_id {asset_id} не найден в инвентаре.")
-                return False
-            if items_to_give_len>1:
-                trades_num_other=items_to_give_len-1
-                offer_message=f"CSFloat Market Trade Offer #{trade_id} and {trades_num_other} other items Thanks for using CSFloat!"
-            else:
-                offer_message=f"CSFloat Market Trade Offer #{trade_id}. Thanks for using CSFloat!"
-            print(f"trade_id {trade_id} buyer_steam_id {buyer_steam_id} trade_url {trade_url} asset_id {asset_id} trade_token {trade_token} offer_message {offer_message}")
-            # return #debug
-            # Вызов make_trade_offer с использованием Steam ID или Trade URL
-            if trade_url:
-                # Отправка через трейд-ссылку
-                offer_id = await client.make_trade_offer(
-                    trade_url,                     # Трейд-ссылка как первый позиционный аргумент
+    if not items_to_give: #wip find missing items
+        if asset_id_len==1:
+            print(f"Item with asset_id {asset_id} not found in the inventory.")
+        else:
+            print(f"Item with asset_id {asset_id[0]} and {asset_id_len-1} other items not found in the inventory.")
+        # print(f"Предмет с asset_id {asset_id} не найден в инвентаре.")
+        if inventory_cache.missing_assets is not None:
+            inventory_cache.missing_assets.add(asset_id_missing, trade_ids or [trade_id])
+        return False
+    if asset_id_missing:
+        print(f"Can't find all items to give. Missing asset_id: {asset_id_missing}")
+        if inventory_cache.missing_assets is not None:
+            inventory_cache.missing_assets.add(asset_id_missing, trade_ids or [trade_id])
+        return False
+    if items_to_give_len>1:
+        trades_num_other=items_to_give_len-1
+        offer_message=f"CSFloat Market Trade Offer #{trade_id} and {trades_num_other} other items Thanks for using CSFloat!"
+    else:
+        offer_message=f"CSFloat Market Trade Offer #{trade_id}. Thanks for using CSFloat!"
+    print(f"trade_id {trade_id} buyer_steam_id {buyer_steam_id} trade_url {trade_url} asset_id {asset_id} trade_token {trade_token} offer_message {offer_message}")
+    # return #debug
+    partner_id = to_account_id(int(buyer_steam_id)) if buyer_steam_id else None
+    # The outbox entry is written before the first attempt, so a crash at any point leaves a record to resolve.
+    outbox_entry_id = None
+    if trade_state_store is not None:
+        outbox_entry_id = trade_state_store.outbox_add(trade_ids or [trade_id], asset_id, partner_id)
+    offer_created_since = time.time()
+    attempts = 0
+
+    async def send_trade_offer():
+        nonlocal attempts
+        attempts += 1
+        if attempts > 1:
+            # The failed attempt may have created the offer before its error (a timeout or 5xx), it is looked up before
+            # sending again. If the lookup fails too, the retry does the lookup again and never sends blindly.
+            for offer in await get_recent_sent_offers(client, offer_created_since, rate_limiter):
+                offer_partner_id = to_account_id(offer.partner_id) if partner_id is not None else None
+                if sent_offer_key(offer_partner_id, [itg.asset_id for itg in offer.items_to_give]) == sent_offer_key(partner_id, asset_id):
+                    print(f"Trade offer {offer.trade_offer_id} was created by the failed attempt.")
+                    return offer.trade_offer_id
+        # Вызов make_trade_offer с использованием Steam ID или Trade URL
+        await acquire_rate_limit(rate_limiter)
+        if trade_url:
+            # Отправка через трейд-ссылку
+            return await client.make_trade_offer(
+                trade_url,                     # Трейд-ссылка как первый позиционный аргумент
+                to_give=items_to_give,
+                to_receive=[],
+                message=offer_message,
+                confirm=False #debug
+            )
+        elif buyer_steam_id:
+            # Отправка через Steam ID партнёра
+            if trade_token:
+                return await client.make_trade_offer(
+                    buyer_steam_id,              # Steam ID партнёра как первый позиционный аргумент
                     to_give=items_to_give,
                     to_receive=[],
                     message=offer_message,
+                    token=trade_token,             # Передача trade_token, если требуется
                     confirm=False #debug
                 )
-            elif buyer_steam_id:
-                # Отправка через Steam ID партнёра
-                if trade_token:
-                    offer_id = await client.make_trade_offer(
-                        buyer_steam_id,              # Steam ID партнёра как первый позиционный аргумент
-                        to_give=items_to_give,
-                        to_receive=[],
-                        message=offer_message,
-                        token=trade_token,             # Передача trade_token, если требуется
-                        confirm=False #debug
-                    )
-                else:
-                    offer_id = await client.make_trade_offer(
-                        buyer_steam_id,              # Steam ID партнёра как первый позиционный аргумент
-                        to_give=items_to_give,
-                        to_receive=[],
-                        message=offer_message,
-                        confirm=False #debug
-                    )
             else:
-                print("It is necessary to specify either buyer_steam_id or trade_url.")
-                return False
+                return await client.make_trade_offer(
+                    buyer_steam_id,              # Steam ID партнёра как первый позиционный аргумент
+                    to_give=items_to_give,
+                    to_receive=[],
+                    message=offer_message,
+                    confirm=False #debug
+                )
+        else:
+            print("It is necessary to specify either buyer_steam_id or trade_url.")
+            return False
 
-            if offer_id:
-                print(f"Trade offer {trade_id} sent!")
-                return offer_id  # Возвращаем offer_id для дальнейшей обработки
-            else:
-                print("It was not possible to send a trade offer.")
-                return False
+    offer_id = await network_request_retry(RETRY_STEAM_TRADE_OFFER, "sending trade offer", send_trade_offer)
+    if offer_id:
+        print(f"Trade offer {trade_id} sent!")
+        if outbox_entry_id is not None:
+            trade_state_store.outbox_set(outbox_entry_id, OUTBOX_SENT, int(offer_id))
+        inventory_cache.invalidate(asset_id)
+        return offer_id  # Возвращаем offer_id для дальнейшей обработки
+    if offer_id is None and attempts:
+        # Every attempt failed with an error, the offer may exist: the next check resolves the pending outbox entry
+        print(f"Couldn't tell if the trade offer for trade {trade_id} was created, it is looked up in the next check.")
+        return None
+    print("It was not possible to send a trade offer.")
+    if outbox_entry_id is not None:
+        trade_state_store.outbox_set(outbox_entry_id, OUTBOX_FAILED)
+    return False
 
-        except aiohttp.ClientResponseError as http_err:
-            print(f"HTTP error occurred while sending trade offer: {http_err}")
-        except ConnectionError as connect_err:
-            print(f"connection error occurred while sending trade offer: {connect_err}")
-        except Exception as e:
-            print(f"An error occurred while sending trade offer: {e}")
-        retryCount+=1
-        if retryCount >5:
-            print("Failed too many times.")
-            return None
-        await asyncio.sleep(5)
+CONFIRMATION_LIST_ATTEMPTS = 3
+
+# Confirms many trade offers with one confirmation list fetch and one multi-confirmation request.
+# Offers just created may show up in the confirmation list with a delay, so the list is fetched again for the missing ones.
+async def confirm_trade_offers_batch(client: SteamGuardMixin, offer_ids, rate_limiter: TokenBucket | None = None) -> set[int]:
+    offer_ids_pending = set(offer_ids)
+    offer_ids_confirmed = set()
+    async def confirm():
+        await acquire_rate_limit(rate_limiter)
+        confirmations = await client.get_confirmations(update_listings=False)
+        trades_to_confirm = [c for c in confirmations if c.type == ConfirmationType.TRADE and c.creator_id in offer_ids_pending]
+        if trades_to_confirm:
+            print(f"Confirming trade offers {[c.creator_id for c in trades_to_confirm]}.")
+            await acquire_rate_limit(rate_limiter)
+            await client.allow_multiple_confirmations(trades_to_confirm)
+        return {c.creator_id for c in trades_to_confirm}
+    for attempt in range(CONFIRMATION_LIST_ATTEMPTS):
+        if not offer_ids_pending:
+            break
+        if attempt:
+            await asyncio.sleep(2)
+        confirmed = await network_request_retry(RETRY_STEAM_CONFIRM, "confirming trade offers", confirm)
+        if confirmed is None:
+            break
+        offer_ids_confirmed |= confirmed
+        offer_ids_pending -= confirmed
+    if offer_ids_pending:
+        print(f"No matched confirmation found for trade offers {sorted(offer_ids_pending)}.")
+    return offer_ids_confirmed
 
 # Функция подтверждения трейдов, если требуется
 async def confirm_trade(client: SteamGuardMixin):
     # breakpoint()#debug
     try:
-        confirmations = await client.get_confirmations()
+        confirmations = await client.get_confirmations(update_listings=False)
+        trades_to_confirm = [c for c in confirmations if c.type == ConfirmationType.TRADE]
 
-        if not confirmations:
+        if not trades_to_confirm:
             print("No pending confirmations.")
             return
 
-        for confirmation in confirmations:
-            confirmation_key, timestamp = await client._gen_confirmation_key(tag="conf")
-
-            # Подтверждение трейда
-            result = await client.confirm_confirmation(confirmation, confirmation_key, timestamp)
-            if result:
-                print(f"Successfully confirmed trade offer {confirmation.offer_id}")
-            else:
-                print(f"Failed to confirm trade offer {confirmation.offer_id}")
+        # Подтверждение трейдов одним запросом
+        await client.allow_multiple_confirmations(trades_to_confirm)
+        print(f"Successfully confirmed trade offers {[c.creator_id for c in trades_to_confirm]}")
 
     except Exception as e:
         print(f"An error occurred while confirming trades: {e}")
 
-async def get_actionable_trades_sell(session, csfloat_api_key,my_steam_id):
-    trades_info = await get_trades(session, csfloat_api_key)
-    if isinstance(trades_info, dict):
-        trades_list = trades_info.get('trades', [])
-        trades_list_sell = list(filter(lambda c: int(c['seller_id']) ==my_steam_id and not any2bool(c['wait_for_cancel_ping']), trades_list))
-        return trades_list_sell
-    else:
-        print(f"Unexpected trades data format: {type(trades_info)}")
+# One Steam trade offer to send: accepted CSFloat trades of the same buyer (and item name, if grouped so).
+@dataclass
+class OfferGroup:
+    trade_id: int
+    buyer_id: int
+    seller_id: int
+    trade_token: str | None
+    trade_url: str | None
+    accepted_at: str | None
+    trade_state: str | None
+    trade_ids: list[int] = field(default_factory=list)
+    asset_id: list[int] = field(default_factory=list)
+    accepted_time: float | None = None  # earliest acceptance of the grouped trades, the send deadline runs from it
+
+OFFER_GROUP_BY_BUYER_ITEM = "buyer_item"
+OFFER_GROUP_BY_BUYER = "buyer"
+
+# Buckets trades into offer groups in one pass. The first trade of a bucket keeps the offer details, as before.
+def group_trades_for_offers(trades: list[Trade], group_by: str = OFFER_GROUP_BY_BUYER_ITEM) -> list[OfferGroup]:
+    groups: dict[tuple, OfferGroup] = {}
+    for trade in trades:
+        if group_by == OFFER_GROUP_BY_BUYER:
+            key = (trade.buyer_id,)
+        else:
+            key = (trade.buyer_id, trade.market_hash_name)
+        group = groups.get(key)
+        if group is None:
+            group = OfferGroup(
+                trade_id=int(trade.id),
+                buyer_id=trade.buyer_id,
+                seller_id=trade.seller_id,
+                trade_token=trade.trade_token,
+                trade_url=trade.trade_url,
+                accepted_at=trade.accepted_at,
+                trade_state=trade.state,
+            )
+            groups[key] = group
+        group.trade_ids.append(int(trade.id))
+        if trade.asset_id is not None:
+            group.asset_id.append(trade.asset_id)
+        accepted_time = parse_timestamp(trade.accepted_at)
+        if accepted_time is not None and (group.accepted_time is None or accepted_time < group.accepted_time):
+            group.accepted_time = accepted_time
+    return list(groups.values())
+
+STEAM_ID64_BASE = 76561197960265728
+OFFER_STATUSES_SENT = (TradeOfferStatus.ACCEPTED, TradeOfferStatus.ACTIVE, TradeOfferStatus.CONFIRMATION_NEED)
+
+def to_account_id(steam_id: int) -> int:
+    return steam_id - STEAM_ID64_BASE if steam_id > STEAM_ID64_BASE else steam_id
+
+@dataclass
+class OfferReconciliation:
+    sent_asset_ids: set[int]
+    offers_to_confirm: list[TradeOffer]
+    missing_asset_ids: list[int]
+
+# Index of sent Steam trade offers, built once per check: partner account id -> offers by status, asset_id -> offer.
+class SentOfferIndex:
+    def __init__(self, sent_offers: list[TradeOffer]):
+        self.by_partner: dict[int, dict[TradeOfferStatus, list[TradeOffer]]] = {}
+        self.by_asset: dict[int, TradeOffer] = {}
+        self.offer_asset_ids: dict[int, set[int]] = {}
+        for offer in sent_offers:
+            partner_id = to_account_id(offer.partner_id)
+            self.by_partner.setdefault(partner_id, {}).setdefault(offer.status, []).append(offer)
+            if offer.status not in OFFER_STATUSES_SENT:
+                continue
+            asset_ids = {itg.asset_id for itg in offer.items_to_give}
+            self.offer_asset_ids[offer.trade_offer_id] = asset_ids
+            for tai in asset_ids:
+                self.by_asset.setdefault(tai, offer)
+
+    def reconcile(self, group: OfferGroup) -> OfferReconciliation:
+        partner_id = to_account_id(group.buyer_id)
+        group_asset_ids = set(group.asset_id)
+        sent_asset_ids = {tai for tai in group_asset_ids if tai in self.by_asset and to_account_id(self.by_asset[tai].partner_id) == partner_id}
+        offers_to_confirm = [
+            offer for offer in self.by_partner.get(partner_id, {}).get(TradeOfferStatus.CONFIRMATION_NEED, [])
+            if self.offer_asset_ids[offer.trade_offer_id] <= group_asset_ids
+        ]
+        missing_asset_ids = [tai for tai in group.asset_id if tai not in sent_asset_ids]
+        return OfferReconciliation(sent_asset_ids, offers_to_confirm, missing_asset_ids)
+
+# Sent trade offers kept between checks, by trade offer id. The first sync pages through the history only back to the
+# oldest time a check needs it for, later syncs ask Steam only for the offers changed since the previous sync.
+SENT_OFFERS_SYNC_MARGIN_SECONDS = 300
+SENT_OFFERS_MAX_PAGES = 100
+
+class SentOfferCache:
+    def __init__(self, client: MySteamClient, rate_limiter: TokenBucket | None = None):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.offers: dict[int, TradeOffer] = {}
+        self.synced_at: float | None = None
+        self.loaded_since: float | None = None
+        self.page_count = 0
+
+    # Pages are requested one at a time. With stop_before, paging stops at the first page reaching offers last updated
+    # before that time: any offer on the next pages was created before it too.
+    async def fetch_pages(self, action_message: str, stop_before: float | None = None, **kwargs) -> bool:
+        cursor = 0
+        for _ in range(SENT_OFFERS_MAX_PAGES):
+            async def fetch_page():
+                await acquire_rate_limit(self.rate_limiter)
+                return await self.client.get_trade_offers(sent=True, received=False, cursor=cursor, **kwargs)
+            page = await network_request_retry(RETRY_STEAM_TRADE_OFFERS, action_message, fetch_page)
+            if page is None:
+                return False
+            offers, _, cursor = page
+            self.page_count += 1
+            for offer in offers:
+                self.offers[offer.trade_offer_id] = offer
+            if not cursor or (stop_before is not None and any(self.updated_at(offer) < stop_before for offer in offers)):
+                return True
+        print(f"Stopped after {SENT_OFFERS_MAX_PAGES} pages of Steam trade offers sent.")
+        return True
+
+    @staticmethod
+    def updated_at(offer) -> float:
+        return to_timestamp(getattr(offer, "time_updated", None) or getattr(offer, "time_created", None)) or float("inf")
+
+    async def sync(self, since: float) -> bool:
+        started_at = time.time()
+        since -= SENT_OFFERS_SYNC_MARGIN_SECONDS
+        if self.loaded_since is None or since < self.loaded_since:
+            synced = await self.fetch_pages("fetching Steam trade offers sent", stop_before=since, active_only=False)
+            if synced:
+                self.loaded_since = since
+        else:
+            synced = await self.fetch_pages("fetching Steam trade offers sent since the last check", active_only=True, time_historical_cutoff=int(self.synced_at - SENT_OFFERS_SYNC_MARGIN_SECONDS))
+        if not synced:
+            return False
+        self.synced_at = started_at
+        # Offers no check needs any more are dropped, the history is loaded again if an older trade ever needs it.
+        if since > self.loaded_since:
+            self.offers = {offer_id: offer for offer_id, offer in self.offers.items() if self.updated_at(offer) >= since}
+            self.loaded_since = since
+        return True
+
+    def snapshot(self) -> dict:
+        return {"synced_at": self.synced_at, "loaded_since": self.loaded_since, "offers": [dump_trade_offer(offer) for offer in self.offers.values()]}
+
+    def restore(self, snapshot: dict):
+        self.synced_at = snapshot["synced_at"]
+        self.loaded_since = snapshot["loaded_since"]
+        self.offers = {offer.trade_offer_id: offer for offer in map(load_trade_offer, snapshot["offers"])}
+
+# Offer statuses after which the bot has nothing left to do for an offer
+OFFER_STATUSES_DONE = (TradeOfferStatus.ACTIVE, TradeOfferStatus.ACCEPTED, TradeOfferStatus.STATE_IN_ESCROW)
+# Sent offers changed this long before the oldest pending outbox entry are looked up as well, for clock differences with Steam
+OUTBOX_LOOKUP_MARGIN_SECONDS = 300
+
+def sent_offer_key(partner_id: int | None, asset_ids) -> tuple:
+    return partner_id, frozenset(asset_ids)
+
+# Offers sent since `since` (an outbox entry's creation time), the lookup an unfinished outbox entry is resolved with
+async def get_recent_sent_offers(client: MySteamClient, since: float, rate_limiter: TokenBucket | None = None) -> list[TradeOffer]:
+    await acquire_rate_limit(rate_limiter)
+    sent_offers_data = await client.get_trade_offers(active_only=True, time_historical_cutoff=int(since) - OUTBOX_LOOKUP_MARGIN_SECONDS, sent=True, received=False)
+    return sent_offers_data[0]
+
+# Resolves the unfinished outbox entries with Steam: entries without an offer id are matched (by partner and items) against
+# the sent offers changed since the oldest of them, entries with one are looked up by that id if that list doesn't have them.
+# Returns offer id -> trade ids of the offers still waiting for confirmation.
+async def resolve_offer_outbox(client: MySteamClient, trade_state_store: TradeStateStore, rate_limiter: TokenBucket | None = None) -> dict[int, list[str]]:
+    entries = trade_state_store.outbox_unfinished()
+    offers: dict[int, TradeOffer] = {}
+    pending = [entry for entry in entries if entry.offer_id is None]
+    if pending:
+        recent_sent_offers = await network_request_retry(RETRY_STEAM_TRADE_OFFERS, "fetching recent Steam trade offers", get_recent_sent_offers, client, min(entry.created_at for entry in pending), rate_limiter)
+        if recent_sent_offers is None:
+            print(f"Couldn't resolve {len(pending)} unfinished trade offers. Their items are not offered again until they are.")
+            entries = [entry for entry in entries if entry.offer_id is not None]
+        else:
+            # Entries that already have an offer id are answered from the same list when their offer is in it.
+            offers = {offer.trade_offer_id: offer for offer in recent_sent_offers}
+            recent_offers = {sent_offer_key(to_account_id(offer.partner_id), [itg.asset_id for itg in offer.items_to_give]): offer for offer in recent_sent_offers}
+            for entry in pending:
+                offer = recent_offers.get(sent_offer_key(entry.partner_id, entry.asset_ids))
+                if offer is None:
+                    print(f"Trade offer for trades {entry.trade_ids} was never created.")
+                    trade_state_store.outbox_set(entry.entry_id, OUTBOX_FAILED)
+                    continue
+                entry.offer_id = offer.trade_offer_id
+                offers[entry.offer_id] = offer
+    offers_to_confirm = {}
+    for entry in entries:
+        if entry.offer_id is None:
+            continue
+        offer = offers.get(entry.offer_id)
+        if offer is None:
+            async def fetch_offer():
+                await acquire_rate_limit(rate_limiter)
+                return await client.get_trade_offer(entry.offer_id)
+            offer = await network_request_retry(RETRY_STEAM_TRADE_OFFERS, f"fetching Steam trade offer {entry.offer_id}", fetch_offer)
+            if offer is None:
+                continue
+        if offer.status == TradeOfferStatus.CONFIRMATION_NEED:
+            trade_state_store.outbox_set(entry.entry_id, OUTBOX_SENT, entry.offer_id)
+            trade_state_store.set_states(entry.trade_ids, TRADE_STATE_OFFER_SENT, entry.offer_id)
+            offers_to_confirm[entry.offer_id] = entry.trade_ids
+        elif offer.status in OFFER_STATUSES_DONE:
+            trade_state_store.outbox_set(entry.entry_id, OUTBOX_DONE, entry.offer_id)
+            trade_state_store.set_states(entry.trade_ids, TRADE_STATE_CONFIRMED, entry.offer_id)
+        else:
+            print(f"Trade offer {entry.offer_id} for trades {entry.trade_ids} is {offer.status.name.lower()}.")
+            trade_state_store.outbox_set(entry.entry_id, OUTBOX_FAILED, entry.offer_id)
+    if entries:
+        print(f"Resolved {len(entries)} unfinished trade offers, {len(offers_to_confirm)} waiting for confirmation.")
+    return offers_to_confirm
+
+# Confirmed offers of trades CSFloat still lists as accepted are checked with the sent offer cache (one incremental page per
+# check). An offer that was declined, canceled or expired fails its outbox entry and its trades are accepted again, so
+# their items count as not offered and get a new offer. Returns trade id -> offer id of the confirmed offers still open
+# or accepted, all of them if Steam couldn't be asked.
+async def recheck_confirmed_offers(trades: list[Trade], trade_state_store: TradeStateStore, sent_offer_cache: SentOfferCache) -> dict[str, int]:
+    confirmed = trade_state_store.confirmed_offers(trade.id for trade in trades)
+    if not confirmed:
+        return {}
+    if not await sent_offer_cache.sync(min(confirmed_at for _, confirmed_at in confirmed.values())):
+        print(f"Couldn't check {len(confirmed)} confirmed trade offers with Steam, they are taken as still open.")
+        return {trade_id: offer_id for trade_id, (offer_id, _) in confirmed.items()}
+    closed_offer_ids = set()
+    for offer_id in {offer_id for offer_id, _ in confirmed.values()}:
+        offer = sent_offer_cache.offers.get(offer_id)
+        if offer is None:
+            async def fetch_offer():
+                await acquire_rate_limit(sent_offer_cache.rate_limiter)
+                return await sent_offer_cache.client.get_trade_offer(offer_id)
+            offer = await network_request_retry(RETRY_STEAM_TRADE_OFFERS, f"fetching Steam trade offer {offer_id}", fetch_offer)
+            if offer is None:
+                continue
+        if offer.status not in OFFER_STATUSES_DONE and offer.status != TradeOfferStatus.CONFIRMATION_NEED:
+            print(f"Trade offer {offer_id} is {offer.status.name.lower()}, its trades get a new offer.")
+            closed_offer_ids.add(offer_id)
+    if closed_offer_ids:
+        trade_state_store.reopen_trades(trade_id for trade_id, (offer_id, _) in confirmed.items() if offer_id in closed_offer_ids)
+        trade_state_store.outbox_set_offers(closed_offer_ids, OUTBOX_FAILED)
+    return {trade_id: offer_id for trade_id, (offer_id, _) in confirmed.items() if offer_id not in closed_offer_ids}
+
+# CSFloat timestamps end with "Z", which datetime.fromisoformat only accepts since Python 3.11. A timestamp without an offset is UTC.
+def parse_timestamp(value: str | None) -> float | None:
+    try:
+        parsed = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith(("Z", "z")) else value)
+    except (AttributeError, TypeError, ValueError):
         return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+async def get_actionable_trades_sell(session, csfloat_api_key,my_steam_id, rate_limiter: TokenBucket | None = None) -> list[Trade] | None:
+    trades_list_sell = await get_trades(session, csfloat_api_key, rate_limiter, my_steam_id)
+    if trades_list_sell is None:
+        print("Failed to fetch trades.")
+    return trades_list_sell
+
+TRADE_STATE_FIELDS = ('state', 'accepted_at', 'verify_sale_at', 'trade_token', 'trade_url')
+
+@dataclass
+class TradesDiff:
+    new: list[Trade] = field(default_factory=list)
+    changed: list[Trade] = field(default_factory=list)
+    removed: list[Trade] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.new or self.changed or self.removed)
+
+# Actionable sell trades fetched once per check and kept until the next one, to expose what changed in between.
+# Refreshes inside a check only apply state changes to the trades that are tracked by the caller.
+class TradesSnapshot:
+    def __init__(self, session, csfloat_api_key, my_steam_id, rate_limiter: TokenBucket | None = None):
+        self.session = session
+        self.csfloat_api_key = csfloat_api_key
+        self.my_steam_id = my_steam_id
+        self.rate_limiter = rate_limiter
+        self.trades: dict[str, Trade] = {}
+        self.previous: dict[str, Trade] = {}
+        self.last_diff = TradesDiff()
+
+    @staticmethod
+    def diff(previous: dict[str, Trade], current: dict[str, Trade]) -> TradesDiff:
+        trades_diff = TradesDiff()
+        for trade_id, trade in current.items():
+            previous_trade = previous.get(trade_id)
+            if previous_trade is None:
+                trades_diff.new.append(trade)
+            elif any(getattr(previous_trade, key) != getattr(trade, key) for key in TRADE_STATE_FIELDS):
+                trades_diff.changed.append(trade)
+        trades_diff.removed = [trade for trade_id, trade in previous.items() if trade_id not in current]
+        return trades_diff
+
+    async def fetch(self) -> dict[str, Trade] | None:
+        trades_list_sell = await get_actionable_trades_sell(self.session, self.csfloat_api_key, self.my_steam_id, self.rate_limiter)
+        if trades_list_sell is None:
+            return None
+        return {trade.id: trade for trade in trades_list_sell}
+
+    async def refresh(self) -> TradesDiff | None:
+        current = await self.fetch()
+        if current is None:
+            return None
+        self.last_diff = self.diff(self.trades, current)
+        self.previous, self.trades = self.trades, current
+        if self.last_diff:
+            print(f"Trades changed since the last check: {len(self.last_diff.new)} new, {len(self.last_diff.changed)} changed, {len(self.last_diff.removed)} removed.")
+        return self.last_diff
+
+    async def refresh_tracked(self, trade_ids: list[str]) -> TradesDiff | None:
+        current = await self.fetch()
+        if current is None:
+            return None
+        tracked = {trade_id: self.trades[trade_id] for trade_id in trade_ids if trade_id in self.trades}
+        trades_diff = self.diff(tracked, {trade_id: current[trade_id] for trade_id in tracked if trade_id in current})
+        for trade in trades_diff.changed:
+            tracked_trade = self.trades[trade.id]
+            for key in TRADE_STATE_FIELDS:
+                setattr(tracked_trade, key, getattr(trade, key))
+        for trade in trades_diff.removed:
+            self.trades.pop(trade.id, None)
+        return trades_diff
+
+    # Marks trades as accepted from the bulk accept responses (see split_accept_result), without fetching the trade list again.
+    def apply_accepted(self, accepted_trades: dict[str, dict]):
+        accepted_at = datetime.now(timezone.utc).isoformat()
+        for trade_id, accepted_trade in accepted_trades.items():
+            trade = self.trades.get(trade_id)
+            if trade is None:
+                continue
+            if accepted_trade:
+                for key in TRADE_STATE_FIELDS:
+                    if accepted_trade.get(key) is not None:
+                        setattr(trade, key, accepted_trade[key])
+            if not trade.accepted_at:
+                trade.accepted_at = accepted_at
+
+    def trades_list(self) -> list[Trade]:
+        return list(self.trades.values())
+
+    def to_accept(self) -> list[Trade]:
+        return [trade for trade in self.trades.values() if not trade.accepted_at]
+
+    def accepted(self) -> list[Trade]:
+        return [trade for trade in self.trades.values() if trade.accepted_at and not trade.verify_sale_at]
+
+async def dispatch_offer(client: MySteamClient, trade: OfferGroup, my_steam_id, inventory_cache: InventoryCache, rate_limiters: dict[str, TokenBucket], timings: StageTimings, trade_state_store: TradeStateStore | None = None):
+    trade_id = trade.trade_id
+    seller_id = trade.seller_id  # ID отправителя
+    buyer_id = trade.buyer_id    # ID получателя
+    asset_id = trade.asset_id
+    trade_token = trade.trade_token  # Получаем trade_token
+    trade_url = trade.trade_url      # Получаем trade_url
+    accepted_at = trade.accepted_at  # Получаем время принятия, если есть
+
+    # print(f"seller_id {type(seller_id)} my_steam_id {type(my_steam_id)}")
+    if seller_id !=my_steam_id:
+        print(f"Trade {trade_id} is not a sell trade, skipping.")
+        return
+
+    if trade_id and seller_id and buyer_id and asset_id:
+        print(f"Trade {trade_id} is a sell trade, proceeding.")
+        if accepted_at:
+            # The offer has already been accepted. Sending a trade offer
+            print(f"Trade {trade_id} has already been accepted. Proceed to sending a trade offer.")
+            with timings.measure("send_offer"):
+                offer_id = await csfloat_send_steam_trade( #wip if items disappered
+                    client,
+                    trade_id=int(trade_id),        # Передаём trade_id как строку
+                    buyer_steam_id=int(buyer_id),  # Передаём buyer_id как целое число
+                    asset_id=asset_id,
+                    trade_token=trade_token,
+                    trade_url=trade_url,
+                    inventory_cache=inventory_cache,
+                    rate_limiter=rate_limiters.get(SERVICE_STEAM),
+                    trade_ids=trade.trade_ids,
+                    trade_state_store=trade_state_store
+                )
+
+            if offer_id:
+                if trade_state_store is not None:
+                    trade_state_store.set_states(trade.trade_ids, TRADE_STATE_OFFER_SENT, offer_id)
+                if metrics.enabled:
+                    metrics.inc("trades_total", len(trade.trade_ids), stage="offered")
+                    accepted_time = parse_timestamp(accepted_at)
+                    if accepted_time is not None:
+                        metrics.observe("offer_send_delay_seconds", time.time() - accepted_time, METRICS_OFFER_DELAY_BUCKETS)
+                return offer_id
+            else:
+                print(f"Failed to send trade for {trade_id}")
+
+# CSFloat cancels a sale when the seller hasn't sent the trade offer this long after the trade was accepted
+OFFER_SEND_DEADLINE_SECONDS = 12 * 3600
+# Dispatch time after which offers that can wait for the next check are left to it. A long dispatch also holds back
+# the confirmation of the offers it already sent.
+OFFER_DISPATCH_BUDGET_SECONDS = 300
 
-async def check_actionable_trades(session, csfloat_api_key, client: MySteamClient, shared_secret, identity_secret, processed_trades, check_interval_seconds,my_steam_id):
-    user_info = await get_user_info(session, csfloat_api_key)
+# Sends the trade offers of a cycle in parallel, at most `concurrency` at a time, the ones closest to their send deadline first.
+# Once `budget_seconds` have passed, offers whose deadline is further away than the next check are deferred to it.
+# Returns offer id -> trade ids of the sent offers.
+async def dispatch_offers(client: MySteamClient, offer_maker: list[OfferGroup], my_steam_id, inventory_cache: InventoryCache, rate_limiters: dict[str, TokenBucket], concurrency: int, timings: StageTimings, trade_state_store: TradeStateStore | None = None, budget_seconds: float | int = OFFER_DISPATCH_BUDGET_SECONDS, next_check_seconds: float | int | None = None) -> dict[int, list[int]]:
+    offers_sent = {}
+    queue = [(group.accepted_time + OFFER_SEND_DEADLINE_SECONDS if group.accepted_time is not None else float("inf"), index, group) for index, group in enumerate(offer_maker) if isinstance(group, OfferGroup)]
+    heapq.heapify(queue)
+    started_at = time.monotonic()
+    deferred = []
+    missed = []
+    async def dispatch_worker():
+        while queue:
+            deadline_at, _, trade = heapq.heappop(queue)
+            if budget_seconds and next_check_seconds is not None and time.monotonic() - started_at > budget_seconds and deadline_at - time.time() > next_check_seconds:
+                deferred.append(trade)
+                continue
+            try:
+                offer_id = await dispatch_offer(client, trade, my_steam_id, inventory_cache, rate_limiters, timings, trade_state_store)
+            except Exception as err:
+                print(f"Other error occurred while dispatching trade offer for {trade.trade_id}: {err}")
+                offer_id = None
+            if offer_id:
+                offers_sent[int(offer_id)] = trade.trade_ids
+            if time.time() > deadline_at:
+                missed.append(trade)
+                metrics.inc("offer_deadline_misses_total", len(trade.trade_ids), outcome="sent" if offer_id else "failed")
+    await asyncio.gather(*(dispatch_worker() for _ in range(max(1, concurrency))))
+    if deferred:
+        print(f"Dispatch budget of {budget_seconds} seconds used up, {len(deferred)} trade offers deferred to the next check.")
+    if missed:
+        print(f"Trade offers past the send deadline: {', '.join(str(trade.trade_id) for trade in missed)}.")
+    return offers_sent
+
+# Random pause in seconds before accepting trades and before fetching the details of accepted trades
+ACCEPT_DELAY_SECONDS = (6, 11)
+
+async def check_actionable_trades(session, csfloat_api_key, client: MySteamClient, shared_secret, identity_secret, trade_state_store: TradeStateStore | None, check_interval_seconds,my_steam_id, inventory_cache_ttl_seconds=120, offer_group_by=OFFER_GROUP_BY_BUYER_ITEM, rate_limiters: dict[str, TokenBucket] | None = None, dispatch_concurrency=4, timings: StageTimings | None = None, user_info=None, trades_snapshot: "TradesSnapshot | None" = None, accept_chunk_size=ACCEPT_CHUNK_SIZE, accept_concurrency=ACCEPT_CONCURRENCY, sent_offer_cache: SentOfferCache | None = None, dispatch_budget_seconds=OFFER_DISPATCH_BUDGET_SECONDS, missing_asset_cache: MissingAssetCache | None = None):
+    if rate_limiters is None:
+        rate_limiters = {}
+    if timings is None:
+        timings = StageTimings()
+    csfloat_rate_limiter = rate_limiters.get(SERVICE_CSFLOAT)
+    steam_rate_limiter = rate_limiters.get(SERVICE_STEAM)
+    # Every check reads fresh data, results are only reused within one check
+    single_flight.invalidate(csfloat_api_key)
+    single_flight.invalidate(steam_single_flight_scope(my_steam_id))
+    if user_info is None:
+        with timings.measure("user_info"):
+            user_info = await get_user_info(session, csfloat_api_key, csfloat_rate_limiter)
     # print(user_info)#debug
     # await get_trades(session, csfloat_api_key)#debug
         
@@ -385,143 +1772,116 @@ async def check_actionable_trades(session, csfloat_api_key, client: MySteamClien
         print("Unfinished trades found, fetching trade details...")
         # print(trades_info)#debug
         # sys.exit()#debug
-        trades_list_sell=await get_actionable_trades_sell(session, csfloat_api_key,my_steam_id)
+        if trades_snapshot is None:
+            trades_snapshot = TradesSnapshot(session, csfloat_api_key, my_steam_id, csfloat_rate_limiter)
+        with timings.measure("trades"):
+            trades_diff = await trades_snapshot.refresh()
+        trades_list_sell = trades_snapshot.trades_list() if trades_diff is not None else None
+        if trades_diff:
+            metrics.inc("trades_total", len(trades_diff.new), stage="seen")
+        if trades_diff is not None and trade_state_store is not None:
+            trade_state_store.forget_states(trades_snapshot.trades)
+        if trades_diff and trade_state_store is not None:
+            trade_state_store.set_states([trade.id for trade in trades_diff.new + trades_diff.changed if trade.verify_sale_at], TRADE_STATE_VERIFIED)
         # print(trades_list_sell)#debug
         if trades_list_sell:
             # breakpoint()#debug
-            # print(trades_list_sell)#debug
-            # buyer_id_n_market_hash_name=[]
-            index_excluded=[]
             offer_maker=[]
-            trades_list_sell_to_accept=list(filter(lambda c: not c.get('accepted_at'), trades_list_sell))
+            trade_ids_without_details = set()
+            trades_list_sell_to_accept=trades_snapshot.to_accept()
             # print(trades_list_sell_to_accept) #debug
             if trades_list_sell_to_accept:
-                trades_list_sell_to_accept_processing=trades_list_sell_to_accept
-                trades_accept_loop_count=0
-                while True:
-                    # breakpoint()
-                    if trades_accept_loop_count>8:
-                        print(f"trades_accept looped more than {trades_accept_loop_count} times. Stop for this check.")
-                        return
-                    if trades_accept_loop_count%3==0:
-                        print("Updating the trade list.") #wip fetch new items
-                        trades_list_sell_to_accept=list(filter(lambda c: not c.get('accepted_at'), await get_actionable_trades_sell(session, csfloat_api_key,my_steam_id)))
-                        # print(trades_list_sell_to_accept)#debug
-                        if not trades_list_sell_to_accept:
-                            print("All accetable trade accepted.")
-                            break
-
-                    if isinstance(trades_list_sell_to_accept, list):
-                        trade_ids_to_accept=[]
-                        for trade in trades_list_sell_to_accept:
-                            if isinstance(trade, dict):
-                                trade_id = trade.get('id')
-                                trade_ids_to_accept.append(str(trade_id))
-                            #     trade_id = trade.get('id')
-                            #     seller_id = int(trade.get('seller_id'))  # ID отправителя
-                            #     buyer_id = int(trade.get('buyer_id'))    # ID получателя
-                            #     asset_id = trade.get('contract', {}).get('item', {}).get('asset_id')
-                            #     trade_token = trade.get('trade_token')  # Получаем trade_token
-                            #     trade_url = trade.get('trade_url')      # Получаем trade_url
-                            #     trade_state = trade.get('state')        # Получаем состояние трейда
-                            #     if trade_id and seller_id and buyer_id and asset_id:
-                            #         print(f"Trade {trade_id} is a sell trade.")
-                            #         # continue#debug
-
-                            #         print(f"Accepting trade {trade_id}...")
-                            #         accept_result = await accept_trade(session, csfloat_api_key, trade_id=str(trade_id), trade_token=trade_token)
-
-                            #         if accept_result:
-                            #             print(f"Accepted trade {trade_id}...")
-                            #             trades_list_sell_to_accept_processing=list(filter(lambda c: c["id"] != trade_id, trades_list_sell_to_accept_processing))
-                            #             # print(f"{trades_list_sell_to_accept_processing}")#debug
-
-                            #         else:
-                            #             print(f"Failed to accept trade {trade_id}")
-                            # await asyncio.sleep(0.19) #0.23
-                        await asyncio.sleep(round(random.uniform(6, 11),4))
-                        accept_result = await accept_trades_bulk(session, csfloat_api_key, trade_ids=trade_ids_to_accept)
-                        if accept_result: # wip cancel trades if can't send trade offers
-                            print(f"Accepted trades.")
-                            for ati in trade_ids_to_accept:
-                                trades_list_sell_to_accept_processing=list(filter(lambda c: c["id"] != str(ati), trades_list_sell_to_accept_processing))
-                            # print(f"{trades_list_sell_to_accept_processing}")#debug
-                        else:
-                            print(f"Failed to accept trade {trade_id}")
-                        if not trades_list_sell_to_accept_processing:
-                            print("All accetable trade accepted.")
-                            break        
-                        else:
-                            trades_list_sell_to_accept=trades_list_sell_to_accept_processing
-                            trades_accept_loop_count+=1
-                            print(f"Can't accept all trades. Retrying: {trades_accept_loop_count}.")
-                    else:
-                        print(f"Unexpected trades list format: {type(trades_list_sell)}")
-                    await asyncio.sleep(1)
-                await asyncio.sleep(round(random.uniform(6, 11),4))
+                trade_ids_to_accept=[trade.id for trade in trades_list_sell_to_accept]
+                await asyncio.sleep(round(random.uniform(*ACCEPT_DELAY_SECONDS),4))
+                with timings.measure("accept"):
+                    accepted_trades, trade_ids_failed = await accept_trades_chunked(session, csfloat_api_key, trade_ids_to_accept, accept_chunk_size, accept_concurrency, csfloat_rate_limiter)
+                trade_ids_accepted=list(accepted_trades)
+                if trade_ids_accepted: # wip cancel trades if can't send trade offers
+                    print(f"Accepted {len(trade_ids_accepted)} trades.")
+                    trades_snapshot.apply_accepted(accepted_trades)
+                    if trade_state_store is not None:
+                        trade_state_store.set_states(trade_ids_accepted, TRADE_STATE_ACCEPTED)
+                    metrics.inc("trades_total", len(trade_ids_accepted), stage="accepted")
+                if trade_ids_failed:
+                    print(f"Failed to accept trades {trade_ids_failed}. They are retried in the next check.")
+                else:
+                    print("All accetable trade accepted.")
+                if trade_ids_accepted:
+                    await asyncio.sleep(round(random.uniform(*ACCEPT_DELAY_SECONDS),4))
+                    # Trades accepted in this check get their trade details (trade url and token) from CSFloat.
+                    with timings.measure("trades"):
+                        if await trades_snapshot.refresh_tracked(trade_ids_accepted) is None:
+                            print(f"Couldn't fetch the trade details of {len(trade_ids_accepted)} accepted trades. Their trade offers are sent in the next check.")
+                            trade_ids_without_details = set(trade_ids_accepted)
             # breakpoint()
-            trades_list_sell_accepted=list(filter(lambda c: c.get('accepted_at') and not c.get('verify_sale_at'), await get_actionable_trades_sell(session, csfloat_api_key,my_steam_id)))
+            trades_list_sell_accepted=trades_snapshot.accepted()
+            if trade_ids_without_details:
+                trades_list_sell_accepted = [trade for trade in trades_list_sell_accepted if trade.id not in trade_ids_without_details]
+            # offer id -> trade ids of every offer to confirm in this check, confirmed together after dispatching
+            offers_to_confirm={}
+            if sent_offer_cache is None:
+                sent_offer_cache = SentOfferCache(client, steam_rate_limiter)
+            if trades_list_sell_accepted and trade_state_store is not None:
+                with timings.measure("outbox"):
+                    trade_state_store.outbox_prune()
+                    offers_to_confirm.update(await resolve_offer_outbox(client, trade_state_store, steam_rate_limiter))
+                    trade_ids_offer_open = await recheck_confirmed_offers(trades_list_sell_accepted, trade_state_store, sent_offer_cache)
+                # Trades whose confirmed offer is still open (or accepted) need nothing more: no grouping, outbox or history matching
+                if trade_ids_offer_open:
+                    print(f"Skipped {len(trade_ids_offer_open)} trades whose confirmed trade offers are still open.")
+                    trades_list_sell_accepted = [trade for trade in trades_list_sell_accepted if trade.id not in trade_ids_offer_open]
             if trades_list_sell_accepted:
-                for i in range(len(trades_list_sell_accepted)):
-                    if i not in index_excluded:
-                        asset_id_list_temp=[]
-                        for ii in range(len(trades_list_sell_accepted)):
-                            if trades_list_sell_accepted[ii]['buyer_id']==trades_list_sell_accepted[i]['buyer_id'] and trades_list_sell_accepted[ii]["contract"]["item"]["market_hash_name"]==trades_list_sell_accepted[i]["contract"]["item"]["market_hash_name"]:
-                                asset_id_list_temp.append(int(trades_list_sell_accepted[ii]["contract"]["item"]["asset_id"]))
-                                index_excluded.append(ii)
-                        offer_maker.append({"trade_id":int(trades_list_sell_accepted[i]["id"]),"buyer_id":int(trades_list_sell_accepted[i]["buyer_id"]),"seller_id":int(trades_list_sell_accepted[i]["seller_id"]),"asset_id":asset_id_list_temp,"trade_token":trades_list_sell_accepted[i]["trade_token"],"trade_url":trades_list_sell_accepted[i]["trade_url"],"accepted_at":trades_list_sell_accepted[i].get('accepted_at'),"trade_state":trades_list_sell_accepted[i]["state"]})
-                        # print(index_excluded)
+                with timings.measure("grouping"):
+                    offer_maker=group_trades_for_offers(trades_list_sell_accepted, offer_group_by)
                 # print(offer_maker)
             else:
                 # breakpoint()
                 print(f"No actionable sell trades at the moment. Waiting for {check_interval_seconds} seconds before next check.")
                 return None
-            # breakpoint()
-            retryCount=0
-            while True:
-                try:
-                    sentto, _, next_cursorvar = await client.get_trade_offers(active_only=False,received=False)
-                    break
-                except aiohttp.ClientResponseError as http_err:
-                    print(f"HTTP error occurred while fetching Steam trade offers sent: {http_err}")
-                except ConnectionError as connect_err:
-                    print(f"connection error occurred while fetching Steam trade offers sent: {connect_err}")
-                except Exception as err:
-                    print(f"Other error occurred while fetching Steam trade offers sent: {err}")
-                retryCount+=1
-                if retryCount >5:
-                    print(f"Failed too many times. Waiting for {check_interval_seconds} seconds before next check.")
+            # With the outbox only its unfinished entries are looked up. The whole sent offer history is still matched
+            # while there are trades accepted before the outbox existed, or without a trade state store.
+            history_needed = trade_state_store is None
+            accepted_times = [parse_timestamp(trade.accepted_at) for trade in trades_list_sell_accepted]
+            if trade_state_store is not None:
+                history_needed = any(accepted_time is None or accepted_time < trade_state_store.outbox_since for accepted_time in accepted_times)
+                offered_asset_ids = trade_state_store.outbox_offered_asset_ids(0 if history_needed else min(accepted_times, default=0) - OUTBOX_LOOKUP_MARGIN_SECONDS)
+                for group in offer_maker:
+                    group_offered = offered_asset_ids.get(to_account_id(group.buyer_id), set())
+                    if any(tai in group_offered for tai in group.asset_id):
+                        print(f"Already sent asset_id: {sorted(tai for tai in group.asset_id if tai in group_offered)}")
+                        group.asset_id=[tai for tai in group.asset_id if tai not in group_offered]
+            if history_needed:
+                # breakpoint()
+                # An offer can't be older than the acceptance of its trades.
+                with timings.measure("sent_offers"):
+                    synced = await sent_offer_cache.sync(0 if None in accepted_times else min(accepted_times, default=time.time()))
+                if not synced:
+                    print(f"Failed to fetch Steam trade offers sent. Waiting for {check_interval_seconds} seconds before next check.")
                     return None
-                await asyncio.sleep(5)
-            for omi in range(len(offer_maker)):
-            # for omi in offer_maker:
-                asset_id_sent=[]
-                for toi in range(len(sentto)):
-                    if sentto[toi].partner_id >76561197960265728:
-                        sentto[toi].partner_id-=76561197960265728
-                    if offer_maker[omi]["buyer_id"] >76561197960265728:
-                        offer_maker[omi]["buyer_id"]-=76561197960265728
-                    if sentto[toi].status in (TradeOfferStatus.ACCEPTED,TradeOfferStatus.ACTIVE,TradeOfferStatus.CONFIRMATION_NEED) and sentto[toi].partner_id==offer_maker[omi]["buyer_id"]:                  
-                        for itg in sentto[toi].items_to_give:
-                            asset_id_sent.append(itg.asset_id)
-                        if sentto[toi].status == TradeOfferStatus.CONFIRMATION_NEED:
-                            asset_id_sent_check=asset_id_sent
-                            # asset_id_sent_check.append(1522523)#debug
-                            for itgom in offer_maker[omi]["asset_id"]:
-                                asset_id_sent_check=list(filter(lambda c: c!=itgom,asset_id_sent_check))
-                            if not asset_id_sent_check:
-                                print("Trade offer to confirm matched.")
-                                await confirm_trade_offer_retry(client,sentto[toi].trade_offer_id)
-                            else:
-                                print("Trade offer to confirm not matched.")
-
-                print(asset_id_sent)
-                if asset_id_sent:
-                    for i in asset_id_sent:
-                        offer_maker[omi]["asset_id"]=list(filter(lambda c: c!=i,offer_maker[omi]["asset_id"]))
-                # if not offer_maker[omi]["asset_id"]: # Empty asset_id detection already implemented in function "csfloat_send_steam_trade"
-                # print(offer_maker[omi]["asset_id"])#debug
+                with timings.measure("reconcile"):
+                    sent_offer_index=SentOfferIndex(list(sent_offer_cache.offers.values()))
+                for group in offer_maker:
+                    reconciliation=sent_offer_index.reconcile(group)
+                    for offer in reconciliation.offers_to_confirm:
+                        if offer.trade_offer_id not in offers_to_confirm:
+                            print(f"Trade offer {offer.trade_offer_id} to confirm matched.")
+                        offer_trade_ids = offers_to_confirm.setdefault(offer.trade_offer_id, [])
+                        offer_trade_ids.extend(trade_id for trade_id in map(str, group.trade_ids) if trade_id not in offer_trade_ids)
+                    if reconciliation.sent_asset_ids:
+                        print(f"Already sent asset_id: {sorted(reconciliation.sent_asset_ids)}")
+                    group.asset_id=reconciliation.missing_asset_ids
+                # if not group.asset_id: # Empty asset_id detection already implemented in function "csfloat_send_steam_trade"
+            # Offers with items known to be missing from the inventory are left for manual action
+            if missing_asset_cache is None:
+                missing_asset_cache = MissingAssetCache()
+            missing_asset_cache.prune({int(trade.id) for trade in trades_list_sell_accepted})
+            offer_maker_missing = [group for group in offer_maker if missing_asset_cache.missing(group.asset_id)]
+            if offer_maker_missing:
+                offer_maker = [group for group in offer_maker if not missing_asset_cache.missing(group.asset_id)]
+                print(f"Skipped {len(offer_maker_missing)} trade offers with items not in the inventory, these trades need manual action:")
+                missing_asset_cache.report()
             print(offer_maker)
+            inventory_cache=InventoryCache(client, AppContext.CS2, ttl_seconds=inventory_cache_ttl_seconds, rate_limiter=steam_rate_limiter, missing_assets=missing_asset_cache)
             # for item in trades_list_sell_accepted:
             # extItem={"buyer_id":item['buyer_id'],"market_hash_name":item["contract"]["item"]["market_hash_name"],}
             #     buyer_id_n_market_hash_name.append(extItem)
@@ -534,109 +1894,769 @@ async def check_actionable_trades(session, csfloat_api_key, client: MySteamClien
             # item.update({"trade_id": findItem["id"], "seller_id": findItem["seller_id"], "asset_id": findItem["contract"]["item"]["asset_id"], "trade_token": findItem["trade_token"], "trade_url": findItem["trade_url"], "accepted_at": findItem["accepted_at"], "trade_state": findItem["trade_state"]}) #wip multiple asset_id
             #     offer_maker.append(item)
             # print(offer_maker)
-            # return #debug wip complete retry if confirm failed
-            """
-            if next(filter(lambda c: c.status==TradeOfferStatus.CONFIRMATION_NEED ,sentto)):
-                retryCount=0
-                while True:
-                    if retryCount>4:
-                        print("Failed too many times.")
-                        sys.exit()
-                    try:
-                        confirmations=await client.get_confirmations(update_listings=False) # wip attr
-                        trades_to_confirm=await client.get_confirmations(update_listings=False)
-                        # print(fr"aaa11a.")
-                        if trades_to_confirm:
-                            # print(fr"aaa111.")
-                            trades_to_confirm_correct = list(filter(lambda c: c.type == ConfirmationType.TRADE, trades_to_confirm)) # c.headline: 'Selling for ¥ 1.11'. c.summary: EconItem.description.market_hash_name
-                            if trades_to_confirm_correct:
-                                # print(fr"aaa112.")
-                                await client.allow_multiple_confirmations(trades_to_confirm_correct)
-                            else:
-                                print("No matched confirmation found.")
-                                break
-                        else:
-                            print("No matched confirmation found.")
-                            break
-                    except Exception as e:
-                        print(fr"{type(e)} {e}")
-                        # writeToFile(os.path.join(LOGS_FOLDER, "1.log"),fr"{type(e)} {e}","a")
-                        await asyncio.sleep(5)
-                    else:
-                        break
-                    retryCount+=1
-
-            """
             if isinstance(offer_maker, list):
-                for trade in offer_maker:
-                    if isinstance(trade, dict):
-                        trade_id = trade.get('trade_id')
-
-                        """
-                        # Проверка, был ли уже обработан этот trade_id
-                        if str(trade_id) in processed_trades:
-                            print(f"Trade {trade_id} has already been processed. Skipping.")
-                            continue  # Пропустить уже обработанные трейды
-                        """
-
-                        seller_id = int(trade.get('seller_id'))  # ID отправителя
-                        buyer_id = int(trade.get('buyer_id'))    # ID получателя
-                        asset_id = trade.get('asset_id')
-                        trade_token = trade.get('trade_token')  # Получаем trade_token
-                        trade_url = trade.get('trade_url')      # Получаем trade_url
-                        accepted_at = trade.get('accepted_at')  # Получаем время принятия, если есть
-                        trade_state = trade.get('trade_state')        # Получаем состояние трейда
-                        # print(trade)#debug
-                        # continue#debug wip fix the bug that can't accept multiple trades.
-                        
-                        # print(f"seller_id {type(seller_id)} my_steam_id {type(my_steam_id)}")
-                        if seller_id !=my_steam_id:
-                            print(f"Trade {trade_id} is not a sell trade, skipping.")
-                            continue
-
-                        """
-                        if trade_state == "verified":
-                            # If the trade is already verified, add it to processed and skip it
-                            processed_trades.add(str(trade_id))
-
-                            continue
-                        """
-
-                        if trade_id and seller_id and buyer_id and asset_id:
-                            print(f"Trade {trade_id} is a sell trade, proceeding.")
-                            # print(f"Trade {trade_id} is a sell trade.")
-                            # continue#debug wip retry if confirm failed
-
-                            if accepted_at:
-                                # The offer has already been accepted. Sending a trade offer
-                                print(f"Trade {trade_id} has already been accepted. Proceed to sending a trade offer.")
-                                offer_id = await csfloat_send_steam_trade( #wip if items disappered
-                                    client,
-                                    trade_id=int(trade_id),        # Передаём trade_id как строку
-                                    buyer_steam_id=int(buyer_id),  # Передаём buyer_id как целое число
-                                    asset_id=asset_id,
-                                    trade_token=trade_token,
-                                    trade_url=trade_url
-                                )
-                                # return#debug
-
-                                if offer_id:
-                                    # Автоматически подтверждаем трейды
-                                    # await confirm_trade(client)
-                                    await confirm_trade_offer_retry(client,offer_id)
-                                else:
-                                    print(f"Failed to send trade for {trade_id}")
-
-                        # Добавляем trade_id в processed_trades независимо от результата
-                        # processed_trades.add(str(trade_id))
-                        
+                with timings.measure("dispatch"):
+                    offers_sent = await dispatch_offers(client, offer_maker, my_steam_id, inventory_cache, rate_limiters, dispatch_concurrency, timings, trade_state_store, dispatch_budget_seconds, check_interval_seconds)
+                for offer_id, trade_ids in offers_sent.items():
+                    offers_to_confirm.setdefault(offer_id, []).extend(map(str, trade_ids))
             else:
                 print(f"Unexpected trade maker list format: {type(offer_maker)}")
+            if offers_to_confirm:
+                # Автоматически подтверждаем трейды
+                with timings.measure("confirm"):
+                    offer_ids_confirmed = await confirm_trade_offers_batch(client, offers_to_confirm, steam_rate_limiter)
+                if trade_state_store is not None:
+                    for offer_id in offer_ids_confirmed:
+                        trade_state_store.set_states(offers_to_confirm[offer_id], TRADE_STATE_CONFIRMED, offer_id)
+                    trade_state_store.outbox_set_offers(offer_ids_confirmed, OUTBOX_DONE)
+                metrics.inc("trades_total", sum(len(offers_to_confirm[offer_id]) for offer_id in offer_ids_confirmed), stage="confirmed")
         else:
             print(f"No actionable sell trades at the moment. Waiting for {check_interval_seconds} seconds before next check.")
         print(f"No actionable sell trades at the moment. Waiting for {check_interval_seconds} seconds before next check.")
     else:
+        if trade_state_store is not None:
+            trade_state_store.forget_states()
         print(f"No actionable sell trades at the moment. Waiting for {check_interval_seconds} seconds before next check.")
+SCHEDULER_MODE_FIXED = "fixed"
+SCHEDULER_MODE_ADAPTIVE = "adaptive"
+
+# Polls the cheap /me endpoint and decides when the full check has to run.
+# The poll interval is tightened while trades are actionable and backs off exponentially when idle or failing.
+class AdaptivePollScheduler:
+    def __init__(self, min_seconds: float | int = 15, max_seconds: float | int = 300, backoff_factor: float | int = 2, full_check_seconds: float | int = 600):
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.backoff_factor = backoff_factor
+        self.full_check_seconds = full_check_seconds
+        self.interval = min_seconds
+        self.last_actionable_trades = None
+        self.last_full_check = 0.0
+
+    def should_run_check(self, user_info) -> bool:
+        if not user_info:
+            return False
+        actionable_trades = user_info.get('actionable_trades', 0)
+        changed = actionable_trades != self.last_actionable_trades
+        self.last_actionable_trades = actionable_trades
+        if actionable_trades <= 0:
+            return False
+        if changed:
+            print(f"Actionable trades changed: {actionable_trades}.")
+            return True
+        # Unfinished work (failed offers, trades waiting for acceptance) is retried at the regular check interval.
+        return time.monotonic() - self.last_full_check >= self.full_check_seconds
+
+    def record_check(self):
+        self.last_full_check = time.monotonic()
+
+    def next_interval(self, user_info) -> float:
+        if user_info and user_info.get('actionable_trades', 0) > 0:
+            self.interval = self.min_seconds
+        else:
+            self.interval = min(self.max_seconds, self.interval * self.backoff_factor)
+        return round(self.interval * random.uniform(0.9, 1.1), 4)
+
+# Lets the control API trigger, pause and resume the check loop of one account.
+# Triggers that arrive while a check is running are coalesced into one follow-up check.
+class CheckController:
+    def __init__(self, name: str):
+        self.name = name
+        self.paused = False
+        self.running = False
+        self.trigger_pending = False
+        self.wakeup = asyncio.Event()
+        self.triggers = 0
+        self.coalesced_triggers = 0
+        self.checks = 0
+        self.last_check_started_at = None
+        self.last_check_seconds = None
+        self.next_check_at = None
+        self.trades_snapshot = None
+        self.trade_state_store = None
+        self.missing_asset_cache = None
+        self.reconfigure = None  # reconfigure(account config, new shared CSFloat session or None), set by run_account
+
+    def trigger(self) -> bool:
+        self.triggers += 1
+        if self.trigger_pending:
+            self.coalesced_triggers += 1
+            return False
+        self.trigger_pending = True
+        self.wakeup.set()
+        return True
+
+    def take_trigger(self) -> bool:
+        triggered = self.trigger_pending
+        self.trigger_pending = False
+        return triggered
+
+    # Ends the current wait without a trigger, so the loop picks up changed settings
+    def wake(self):
+        self.wakeup.set()
+
+    # Sleeps until the next scheduled check, a trigger or a wake()
+    async def wait(self, seconds: float):
+        if self.trigger_pending:
+            return
+        self.wakeup.clear()
+        self.next_check_at = time.time() + seconds
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), max(0, seconds))
+        except asyncio.TimeoutError:
+            pass
+
+    @contextmanager
+    def check(self):
+        self.running = True
+        self.last_check_started_at = time.time()
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.running = False
+            self.checks += 1
+            self.last_check_seconds = round(time.perf_counter() - started_at, 3)
+
+    def state(self) -> dict:
+        trades = {}
+        if self.trades_snapshot is not None:
+            for trade in self.trades_snapshot.trades.values():
+                trades[trade.state] = trades.get(trade.state, 0) + 1
+        return {
+            "paused": self.paused,
+            "running": self.running,
+            "trigger_pending": self.trigger_pending,
+            "triggers": self.triggers,
+            "coalesced_triggers": self.coalesced_triggers,
+            "checks": self.checks,
+            "last_check_started_at": self.last_check_started_at,
+            "last_check_seconds": self.last_check_seconds,
+            "next_check_at": None if self.running or self.trigger_pending else self.next_check_at,
+            "trades": trades,
+            "offers_unfinished": len(self.trade_state_store.outbox_unfinished()) if self.trade_state_store is not None else None,
+            "trades_missing_items": sorted({trade_id for asset in self.missing_asset_cache.assets.values() for trade_id in asset.trade_ids}) if self.missing_asset_cache is not None else None,
+        }
+
+# Controllers of the accounts running in this process, by account name
+check_controllers: dict[str, CheckController] = {}
+
+# Serves the control API on http://host:port or on a Unix socket:
+# GET /state, POST /trigger, POST /pause, POST /resume; "?account=<name>" limits a request to one account.
+async def start_control_server(port: int | None = None, host: str = "127.0.0.1", socket_path: str | None = None, token: str | None = None):
+    from aiohttp import web
+    def select(request) -> list[CheckController]:
+        if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            raise web.HTTPUnauthorized()
+        account_name = request.query.get("account")
+        if account_name is None:
+            return list(check_controllers.values())
+        if account_name not in check_controllers:
+            raise web.HTTPNotFound(text=f"Unknown account {account_name}")
+        return [check_controllers[account_name]]
+    async def handle_state(request):
+        return web.json_response({controller.name: controller.state() for controller in select(request)})
+    async def handle_trigger(request):
+        result = {}
+        for controller in select(request):
+            result[controller.name] = "triggered" if controller.trigger() else "coalesced"
+        return web.json_response(result)
+    def set_paused(paused: bool):
+        async def handle(request):
+            result = {}
+            for controller in select(request):
+                controller.paused = paused
+                result[controller.name] = "paused" if paused else "resumed"
+                print(f"Control API: {controller.name} {result[controller.name]}.")
+            return web.json_response(result)
+        return handle
+    app = web.Application()
+    app.router.add_get("/state", handle_state)
+    app.router.add_post("/trigger", handle_trigger)
+    app.router.add_post("/pause", set_paused(True))
+    app.router.add_post("/resume", set_paused(False))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    if socket_path:
+        await web.UnixSite(runner, socket_path).start()
+        print(f"Control API: serving on unix:{socket_path}")
+    else:
+        await web.TCPSite(runner, host, port).start()
+        print(f"Control API: serving http://{host}:{port}")
+    return runner
+
+# Multi-account mode: every entry of the "accounts" list in steam.json is one seller account, top-level values are shared defaults
+def load_account_configs(config: dict) -> list[dict]:
+    accounts = config.get('accounts')
+    if not accounts:
+        return [config]
+    shared_config = {key: value for key, value in config.items() if key != 'accounts'}
+    return [{**shared_config, **account} for account in accounts]
+
+def account_configs_by_name(config: dict) -> dict[str, dict]:
+    return {account_config.get('account_name') or account_config['steam_login']: account_config for account_config in load_account_configs(config)}
+
+# Per-account file next to the single-account one, e.g. cookies.json -> cookies_<account>.json
+def account_file(path: Path, account_name: str | None) -> Path:
+    if not account_name:
+        return path
+    return path.with_name(f"{path.stem}_{account_name}{path.suffix}")
+
+# CSFloat request and socket counters of one account on the shared session
+class AccountStats:
+    def __init__(self, name: str | None):
+        self.name = name
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+# One account's view of the shared CSFloat session, tags its requests for the per-account counters
+class AccountSession:
+    def __init__(self, session: aiohttp.ClientSession, stats: AccountStats):
+        self.session = session
+        self.stats = stats
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, trace_request_ctx=self.stats, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, trace_request_ctx=self.stats, **kwargs)
+
+HTTP_TIMEOUT_SECONDS = 60
+HTTP_CONNECT_TIMEOUT_SECONDS = 15
+HTTP_KEEPALIVE_SECONDS = 60
+HTTP_DNS_CACHE_SECONDS = 300
+HTTP_LIMIT_PER_HOST = 50
+# Hosts whose pool is warmed up before it is needed: CSFloat at startup, Steam at the start of every check
+HTTP_WARM_UP_URLS = {SERVICE_CSFLOAT: ("https://csfloat.com/",), SERVICE_STEAM: ("https://steamcommunity.com/",)}
+
+# Connection pools of one process, shared by the CSFloat session and the Steam clients of all accounts. Every proxy
+# (and the direct connection) gets one pool with its own DNS cache; sessions on a pool only keep their own cookies
+# and default headers. One trace config counts connections and requests in flight per host for the pool report and the metrics,
+# and the requests and connections of an account when its AccountStats is passed as trace_request_ctx (see AccountSession).
+# A pool is closed once no open session uses its proxy any more (after a config reload changed the proxy).
+class HttpTransport:
+    def __init__(self):
+        self.timeout_seconds = HTTP_TIMEOUT_SECONDS
+        self.keepalive_seconds = HTTP_KEEPALIVE_SECONDS
+        self.warm_up_enabled = True
+        self.connectors: dict[str | None, aiohttp.BaseConnector] = {}
+        self.session_proxies: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary() # session -> proxy of its pool
+        self.connections: dict[str, dict[str, int]] = {} # host -> {"created": .., "reused": .., "in_use": ..}
+        self.last_used: dict[tuple[str | None, str], float] = {} # (proxy, host) -> when its last request finished
+        self.warm_up_tasks: set[asyncio.Task] = set()
+        self.tracing = self.make_trace_config()
+
+    def apply_config(self, config: dict):
+        self.timeout_seconds = config.get('http_timeout_seconds') or HTTP_TIMEOUT_SECONDS
+        keepalive_seconds = config.get('http_keepalive_seconds')
+        self.keepalive_seconds = HTTP_KEEPALIVE_SECONDS if keepalive_seconds is None else keepalive_seconds
+        http_warm_up = config.get('http_warm_up')
+        self.warm_up_enabled = True if http_warm_up is None else any2bool(http_warm_up)
+
+    def connector(self, proxy: str | None = None) -> aiohttp.BaseConnector:
+        connector = self.connectors.get(proxy)
+        if connector is None or connector.closed:
+            if proxy:
+                connector = ProxyConnector.from_url(proxy, ttl_dns_cache=HTTP_DNS_CACHE_SECONDS, keepalive_timeout=self.keepalive_seconds, limit_per_host=HTTP_LIMIT_PER_HOST)
+            else:
+                connector = aiohttp.TCPConnector(
+                    resolver=aiohttp.resolver.AsyncResolver() if aiodns is not None else aiohttp.resolver.ThreadedResolver(),
+                    ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+                    keepalive_timeout=self.keepalive_seconds,
+                    limit_per_host=HTTP_LIMIT_PER_HOST
+                )
+            self.connectors[proxy] = connector
+        return connector
+
+    def make_trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        def host_connections(host: str) -> dict[str, int]:
+            return self.connections.setdefault(host, {"created": 0, "reused": 0, "in_use": 0})
+        def count(trace_config_ctx, kind: str):
+            host = getattr(trace_config_ctx, "host", None) or "unknown"
+            host_connections(host)[kind] += 1
+            metrics.inc("http_connections_total", host=host, connection=kind)
+            if isinstance(trace_config_ctx.trace_request_ctx, AccountStats):
+                if kind == "created":
+                    trace_config_ctx.trace_request_ctx.connections_created += 1
+                else:
+                    trace_config_ctx.trace_request_ctx.connections_reused += 1
+        async def on_request_start(session, trace_config_ctx, params):
+            trace_config_ctx.host = params.url.host
+            host_connections(params.url.host)["in_use"] += 1
+            if isinstance(trace_config_ctx.trace_request_ctx, AccountStats):
+                trace_config_ctx.trace_request_ctx.requests += 1
+        async def on_request_done(session, trace_config_ctx, params):
+            host_connections(trace_config_ctx.host)["in_use"] -= 1
+            self.last_used[(self.session_proxies.get(session), trace_config_ctx.host)] = time.monotonic()
+        async def on_connection_create_end(session, trace_config_ctx, params):
+            count(trace_config_ctx, "created")
+        async def on_connection_reuseconn(session, trace_config_ctx, params):
+            count(trace_config_ctx, "reused")
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_done)
+        trace_config.on_request_exception.append(on_request_done)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    # A session on the pool of `proxy`. Closing it leaves the pool open, close_session() also closes the pools no session uses.
+    def session(self, proxy: str | None = None, **kwargs) -> aiohttp.ClientSession:
+        session = aiohttp.ClientSession(
+            connector=self.connector(proxy),
+            connector_owner=False,
+            timeout=aiohttp.ClientTimeout(total=self.timeout_seconds, sock_connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+            trace_configs=[self.tracing],
+            **kwargs
+        )
+        self.session_proxies[session] = proxy
+        return session
+
+    async def close_session(self, session: aiohttp.ClientSession):
+        await session.close()
+        for proxy, connector in list(self.connectors.items()):
+            if not any(session_proxy == proxy and not open_session.closed for open_session, session_proxy in list(self.session_proxies.items())):
+                del self.connectors[proxy]
+                await connector.close()
+                # The closed pool's idle connections are gone, the pools of the other proxies keep theirs
+                self.last_used = {key: last_used for key, last_used in self.last_used.items() if key[0] != proxy}
+
+    # Whether the last request to `host` through the pool of `proxy` finished within the keep-alive time (an idle connection is likely open)
+    def is_warm(self, proxy: str | None, host: str) -> bool:
+        last_used = self.last_used.get((proxy, host))
+        return last_used is not None and time.monotonic() - last_used < self.keepalive_seconds
+
+    # Requests in flight per host and the number of pools with a warm connection to it
+    def pool_usage(self) -> dict[str, dict[str, int]]:
+        hosts = self.connections.keys() | {host for _, host in self.last_used}
+        return {
+            host: {"in_use": self.connections.get(host, {}).get("in_use", 0), "warm": sum(self.is_warm(proxy, host) for proxy in self.connectors)}
+            for host in hosts
+        }
+
+    def report(self):
+        usage = self.pool_usage()
+        hosts = sorted(usage)
+        if not hosts:
+            return
+        print("HTTP pools: " + ", ".join(
+            f"{host} {usage[host]['in_use']} in use/{usage[host]['warm']} warm pools, "
+            f"{self.connections.get(host, {}).get('created', 0)} new/{self.connections.get(host, {}).get('reused', 0)} reused"
+            for host in hosts
+        ))
+
+    async def warm_up(self, proxy: str | None, urls):
+        urls = [url for url in urls if not self.is_warm(proxy, URL(url).host)]
+        if not urls:
+            return
+        async def open_connection(url):
+            try:
+                async with session.head(url, allow_redirects=False):
+                    pass
+            except Exception as err:
+                print(f"Couldn't warm up the connection to {url}: {err}")
+        async with self.session(proxy) as session:
+            await asyncio.gather(*(open_connection(url) for url in urls))
+
+    # Opens keep-alive connections to urls in the background, hosts with an idle connection in the pool are skipped
+    def warm_up_soon(self, proxy: str | None, urls):
+        if not self.warm_up_enabled or self.keepalive_seconds <= 0:
+            return
+        task = asyncio.create_task(self.warm_up(proxy, urls))
+        self.warm_up_tasks.add(task)
+        task.add_done_callback(self.warm_up_tasks.discard)
+
+    async def close(self):
+        for task in list(self.warm_up_tasks):
+            task.cancel()
+        await asyncio.gather(*self.warm_up_tasks, return_exceptions=True)
+        for connector in self.connectors.values():
+            await connector.close()
+        self.connectors.clear()
+        self.last_used.clear()
+
+http_transport = HttpTransport()
+
+# CSFloat request headers are built once per API key. aiohttp copies them into every request, they are never changed.
+@lru_cache(maxsize=256)
+def csfloat_headers(csfloat_api_key: str, json_body: bool = False) -> dict:
+    if json_body:
+        return {'Authorization': csfloat_api_key, 'Content-Type': 'application/json'}
+    return {'Authorization': csfloat_api_key}
+
+# Rough retained size of an object graph in bytes, follows containers, __slots__ and __dict__
+def approximate_size(obj, seen: set | None = None) -> int:
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approximate_size(key, seen) + approximate_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, seen) for item in obj)
+    elif not isinstance(obj, (str, bytes, int, float, bool)) and obj is not None:
+        for slot in getattr(type(obj), '__slots__', ()):
+            size += approximate_size(getattr(obj, slot, None), seen)
+        if hasattr(obj, '__dict__'):
+            size += approximate_size(vars(obj), seen)
+    return size
+
+# Rough retained size of the trade state: one sampled trade and state entry times their counts, the object graph isn't walked on every check
+def estimate_trade_state_size(trades_snapshot: TradesSnapshot, trade_state_store: TradeStateStore) -> int:
+    size = sys.getsizeof(trades_snapshot.trades) + sys.getsizeof(trades_snapshot.previous) + sys.getsizeof(trade_state_store.states)
+    trade_count = len(trades_snapshot.trades) + len(trades_snapshot.previous)
+    sample_trade = next(iter(trades_snapshot.trades.values()), None) or next(iter(trades_snapshot.previous.values()), None)
+    if sample_trade is not None:
+        size += trade_count * approximate_size(sample_trade)
+    sample_state = next(iter(trade_state_store.states.items()), None)
+    if sample_state is not None:
+        size += len(trade_state_store.states) * (approximate_size(sample_state[0]) + approximate_size(sample_state[1]))
+    return size
+
+# Prints socket usage and retained state of one account
+def report_account_usage(stats: AccountStats, trades_snapshot: TradesSnapshot, trade_state_store: TradeStateStore, sent_offer_cache: SentOfferCache):
+    retained_bytes = estimate_trade_state_size(trades_snapshot, trade_state_store)
+    print(f"Account {stats.name}: CSFloat {stats.requests} requests, {stats.connections_created} new connections, {stats.connections_reused} reused; "
+          f"trade state ~{retained_bytes / 1024:.1f} KiB; "
+          f"{len(sent_offer_cache.offers)} sent offers cached, {sent_offer_cache.page_count} pages fetched")
+
+# Record and replay of check cycles. Every CSFloat request and Steam client call of a recorded cycle is saved in order
+# to a gzipped JSON lines archive with credentials redacted, CSFloat-Replay.py feeds the archive back to check_actionable_trades.
+RECORD_FORMAT_VERSION = 1
+RECORD_REDACTED = "REDACTED"
+RECORD_REDACTED_KEYS = {"trade_token", "trade_url", "token", "nonce", "email", "api_key", "access_token", "refresh_token", "password", "shared_secret", "identity_secret", "steam_login"}
+RECORD_HEADERS = ("Content-Type", "Retry-After")
+# Outbox entries younger than this are saved with a recorded cycle, older finished ones can't affect it
+RECORD_OUTBOX_SECONDS = 8 * 86400
+
+def redact(data):
+    if isinstance(data, dict):
+        return {key: (RECORD_REDACTED if key in RECORD_REDACTED_KEYS and value else redact(value)) for key, value in data.items()}
+    if isinstance(data, list):
+        return [redact(item) for item in data]
+    return data
+
+def redact_body(body: bytes) -> str:
+    text = body.decode("utf-8", errors="replace")
+    try:
+        return json.dumps(redact(json.loads(text)), ensure_ascii=False, separators=(",", ":"))
+    except ValueError:
+        return text
+
+def to_timestamp(value):
+    return value.timestamp() if isinstance(value, datetime) else value
+
+def from_timestamp(value):
+    return datetime.fromtimestamp(value, timezone.utc) if isinstance(value, (int, float)) else value
+
+# Steam objects as replayed, only the fields the bot reads
+@dataclass
+class ReplayItem:
+    asset_id: int
+    market_hash_name: str | None = None
+
+@dataclass
+class ReplayTradeOffer:
+    trade_offer_id: int
+    partner_id: int
+    status: TradeOfferStatus
+    items_to_give: list[ReplayItem]
+    time_created: datetime | None = None
+    time_updated: datetime | None = None
+
+@dataclass
+class ReplayConfirmation:
+    id: int
+    nonce: str
+    creator_id: int
+    type: ConfirmationType
+
+def dump_item(item) -> dict:
+    return {"asset_id": item.asset_id, "market_hash_name": getattr(getattr(item, "description", None), "market_hash_name", None) or getattr(item, "market_hash_name", None)}
+
+def dump_trade_offer(offer) -> dict:
+    return {"trade_offer_id": offer.trade_offer_id, "partner_id": offer.partner_id, "status": offer.status.value, "items_to_give": [dump_item(item) for item in offer.items_to_give],
+            "time_created": to_timestamp(getattr(offer, "time_created", None)), "time_updated": to_timestamp(getattr(offer, "time_updated", None))}
+
+def load_trade_offer(data: dict) -> ReplayTradeOffer:
+    return ReplayTradeOffer(data["trade_offer_id"], data["partner_id"], TradeOfferStatus(data["status"]), [ReplayItem(**item) for item in data["items_to_give"]],
+                            from_timestamp(data.get("time_created")), from_timestamp(data.get("time_updated")))
+
+def dump_confirmation(confirmation) -> dict:
+    return {"id": confirmation.id, "nonce": RECORD_REDACTED, "creator_id": confirmation.creator_id, "type": confirmation.type.value}
+
+def load_confirmation(data: dict) -> ReplayConfirmation:
+    return ReplayConfirmation(data["id"], data["nonce"], data["creator_id"], ConfirmationType(data["type"]))
+
+def dump_error(err: Exception) -> dict:
+    return {"type": type(err).__name__, "message": str(err), "status": getattr(err, "status", None), "headers": {name: err.headers[name] for name in RECORD_HEADERS if getattr(err, "headers", None) and name in err.headers}}
+
+# Error raised during replay in place of a recorded one
+class ReplayedError(Exception):
+    pass
+
+# Raised when the replayed cycle makes a call the recording has no answer for
+class ReplayMismatch(Exception):
+    pass
+
+def load_error(data: dict, url: str = "replay://steam", method: str = "GET") -> Exception:
+    if data.get("status"):
+        request_info = aiohttp.RequestInfo(URL(url), method, CIMultiDictProxy(CIMultiDict()), URL(url))
+        return aiohttp.ClientResponseError(request_info, (), status=data["status"], message=data["message"], headers=CIMultiDictProxy(CIMultiDict(data.get("headers") or {})))
+    return ReplayedError(f"{data['type']}: {data['message']}")
+
+# A CSFloat response read in full, returned both while recording and while replaying
+class RecordedResponse:
+    def __init__(self, method: str, url: str, status: int, headers: dict, body: bytes):
+        self.method = method
+        self.url = url
+        self.status = status
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self.body = body
+        self.content = self
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            request_info = aiohttp.RequestInfo(URL(self.url), self.method, CIMultiDictProxy(CIMultiDict()), URL(self.url))
+            raise aiohttp.ClientResponseError(request_info, (), status=self.status, message=self.body.decode("utf-8", errors="replace")[:200], headers=self.headers)
+
+    async def iter_chunked(self, chunk_size: int):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self) -> str:
+        return self.body.decode("utf-8")
+
+    async def json(self, **kwargs):
+        return json.loads(self.body)
+
+# Collects the calls of one check cycle and writes them to record_dir
+class CycleRecorder:
+    def __init__(self, record_dir: Path, account_name: str | None = None, max_files: int = 20):
+        self.record_dir = record_dir
+        self.account_name = account_name
+        self.max_files = max_files
+        self.entries: list[dict] | None = None
+        self.header: dict = {}
+
+    @property
+    def active(self) -> bool:
+        return self.entries is not None
+
+    def begin(self, my_steam_id: int, user_info: dict | None, settings: dict, outbox: dict | None = None, sent_offers: dict | None = None, missing_assets: dict | None = None):
+        self.entries = []
+        self.header = {"version": RECORD_FORMAT_VERSION, "recorded_at": datetime.now(timezone.utc).isoformat(), "my_steam_id": my_steam_id,
+                       "user_info": redact(user_info) if user_info is not None else None, "settings": settings, "outbox": outbox, "sent_offers": sent_offers,
+                       "missing_assets": missing_assets}
+
+    def record(self, entry: dict):
+        if self.entries is not None:
+            entry["seq"] = len(self.entries)
+            self.entries.append(entry)
+
+    def save(self) -> Path | None:
+        if self.entries is None:
+            return None
+        entries, self.entries = self.entries, None
+        self.record_dir.mkdir(parents=True, exist_ok=True)
+        prefix = f"cycle_{self.account_name}_" if self.account_name else "cycle_"
+        path = self.record_dir / f"{prefix}{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')}.jsonl.gz"
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(self.header, separators=(",", ":")) + "\n")
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        for old_path in sorted(self.record_dir.glob(f"{prefix}*.jsonl.gz"))[:-self.max_files or None]:
+            old_path.unlink(missing_ok=True)
+        print(f"Recorded the check cycle to {path} ({len(entries)} calls).")
+        return path
+
+class RecordingRequest:
+    def __init__(self, recorder: CycleRecorder, method: str, url: str, payload, request_context):
+        self.recorder = recorder
+        self.method = method
+        self.url = url
+        self.payload = payload
+        self.request_context = request_context
+
+    async def __aenter__(self):
+        entry = {"kind": "csfloat", "method": self.method, "url": self.url, "json": redact(self.payload)}
+        started_at = time.perf_counter()
+        try:
+            response = await self.request_context.__aenter__()
+            body = await response.read()
+        except Exception as err:
+            self.recorder.record({**entry, "error": dump_error(err), "elapsed": time.perf_counter() - started_at})
+            raise
+        headers = {name: response.headers[name] for name in RECORD_HEADERS if name in response.headers}
+        self.recorder.record({**entry, "status": response.status, "headers": headers, "body": redact_body(body), "elapsed": time.perf_counter() - started_at})
+        return RecordedResponse(self.method, self.url, response.status, headers, body)
+
+    async def __aexit__(self, *exc_info):
+        return await self.request_context.__aexit__(*exc_info)
+
+# CSFloat session that records requests while a cycle is being recorded and passes them through otherwise
+class RecordingSession:
+    def __init__(self, session, recorder: CycleRecorder):
+        self.session = session
+        self.recorder = recorder
+
+    def get(self, url, **kwargs):
+        if not self.recorder.active:
+            return self.session.get(url, **kwargs)
+        return RecordingRequest(self.recorder, "GET", url, None, self.session.get(url, **kwargs))
+
+    def post(self, url, **kwargs):
+        if not self.recorder.active:
+            return self.session.post(url, **kwargs)
+        return RecordingRequest(self.recorder, "POST", url, kwargs.get("json"), self.session.post(url, **kwargs))
+
+# Steam client calls of the bot with their arguments and results in replayable form
+STEAM_RECORDED_CALLS = {
+    "get_inventory": lambda result: {"items": [dump_item(item) for item in result[0]], "total": result[1], "last_asset_id": result[2]},
+    "make_trade_offer": lambda result: result,
+    "get_trade_offers": lambda result: {"sent": [dump_trade_offer(offer) for offer in result[0]], "received": [dump_trade_offer(offer) for offer in result[1]], "cursor": result[2]},
+    "get_trade_offer": dump_trade_offer,
+    "get_confirmations": lambda result: [dump_confirmation(confirmation) for confirmation in result],
+    "allow_multiple_confirmations": lambda result: None,
+    "confirm_trade_offer": lambda result: None,
+}
+
+def steam_call_key(name: str, args: tuple, kwargs: dict) -> str | None:
+    if name == "make_trade_offer":
+        return ",".join(str(asset_id) for asset_id in sorted(item.asset_id for item in kwargs.get("to_give", ())))
+    if name in ("get_trade_offer", "confirm_trade_offer") and args:
+        return str(args[0])
+    return None
+
+def dump_steam_args(name: str, args: tuple, kwargs: dict) -> dict:
+    if name == "make_trade_offer":
+        partner = args[0] if args else None
+        return {"partner": RECORD_REDACTED if isinstance(partner, str) else partner, "to_give": [item.asset_id for item in kwargs.get("to_give", ())], "message": kwargs.get("message")}
+    if name == "allow_multiple_confirmations":
+        return {"creator_ids": [confirmation.creator_id for confirmation in args[0]]}
+    return redact({key: value for key, value in kwargs.items() if isinstance(value, (str, int, float, bool, type(None)))} | {"args": [arg for arg in args if isinstance(arg, (str, int))]})
+
+class RecordingSteamClient:
+    def __init__(self, client, recorder: CycleRecorder):
+        self.client = client
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in STEAM_RECORDED_CALLS:
+            return attribute
+        async def recorded_call(*args, **kwargs):
+            if not self.recorder.active:
+                return await attribute(*args, **kwargs)
+            entry = {"kind": "steam", "call": name, "key": steam_call_key(name, args, kwargs), "args": dump_steam_args(name, args, kwargs)}
+            started_at = time.perf_counter()
+            try:
+                result = await attribute(*args, **kwargs)
+            except Exception as err:
+                self.recorder.record({**entry, "error": dump_error(err), "elapsed": time.perf_counter() - started_at})
+                raise
+            self.recorder.record({**entry, "result": STEAM_RECORDED_CALLS[name](result), "elapsed": time.perf_counter() - started_at})
+            return result
+        return recorded_call
+
+def load_recording(path: Path) -> tuple[dict, list[dict]]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != RECORD_FORMAT_VERSION:
+            raise ValueError(f"Unsupported recording version: {header.get('version')}")
+        return header, [json.loads(line) for line in f if line.strip()]
+
+def replay_request_key(method: str, url: str, payload) -> tuple:
+    return ("csfloat", method, URL(url).path_qs, json.dumps(redact(payload), sort_keys=True) if payload is not None else None)
+
+# Answers the calls of a replayed cycle from a recording. Calls are matched by path and body (and items or offer id for Steam)
+# in recorded order, so concurrent offers and accept chunks get their own answers whatever order they run in.
+class ReplayLog:
+    def __init__(self, entries: list[dict]):
+        self.queues: dict[tuple, list[dict]] = {}
+        for entry in entries:
+            if entry["kind"] == "csfloat":
+                key = replay_request_key(entry["method"], entry["url"], entry.get("json"))
+            else:
+                key = ("steam", entry["call"], entry.get("key"))
+            self.queues.setdefault(key, []).append(entry)
+        self.unmatched: list[tuple] = []
+
+    def take(self, key: tuple) -> dict:
+        entries = self.queues.get(key)
+        if not entries:
+            self.unmatched.append(key)
+            raise ReplayMismatch(f"No recorded answer for {key}")
+        return entries.pop(0)
+
+    def remaining(self) -> int:
+        return sum(len(entries) for entries in self.queues.values())
+
+class ReplayRequest:
+    def __init__(self, replay_log: ReplayLog, method: str, url: str, payload=None):
+        self.replay_log = replay_log
+        self.method = method
+        self.url = url
+        self.payload = payload
+
+    async def __aenter__(self):
+        entry = self.replay_log.take(replay_request_key(self.method, self.url, self.payload))
+        if "error" in entry:
+            raise load_error(entry["error"], self.url, self.method)
+        return RecordedResponse(self.method, self.url, entry["status"], entry.get("headers") or {}, entry["body"].encode("utf-8"))
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+class ReplaySession:
+    def __init__(self, replay_log: ReplayLog):
+        self.replay_log = replay_log
+
+    def get(self, url, **kwargs):
+        return ReplayRequest(self.replay_log, "GET", url)
+
+    def post(self, url, **kwargs):
+        return ReplayRequest(self.replay_log, "POST", url, kwargs.get("json"))
+
+class ReplaySteamClient:
+    def __init__(self, replay_log: ReplayLog, steam_id: int):
+        self.replay_log = replay_log
+        self.steam_id = steam_id
+
+    async def replay(self, name: str, *args, **kwargs):
+        entry = self.replay_log.take(("steam", name, steam_call_key(name, args, kwargs)))
+        if "error" in entry:
+            raise load_error(entry["error"])
+        return entry["result"]
+
+    async def get_inventory(self, *args, **kwargs):
+        result = await self.replay("get_inventory", *args, **kwargs)
+        return [ReplayItem(**item) for item in result["items"]], result["total"], result["last_asset_id"]
+
+    async def make_trade_offer(self, *args, **kwargs):
+        return await self.replay("make_trade_offer", *args, **kwargs)
+
+    async def get_trade_offers(self, *args, **kwargs):
+        result = await self.replay("get_trade_offers", *args, **kwargs)
+        return [load_trade_offer(offer) for offer in result["sent"]], [load_trade_offer(offer) for offer in result["received"]], result["cursor"]
+
+    async def get_trade_offer(self, *args, **kwargs):
+        return load_trade_offer(await self.replay("get_trade_offer", *args, **kwargs))
+
+    async def get_confirmations(self, *args, **kwargs):
+        return [load_confirmation(confirmation) for confirmation in await self.replay("get_confirmations", *args, **kwargs)]
+
+    async def allow_multiple_confirmations(self, *args, **kwargs):
+        await self.replay("allow_multiple_confirmations", *args, **kwargs)
+
+    async def confirm_trade_offer(self, *args, **kwargs):
+        await self.replay("confirm_trade_offer", *args, **kwargs)
+
 def any2bool(v):
   return str(v).lower() in ("yes", "true", "t", "1")
 def readConfigValue(configJson,jsonKey):
@@ -646,119 +2666,810 @@ def readConfigValue(configJson,jsonKey):
         print(f"Couldn't load the item from the config file: {jsonKey}")
     else:
         return jsonValue
-async def main():
-    config = load_steam_config()  # Загрузка конфигурации
+DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36 Edg/136.0.0.0"
 
-    csfloat_api_key = config['csfloat_api_key']
-    steam_api_key = config.get('steam_api_key')
-    steam_id = int(config['steam_id64'])  # Убедитесь, что это целое число
-    steam_login = config['steam_login']
-    steam_password = config['steam_password']
-    shared_secret = config['shared_secret']
-    identity_secret = config['identity_secret']
+# Scheduling, rate limit and concurrency settings of one account. They are read again on every config reload and apply
+# from the next check on, without a new Steam login.
+@dataclass
+class AccountSettings:
+    check_interval_seconds: float | int = 600
+    check_interval_seconds_random: bool = False
+    check_interval_seconds_random_min: float | int | None = None
+    check_interval_seconds_random_max: float | int | None = None
+    offer_group_by: str = OFFER_GROUP_BY_BUYER_ITEM
+    dispatch_concurrency: int = 4
+    accept_chunk_size: int = ACCEPT_CHUNK_SIZE
+    accept_concurrency: int = ACCEPT_CONCURRENCY
+    dispatch_budget_seconds: float | int = OFFER_DISPATCH_BUDGET_SECONDS
+    missing_asset_recheck_seconds: float | int = MISSING_ASSET_RECHECK_SECONDS
+    csfloat_requests_per_second: float | int = 2
+    steam_requests_per_second: float | int = 1
+    inventory_cache_ttl_seconds: float | int = 120
+    scheduler_mode: str = SCHEDULER_MODE_FIXED
+    adaptive_poll_min_seconds: float | int = 15
+    adaptive_poll_max_seconds: float | int = 300
+    adaptive_poll_backoff_factor: float | int = 2
+
+    def next_check_interval(self) -> float | int:
+        check_interval_seconds = self.check_interval_seconds
+        if self.check_interval_seconds_random:
+            check_interval_seconds=round(random.uniform(self.check_interval_seconds_random_min, self.check_interval_seconds_random_max),4)
+        if check_interval_seconds<300:
+            check_interval_seconds=300
+            print("Minimum check interval is 300 seconds. Setting 'check_interval_seconds' to 300.")
+        return check_interval_seconds
+
+    def changed(self, other: "AccountSettings") -> list[str]:
+        return [settings_field.name for settings_field in fields(self) if getattr(self, settings_field.name) != getattr(other, settings_field.name)]
+
+def load_account_settings(config: dict) -> AccountSettings:
+    settings = AccountSettings()
+    # Определение продолжительности ожидания (в минутах)
+    settings.check_interval_seconds_random = any2bool(config.get('check_interval_seconds_random'))
+    if settings.check_interval_seconds_random:
+        settings.check_interval_seconds_random_min=config.get('check_interval_seconds_random_min') # converting to 'decimal.Decimal' causes the problem.
+        settings.check_interval_seconds_random_max=config.get('check_interval_seconds_random_max')
+        if not settings.check_interval_seconds_random_min or not settings.check_interval_seconds_random_max:
+            settings.check_interval_seconds_random=False
+            print("Error: Value invalid of \"check_interval_seconds_random_min\" or \"check_interval_seconds_random_max\". Restoring default check interval value.")
+        elif settings.check_interval_seconds_random_min>settings.check_interval_seconds_random_max:
+            settings.check_interval_seconds_random=False
+            print("Error: \"check_interval_seconds_random_min\" is greater than \"check_interval_seconds_random_max\". Restoring default check interval value.")
+    settings.check_interval_seconds=config.get('check_interval_seconds') or 600  # Вы можете легко изменить это значение
+    settings.offer_group_by=config.get('offer_group_by')
+    if settings.offer_group_by not in (OFFER_GROUP_BY_BUYER_ITEM, OFFER_GROUP_BY_BUYER):
+        settings.offer_group_by = OFFER_GROUP_BY_BUYER_ITEM
+    settings.dispatch_concurrency=config.get('dispatch_concurrency') or 4
+    settings.accept_chunk_size=config.get('accept_chunk_size') or ACCEPT_CHUNK_SIZE
+    settings.accept_concurrency=config.get('accept_concurrency') or ACCEPT_CONCURRENCY
+    if config.get('dispatch_budget_seconds') is not None:
+        settings.dispatch_budget_seconds = config['dispatch_budget_seconds']
+    settings.missing_asset_recheck_seconds=config.get('missing_asset_recheck_seconds') or MISSING_ASSET_RECHECK_SECONDS
+    if config.get('csfloat_requests_per_second') is not None:
+        settings.csfloat_requests_per_second = config['csfloat_requests_per_second']
+    if config.get('steam_requests_per_second') is not None:
+        settings.steam_requests_per_second = config['steam_requests_per_second']
+    settings.inventory_cache_ttl_seconds=config.get('inventory_cache_ttl_seconds') or 120
+    settings.scheduler_mode=config.get('scheduler_mode')
+    if settings.scheduler_mode not in (SCHEDULER_MODE_FIXED, SCHEDULER_MODE_ADAPTIVE):
+        settings.scheduler_mode = SCHEDULER_MODE_FIXED
+    settings.adaptive_poll_min_seconds=config.get('adaptive_poll_min_seconds') or 15
+    if settings.adaptive_poll_min_seconds<5:
+        settings.adaptive_poll_min_seconds=5
+        print("Minimum adaptive poll interval is 5 seconds. Setting 'adaptive_poll_min_seconds' to 5.")
+    settings.adaptive_poll_max_seconds=config.get('adaptive_poll_max_seconds')
+    if not settings.adaptive_poll_max_seconds or settings.adaptive_poll_max_seconds<settings.adaptive_poll_min_seconds:
+        settings.adaptive_poll_max_seconds = max(300, settings.adaptive_poll_min_seconds)
+    settings.adaptive_poll_backoff_factor=config.get('adaptive_poll_backoff_factor')
+    if not settings.adaptive_poll_backoff_factor or settings.adaptive_poll_backoff_factor<1:
+        settings.adaptive_poll_backoff_factor = 2
+    if settings.scheduler_mode == SCHEDULER_MODE_ADAPTIVE:
+        print(f"Adaptive scheduler: polling every {settings.adaptive_poll_min_seconds}-{settings.adaptive_poll_max_seconds} seconds.")
+    return settings
+
+CONFIG_REQUIRED_KEYS = ('csfloat_api_key', 'steam_id64', 'steam_login', 'steam_password', 'shared_secret', 'identity_secret')
+CONFIG_NUMBER_KEYS = (
+    'check_interval_seconds', 'check_interval_seconds_random_min', 'check_interval_seconds_random_max', 'dispatch_concurrency',
+    'accept_chunk_size', 'accept_concurrency', 'dispatch_budget_seconds', 'missing_asset_recheck_seconds', 'csfloat_requests_per_second',
+    'steam_requests_per_second', 'inventory_cache_ttl_seconds', 'adaptive_poll_min_seconds', 'adaptive_poll_max_seconds',
+    'adaptive_poll_backoff_factor', 'single_flight_fresh_seconds', 'config_watch_seconds', 'http_timeout_seconds', 'http_keepalive_seconds',
+)
+# Changing these needs a new Steam client and login (cookies are kept when only the proxy, user agent or API key change)
+STEAM_CLIENT_CONFIG_KEYS = ('client_proxy', 'steam_use_proxy', 'user_agent', 'steam_api_key', 'steam_login', 'steam_password', 'shared_secret', 'identity_secret')
+STEAM_LOGIN_CONFIG_KEYS = ('steam_login', 'steam_password', 'shared_secret')
+# Changing these only takes effect after a restart
+ACCOUNT_RESTART_CONFIG_KEYS = ('steam_id64', 'record_dir', 'record_max_files')
+PROCESS_RESTART_CONFIG_KEYS = ('worker_processes', 'metrics_port', 'metrics_host', 'control_port', 'control_host', 'control_socket', 'control_token', 'http_timeout_seconds', 'http_keepalive_seconds', 'http_warm_up')
+
+# Problems that make a config unusable, a reload with any of them is rejected and the running config is kept
+def validate_config(config) -> list[str]:
+    if not isinstance(config, dict):
+        return ["the config is not a JSON object"]
+    errors = []
+    accounts = config.get('accounts')
+    if accounts is not None and (not isinstance(accounts, list) or not all(isinstance(account, dict) for account in accounts)):
+        return ["\"accounts\" must be a list of objects"]
+    for position, account_config in enumerate(load_account_configs(config)):
+        where = f" of account {account_config.get('account_name') or position + 1}" if accounts else ""
+        errors += [f"\"{key}\"{where} is missing" for key in CONFIG_REQUIRED_KEYS if not account_config.get(key)]
+        for key in CONFIG_NUMBER_KEYS:
+            value = account_config.get(key)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                errors.append(f"\"{key}\"{where} must be a number not less than 0")
+    return errors
+
+def steam_proxy_from_config(config: dict) -> str | None:
     client_proxy = readConfigValue(config,'client_proxy')
     steam_use_proxy = any2bool(readConfigValue(config,'steam_use_proxy')) # Acceptable true value: "yes", "true", "t", "y", "1"
+    return client_proxy if client_proxy and steam_use_proxy else None
+
+# Builds the Steam client of an account and restores its session from cookies, or logs in.
+# Returns the client and whether its session still has to be verified (see LazySteamClient).
+async def start_steam_client(config: dict, cookies: JSONABLE_COOKIE_JAR | None = None, fast_start: bool = True) -> tuple[SteamClient, bool]:
+    client_proxy = readConfigValue(config,'client_proxy')
     if client_proxy:
         print(f"proxy true: {client_proxy}")
-    # Определение продолжительности ожидания (в минутах)
-    check_interval_seconds_random = any2bool(config.get('check_interval_seconds_random'))
-    if check_interval_seconds_random:
-        check_interval_seconds_random_min=config.get('check_interval_seconds_random_min') # converting to 'decimal.Decimal' causes the problem.
-        check_interval_seconds_random_max=config.get('check_interval_seconds_random_max')
-        if not check_interval_seconds_random_min or not check_interval_seconds_random_max:
-            check_interval_seconds_random=False
-            print("Error: Value invalid of \"check_interval_seconds_random_min\" or \"check_interval_seconds_random_max\". Restoring default check interval value.")
-        elif check_interval_seconds_random_min>check_interval_seconds_random_max:
-            check_interval_seconds_random=False
-            print("Error: \"check_interval_seconds_random_min\" is greater than \"check_interval_seconds_random_max\". Restoring default check interval value.")
-    # check_interval_seconds=Decimal(config.get('check_interval_seconds'))
-    check_interval_seconds=config.get('check_interval_seconds')
-    if not check_interval_seconds:
-        check_interval_seconds = 600  # Вы можете легко изменить это значение
     # print(steam_use_proxy)
-    user_agent=config.get('user_agent')
-    if not user_agent:
-        user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36 Edg/136.0.0.0"
+    user_agent=config.get('user_agent') or DEFAULT_USER_AGENT
     print(f"User agent: {user_agent}")
-    # breakpoint()
+    steam_proxy = steam_proxy_from_config(config)
     client = SteamClient(
-        steam_id=steam_id,              # Steam ID64 как целое число
-        username=steam_login,
-        password=steam_password,
-        shared_secret=shared_secret,
-        identity_secret=identity_secret,
-        api_key=steam_api_key,          # Передача API ключа
-        user_agent=user_agent
+        steam_id=int(config['steam_id64']),  # Steam ID64 как целое число
+        username=config['steam_login'],
+        password=config['steam_password'],
+        shared_secret=config['shared_secret'],
+        identity_secret=config['identity_secret'],
+        api_key=config.get('steam_api_key'),  # Передача API ключа
+        user_agent=user_agent,
+        session=http_transport.session(steam_proxy, raise_for_status=True)  # Steam requests share the connection pools of the process
     )
-    if client_proxy and steam_use_proxy:
-        # client.api_key=steam_api_key
-        # client.proxy=client_proxy
-        client = SteamClient(
-            steam_id=steam_id,              # Steam ID64 как целое число
-            username=steam_login,
-            password=steam_password,
-            shared_secret=shared_secret,
-            identity_secret=identity_secret,
-            api_key=steam_api_key,          # Передача API ключа
-            user_agent=user_agent,
-            proxy=client_proxy
-        )
-        print("steam proxy true")
-        # print(client.user_agent)
-        # print(client.proxy)
-    else:
-        print("steam proxy false")
+    print(f"steam proxy {'true' if steam_proxy else 'false'}")
     # Восстановление cookies, если они существуют
+    if cookies is None:
+        await steam_client_login_retry(client)
+        return client, False
+    try:
+        return client, await restore_steam_session(cookies, client, fast_start)
+    except Exception as err:
+        print(f"{err}")
+        await steam_client_login_retry(client)
+        return client, False
 
+def steam_session_fast_start_from_config(config: dict) -> bool:
+    steam_session_fast_start = config.get('steam_session_fast_start')
+    return True if steam_session_fast_start is None else any2bool(steam_session_fast_start)
 
-    if COOKIE_FILE.is_file():
+# Runs the scheduler of one account on the shared CSFloat session. account_name is None in single-account mode.
+# on_check(account name, check seconds, trades tracked) is called after every check.
+async def run_account(config: dict, shared_session: aiohttp.ClientSession, account_name: str | None = None, on_check=None):
+    if account_name:
+        current_account.set(account_name)
+    csfloat_api_key = config['csfloat_api_key']
+    steam_id = int(config['steam_id64'])  # Убедитесь, что это целое число
+    cookie_file = account_file(COOKIE_FILE, account_name)
+    settings = load_account_settings(config)
+    check_interval_seconds = settings.next_check_interval()
+    rate_limiters = {
+        SERVICE_CSFLOAT: TokenBucket(settings.csfloat_requests_per_second),
+        SERVICE_STEAM: TokenBucket(settings.steam_requests_per_second),
+    }
+    # breakpoint()
+    startup_started_at = time.perf_counter()
+    cookies = None
+    if cookie_file.is_file():
         try:
-            with COOKIE_FILE.open("r") as f:
+            with cookie_file.open("r") as f:
                 cookies = json.load(f)
-            await restore_from_cookies_retry(cookies, client)
         except Exception as err:
             print(f"{err}")
-            await steam_client_login_retry(client)
-    else:
-        await steam_client_login_retry(client)
+    client, steam_session_unverified = await start_steam_client(config, cookies, steam_session_fast_start_from_config(config))
+    print(f"Steam session ready in {time.perf_counter() - startup_started_at:.2f}s.")
 
     # Загрузка обработанных трейдов
-    processed_trades = load_processed_trades()
+    trade_state_store = TradeStateStore(account_file(TRADE_STATE_FILE, account_name))
+    trade_state_store.import_processed_trades(account_file(PROCESSED_TRADES_FILE, account_name))
 
-    sessionConnector = ProxyConnector.from_url(client_proxy, ttl_dns_cache=300) if client_proxy else aiohttp.TCPConnector(
-        resolver=aiohttp.resolver.AsyncResolver(),
-        limit_per_host=50
-    )
-    async with aiohttp.ClientSession(connector=sessionConnector) as session:
+    account_stats = AccountStats(account_name or config['steam_login'])
+    account_session = AccountSession(shared_session, account_stats)
+    session = account_session
+    record_dir = config.get('record_dir')
+    cycle_recorder = None
+    if record_dir:
+        record_max_files = config.get('record_max_files') or 20
+        cycle_recorder = CycleRecorder(Path(record_dir), account_name, record_max_files)
+        session = RecordingSession(session, cycle_recorder)
+        print(f"Recording check cycles to {record_dir}.")
+    def make_check_client(client, unverified: bool):
+        check_client = SingleFlightSteamClient(LazySteamClient(client) if unverified else client)
+        if cycle_recorder is not None:
+            check_client = RecordingSteamClient(check_client, cycle_recorder)
+        return check_client
+    check_client = make_check_client(client, steam_session_unverified)
+    trades_snapshot = TradesSnapshot(session, csfloat_api_key, steam_id, rate_limiters[SERVICE_CSFLOAT])
+    sent_offer_cache = SentOfferCache(check_client, rate_limiters[SERVICE_STEAM])
+    missing_asset_cache = MissingAssetCache(settings.missing_asset_recheck_seconds)
+    controller = CheckController(account_stats.name)
+    controller.trades_snapshot = trades_snapshot
+    controller.trade_state_store = trade_state_store
+    controller.missing_asset_cache = missing_asset_cache
+    scheduler = AdaptivePollScheduler(settings.adaptive_poll_min_seconds, settings.adaptive_poll_max_seconds, settings.adaptive_poll_backoff_factor, max(300, settings.check_interval_seconds))
+    steam_config = config
+    steam_client_outdated = False
+
+    # Applies a reloaded account config. Settings take effect at once, a new Steam client is built before the next check.
+    def reconfigure(new_config: dict, new_shared_session: aiohttp.ClientSession | None = None):
+        nonlocal config, csfloat_api_key, settings, check_interval_seconds, scheduler, steam_client_outdated
+        restart_keys = [key for key in ACCOUNT_RESTART_CONFIG_KEYS if new_config.get(key) != config.get(key)]
+        if restart_keys:
+            print(f"Changed {', '.join(restart_keys)} of account {account_stats.name} take effect after a restart.")
+        new_settings = load_account_settings(new_config)
+        changed = new_settings.changed(settings)
+        settings = new_settings
+        rate_limiters[SERVICE_CSFLOAT].set_rate(settings.csfloat_requests_per_second)
+        rate_limiters[SERVICE_STEAM].set_rate(settings.steam_requests_per_second)
+        missing_asset_cache.recheck_seconds = settings.missing_asset_recheck_seconds
+        if new_config['csfloat_api_key'] != csfloat_api_key:
+            csfloat_api_key = trades_snapshot.csfloat_api_key = new_config['csfloat_api_key']
+            changed.append('csfloat_api_key')
+        if new_shared_session is not None:
+            account_session.session = new_shared_session
+            changed.append('CSFloat session')
+        steam_client_outdated = any(new_config.get(key) != steam_config.get(key) for key in STEAM_CLIENT_CONFIG_KEYS)
+        config = new_config
+        if any(name.startswith(('check_interval', 'adaptive_poll', 'scheduler_mode')) for name in changed):
+            check_interval_seconds = settings.next_check_interval()
+            scheduler = AdaptivePollScheduler(settings.adaptive_poll_min_seconds, settings.adaptive_poll_max_seconds, settings.adaptive_poll_backoff_factor, max(300, settings.check_interval_seconds))
+            controller.wake()
+        if changed or steam_client_outdated:
+            print(f"Account {account_stats.name}: applied {', '.join(changed) or 'no setting changes'}{', the Steam client is rebuilt before the next check' if steam_client_outdated else ''}.")
+    controller.reconfigure = reconfigure
+    check_controllers[controller.name] = controller
+
+    # The old client keeps working if the new one cannot log in, the rebuild is tried again before the next check.
+    # Kept cookies are restored like at startup: with steam_session_fast_start the session is verified on first use.
+    async def rebuild_steam_client():
+        nonlocal client, check_client, steam_config, steam_client_outdated
+        print(f"Rebuilding the Steam client of account {account_stats.name}.")
+        new_config = config
+        keep_cookies = all(new_config.get(key) == steam_config.get(key) for key in STEAM_LOGIN_CONFIG_KEYS)
         try:
-            while True:
-                if check_interval_seconds_random:
-                    # print(f"check_interval_seconds: {type(check_interval_seconds_random_min)}")
-                    # print(f"check_interval_seconds: {type(check_interval_seconds_random_max)}")
-                    # breakpoint()
-                    check_interval_seconds=round(random.uniform(check_interval_seconds_random_min, check_interval_seconds_random_max),4)
-                # print(f"check_interval_seconds: {check_interval_seconds} {type(check_interval_seconds)}")
-                if check_interval_seconds<300:
-                    check_interval_seconds=300
-                    print("Minimum check interval is 300 seconds. Setting 'check_interval_seconds' to 300.")
+            new_client, unverified = await start_steam_client(new_config, get_jsonable_cookies(client.session) if keep_cookies else None, steam_session_fast_start_from_config(new_config))
+        except Exception as err:
+            print(f"Couldn't rebuild the Steam client, keeping the current one: {err}")
+            return
+        old_client = client
+        client, steam_config = new_client, new_config
+        steam_client_outdated = config is not new_config
+        check_client = make_check_client(client, unverified)
+        sent_offer_cache.client = check_client
+        single_flight.invalidate(steam_single_flight_scope(steam_id))
+        with cookie_file.open("w") as f:
+            json.dump(get_jsonable_cookies(client.session), f, indent=2)
+        await http_transport.close_session(old_client.session)
+
+    async def run_check(check_interval_seconds, user_info=None):
+        if steam_client_outdated:
+            await rebuild_steam_client()
+        # Steam is first needed after the CSFloat trades are fetched, its connection is opened meanwhile
+        http_transport.warm_up_soon(steam_proxy_from_config(steam_config), HTTP_WARM_UP_URLS[SERVICE_STEAM])
+        timings = StageTimings()
+        check_started_at = time.perf_counter()
+        if cycle_recorder is not None:
+            cycle_recorder.begin(steam_id, user_info, {"inventory_cache_ttl_seconds": settings.inventory_cache_ttl_seconds, "offer_group_by": settings.offer_group_by, "dispatch_concurrency": settings.dispatch_concurrency, "accept_chunk_size": settings.accept_chunk_size, "accept_concurrency": settings.accept_concurrency, "dispatch_budget_seconds": settings.dispatch_budget_seconds}, trade_state_store.outbox_snapshot(RECORD_OUTBOX_SECONDS), sent_offer_cache.snapshot(), missing_asset_cache.snapshot())
+        with controller.check():
+            try:
                 await check_actionable_trades(
                     session,
                     csfloat_api_key,
-                    client,
-                    shared_secret,
-                    identity_secret,
-                    processed_trades,           # Передача набора обработанных трейдов
+                    check_client,
+                    config['shared_secret'],
+                    config['identity_secret'],
+                    trade_state_store,           # Передача состояния обработанных трейдов
                     check_interval_seconds,      # Передача продолжительности ожидания
-                    my_steam_id=steam_id
+                    my_steam_id=steam_id,
+                    inventory_cache_ttl_seconds=settings.inventory_cache_ttl_seconds,
+                    offer_group_by=settings.offer_group_by,
+                    rate_limiters=rate_limiters,
+                    dispatch_concurrency=settings.dispatch_concurrency,
+                    timings=timings,
+                    user_info=user_info,
+                    trades_snapshot=trades_snapshot,
+                    accept_chunk_size=settings.accept_chunk_size,
+                    accept_concurrency=settings.accept_concurrency,
+                    sent_offer_cache=sent_offer_cache,
+                    dispatch_budget_seconds=settings.dispatch_budget_seconds,
+                    missing_asset_cache=missing_asset_cache
                 )
-                save_processed_trades(processed_trades)  # Сохранение после каждой проверки
-                await asyncio.sleep(check_interval_seconds)  # Ожидание заданное количество минут
+            finally:
+                if cycle_recorder is not None:
+                    cycle_recorder.save()
+        timings.report()
+        retry_engine.report()
+        # Per-account usage only tells the accounts apart in multi-account mode
+        if account_name is not None:
+            report_account_usage(account_stats, trades_snapshot, trade_state_store, sent_offer_cache)
+        http_transport.report()
+        metrics.observe("cycle_duration_seconds", time.perf_counter() - check_started_at, METRICS_CYCLE_BUCKETS)
+        if on_check is not None:
+            on_check(account_stats.name, time.perf_counter() - check_started_at, len(trades_snapshot.trades))
+
+    try:
+        # The scheduler mode and intervals can change on a config reload, so both modes share one loop.
+        # The fixed mode waits until check_interval_seconds after the last check, a reload wakes the wait up to recompute it.
+        checked_at = None
+        while True:
+            if settings.scheduler_mode == SCHEDULER_MODE_ADAPTIVE:
+                # While paused /me is not polled, only triggers from the control API run a check
+                if controller.paused and not controller.trigger_pending:
+                    await controller.wait(scheduler.max_seconds)
+                    continue
+                triggered = controller.take_trigger()
+                user_info = await get_user_info(session, csfloat_api_key, rate_limiters[SERVICE_CSFLOAT])
+                if scheduler.should_run_check(user_info) or triggered:
+                    await run_check(check_interval_seconds, user_info)
+                    scheduler.record_check()
+                await controller.wait(scheduler.next_interval(user_info))
+            else:
+                if controller.take_trigger() or (not controller.paused and (checked_at is None or time.monotonic() - checked_at >= check_interval_seconds)):
+                    await run_check(check_interval_seconds)
+                    checked_at = time.monotonic()
+                    check_interval_seconds = settings.next_check_interval()
+                remaining_seconds = check_interval_seconds - (time.monotonic() - checked_at) if checked_at is not None else check_interval_seconds
+                await controller.wait(remaining_seconds if remaining_seconds > 0 else check_interval_seconds)  # Ожидание заданное количество минут или запуска через control API
+    finally:
+        check_controllers.pop(controller.name, None)
+        # Сохранение cookies
+        with cookie_file.open("w") as f:
+            json.dump(get_jsonable_cookies(client.session), f, indent=2)
+
+        await http_transport.close_session(client.session)
+        trade_state_store.close()
+
+# CSFloat session shared by the accounts of one process
+def make_csfloat_session(config: dict) -> aiohttp.ClientSession:
+    return http_transport.session(config.get('client_proxy'))
+
+CONFIG_WATCH_SECONDS = 5
+CONFIG_SESSION_RETIRE_SECONDS = 60 # a replaced CSFloat session is closed this long after, requests already on it finish first
+
+# Prints the changes of a reloaded config that only take effect after a restart
+def report_restart_changes(old_config: dict, config: dict):
+    restart_keys = [key for key in PROCESS_RESTART_CONFIG_KEYS if config.get(key) != old_config.get(key)]
+    if restart_keys:
+        print(f"Config reload: changed {', '.join(restart_keys)} take effect after a restart.")
+    old_accounts, accounts = account_configs_by_name(old_config), account_configs_by_name(config)
+    if old_config.get('accounts') and config.get('accounts'):
+        changes = [f"{change} accounts {sorted(names)}" for change, names in (("added", accounts.keys() - old_accounts.keys()), ("removed", old_accounts.keys() - accounts.keys())) if names]
+        if changes:
+            print(f"Config reload: {' and '.join(changes)} take effect after a restart.")
+    elif bool(old_config.get('accounts')) != bool(config.get('accounts')):
+        print("Config reload: switching between single and multi-account mode takes effect after a restart.")
+
+# Watches steam.json and applies a changed, valid config to the accounts running in this process.
+# Steam sessions are kept, only accounts whose proxy or credentials changed get a new Steam client.
+class ConfigReloader:
+    def __init__(self, config: dict, session: aiohttp.ClientSession | None, config_path: Path = CONFIG_FILE):
+        self.config = config
+        self.session = session
+        self.config_path = config_path
+        self.modified_at = self.stat()
+        self.retire_tasks: set[asyncio.Task] = set()
+
+    def stat(self):
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    # The new config if steam.json changed and is valid, None otherwise
+    def read(self) -> dict | None:
+        modified_at = self.stat()
+        if modified_at is None or modified_at == self.modified_at:
+            return None
+        self.modified_at = modified_at
+        try:
+            config = load_steam_config(self.config_path)
+        except Exception as err:
+            print(f"Config reload: couldn't read {self.config_path}, keeping the running config: {err}")
+            return None
+        errors = validate_config(config)
+        if errors:
+            print(f"Config reload: {self.config_path} is invalid, keeping the running config: {'; '.join(errors)}.")
+            return None
+        if config == self.config:
+            return None
+        return config
+
+    async def retire_session(self, session: aiohttp.ClientSession):
+        try:
+            await asyncio.sleep(CONFIG_SESSION_RETIRE_SECONDS)
         finally:
-            # Сохранение cookies
-            with COOKIE_FILE.open("w") as f:
-                json.dump(get_jsonable_cookies(client.session), f, indent=2)
+            await http_transport.close_session(session)
+
+    def apply(self, config: dict, report: bool = True):
+        old_config, self.config = self.config, config
+        print(f"Config reload: applying the changed {self.config_path.name}.")
+        if report:
+            report_restart_changes(old_config, config)
+        retry_engine.apply_config(config.get('retry_policies'))
+        single_flight.apply_config(config.get('single_flight_fresh_seconds'))
+        new_session = None
+        if self.session is not None and config.get('client_proxy') != old_config.get('client_proxy'):
+            print("Config reload: the CSFloat proxy changed, opening a new CSFloat session.")
+            task = asyncio.create_task(self.retire_session(self.session))
+            self.retire_tasks.add(task)
+            task.add_done_callback(self.retire_tasks.discard)
+            self.session = new_session = make_csfloat_session(config)
+        if not config.get('accounts'):
+            # Single-account mode: the one controller is named after the login it started with
+            account_configs = {name: config for name in check_controllers}
+        else:
+            account_configs = account_configs_by_name(config)
+        for account_name, account_config in account_configs.items():
+            controller = check_controllers.get(account_name)
+            if controller is not None and controller.reconfigure is not None:
+                controller.reconfigure(account_config, new_session)
+
+    async def watch(self, interval: float | int):
+        while True:
+            await asyncio.sleep(interval)
+            config = self.read()
+            if config is not None:
+                self.apply(config)
 
-            await client.session.close()
+    async def close(self):
+        for task in list(self.retire_tasks):
+            task.cancel()
+        await asyncio.gather(*self.retire_tasks, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+# Supervisor <-> worker process messages. Commands: (command, account name, account config). Events: (event, worker index, pid, account name, data).
+WORKER_COMMAND_ADD = "add"
+WORKER_COMMAND_REMOVE = "remove"
+WORKER_COMMAND_STOP = "stop"
+WORKER_COMMAND_RELOAD = "reload" # (reload, None, the whole reloaded config)
+WORKER_EVENT_HEARTBEAT = "heartbeat"
+WORKER_EVENT_CHECK = "check"
+WORKER_EVENT_RELEASED = "released"
+WORKER_EVENT_ACCOUNT_CRASHED = "account_crashed" # data: error, restart delay; the worker restarts the account itself
+WORKER_HEARTBEAT_SECONDS = 10
+WORKER_HEARTBEAT_TIMEOUT_SECONDS = 120
+WORKER_RESTART_BASE_DELAY = 5
+WORKER_RESTART_MAX_DELAY = 300
+WORKER_STABLE_SECONDS = 600 # a worker (or an account inside it) running this long resets its restart backoff
+SUPERVISOR_REPORT_SECONDS = 60
+
+# Runs the accounts the supervisor assigns to this worker process in one event loop
+async def account_worker(worker_index: int, config: dict, command_queue, event_queue):
+    retry_engine.apply_config(config.get('retry_policies'))
+    single_flight.apply_config(config.get('single_flight_fresh_seconds'))
+    http_transport.apply_config(config)
+    metrics_runner = None
+    if config.get('metrics_port'):
+        metrics.enable()
+        metrics_runner = await start_metrics_server(config['metrics_port'] + worker_index, config.get('metrics_host') or "127.0.0.1")
+    control_runner = None
+    if config.get('control_port') or config.get('control_socket'):
+        control_socket = config.get('control_socket')
+        control_runner = await start_control_server(
+            config['control_port'] + worker_index if config.get('control_port') else None,
+            config.get('control_host') or "127.0.0.1",
+            f"{control_socket}.{worker_index}" if control_socket else None,
+            config.get('control_token')
+        )
+    pid = os.getpid()
+    loop = asyncio.get_running_loop()
+    account_tasks: dict[str, asyncio.Task] = {}
+    account_configs: dict[str, dict] = {} # accounts assigned to this worker, running or waiting for a restart
+    account_started_at: dict[str, float] = {}
+    account_failures_in_row: dict[str, int] = {}
+    account_restarts: dict[str, asyncio.TimerHandle] = {}
+    def get_command():
+        try:
+            return command_queue.get(timeout=1)
+        except queue.Empty:
+            return None
+    def on_check(account_name, check_seconds, trades_tracked):
+        event_queue.put((WORKER_EVENT_CHECK, worker_index, pid, account_name, {"seconds": check_seconds, "trades": trades_tracked}))
+    def start_account(account_name):
+        account_tasks[account_name] = asyncio.create_task(run_account(account_configs[account_name], reloader.session, account_name, on_check), name=account_name)
+        account_tasks[account_name].add_done_callback(on_account_done)
+        account_started_at[account_name] = time.monotonic()
+    def restart_account(account_name):
+        del account_restarts[account_name]
+        if account_name in account_configs and account_name not in account_tasks:
+            print(f"Worker {worker_index}: restarting account {account_name}.")
+            start_account(account_name)
+    # A crashed account leaves the running ones and is restarted with backoff, like a crashed worker
+    def on_account_done(task: asyncio.Task):
+        account_name = task.get_name()
+        if task.cancelled() or account_tasks.get(account_name) is not task:
+            return
+        del account_tasks[account_name]
+        error = task.exception() or "the account loop returned"
+        if time.monotonic() - account_started_at[account_name] >= WORKER_STABLE_SECONDS:
+            account_failures_in_row[account_name] = 0
+        failures_in_row = account_failures_in_row.get(account_name, 0)
+        delay = min(WORKER_RESTART_MAX_DELAY, WORKER_RESTART_BASE_DELAY * 2 ** failures_in_row)
+        account_failures_in_row[account_name] = failures_in_row + 1
+        print(f"Account {account_name} stopped: {error}. Restarting it in {delay} seconds.")
+        account_restarts[account_name] = loop.call_later(delay, restart_account, account_name)
+        event_queue.put((WORKER_EVENT_ACCOUNT_CRASHED, worker_index, pid, account_name, {"error": str(error), "restart_in": delay}))
+    async def heartbeat():
+        while True:
+            event_queue.put((WORKER_EVENT_HEARTBEAT, worker_index, pid, None, {"accounts": sorted(account_tasks), "restarting": sorted(account_restarts)}))
+            await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+    # The supervisor watches steam.json and sends the reloaded config to the workers
+    reloader = ConfigReloader(config, make_csfloat_session(config))
+    http_transport.warm_up_soon(config.get('client_proxy'), HTTP_WARM_UP_URLS[SERVICE_CSFLOAT])
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        while True:
+            command = await loop.run_in_executor(None, get_command)
+            if command is None:
+                continue
+            command, account_name, account_config = command
+            if command == WORKER_COMMAND_ADD and account_name not in account_configs:
+                print(f"Worker {worker_index}: starting account {account_name}.")
+                account_configs[account_name] = account_config
+                account_failures_in_row.pop(account_name, None)
+                start_account(account_name)
+            elif command == WORKER_COMMAND_REMOVE:
+                account_configs.pop(account_name, None)
+                restart = account_restarts.pop(account_name, None)
+                if restart is not None:
+                    restart.cancel()
+                task = account_tasks.pop(account_name, None)
+                if task is not None:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                event_queue.put((WORKER_EVENT_RELEASED, worker_index, pid, account_name, None))
+            elif command == WORKER_COMMAND_RELOAD:
+                reloader.apply(account_config, report=False)
+                reloaded_account_configs = account_configs_by_name(account_config)
+                account_configs.update({name: reloaded for name, reloaded in reloaded_account_configs.items() if name in account_configs})
+            elif command == WORKER_COMMAND_STOP:
+                break
+    finally:
+        heartbeat_task.cancel()
+        for restart in account_restarts.values():
+            restart.cancel()
+        for task in account_tasks.values():
+            task.cancel()
+        await asyncio.gather(*account_tasks.values(), return_exceptions=True)
+        await reloader.close()
+        await http_transport.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if control_runner is not None:
+            await control_runner.cleanup()
+
+def account_worker_process(worker_index: int, config: dict, command_queue, event_queue):
+    try:
+        asyncio.run(account_worker(worker_index, config, command_queue, event_queue))
+    except KeyboardInterrupt:
+        pass
+
+@dataclass
+class WorkerState:
+    index: int
+    process: multiprocessing.Process | None = None
+    command_queue: object = None
+    accounts: set[str] = field(default_factory=set)
+    started_at: float = 0.0
+    last_heartbeat: float = 0.0
+    restart_at: float | None = None
+    restarts: int = 0
+    failures_in_row: int = 0
+    account_crashes: int = 0
+    accounts_restarting: set[str] = field(default_factory=set)
+    checks: int = 0
+    check_seconds: float = 0.0
+    trades_tracked: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+# Shards accounts across worker processes, restarts crashed workers with backoff and moves their accounts to the live ones.
+# An account moves between workers only after the old worker released it, so no account runs twice.
+class WorkerSupervisor:
+    def __init__(self, config: dict, account_configs: dict[str, dict], worker_count: int, worker_target=account_worker_process):
+        self.config = config
+        self.account_configs = account_configs
+        self.worker_target = worker_target
+        self.context = multiprocessing.get_context("spawn")
+        self.event_queue = self.context.Queue()
+        self.workers = [WorkerState(index) for index in range(max(1, min(worker_count, len(account_configs))))]
+        self.pending_moves: dict[str, tuple[int, int]] = {} # account -> (source worker, target worker)
+        self.reloader = ConfigReloader(config, None)
+        for position, account_name in enumerate(account_configs):
+            self.workers[position % len(self.workers)].accounts.add(account_name)
+
+    def start_worker(self, worker: WorkerState):
+        worker.command_queue = self.context.Queue()
+        worker.process = self.context.Process(target=self.worker_target, args=(worker.index, self.config, worker.command_queue, self.event_queue), name=f"csfloat-worker-{worker.index}", daemon=True)
+        worker.process.start()
+        worker.started_at = worker.last_heartbeat = time.monotonic()
+        worker.restart_at = None
+        print(f"Worker {worker.index} started (pid {worker.process.pid}) with accounts {sorted(worker.accounts)}.")
+        for account_name in worker.accounts:
+            worker.command_queue.put((WORKER_COMMAND_ADD, account_name, self.account_configs[account_name]))
+
+    def assign(self, worker: WorkerState, account_name: str):
+        worker.accounts.add(account_name)
+        if worker.alive:
+            worker.command_queue.put((WORKER_COMMAND_ADD, account_name, self.account_configs[account_name]))
+
+    def least_loaded_worker(self, exclude: WorkerState | None = None) -> WorkerState | None:
+        live_workers = [worker for worker in self.workers if worker.alive and worker is not exclude]
+        return min(live_workers, key=lambda worker: len(worker.accounts), default=None)
+
+    def handle_dead_worker(self, worker: WorkerState, now: float):
+        print(f"Worker {worker.index} (pid {worker.process.pid}) exited with code {worker.process.exitcode}.")
+        worker.process = None
+        if now - worker.started_at >= WORKER_STABLE_SECONDS:
+            worker.failures_in_row = 0
+        delay = min(WORKER_RESTART_MAX_DELAY, WORKER_RESTART_BASE_DELAY * 2 ** worker.failures_in_row)
+        worker.failures_in_row += 1
+        worker.restart_at = now + delay
+        worker.trades_tracked.clear()
+        worker.accounts_restarting.clear()
+        print(f"Restarting worker {worker.index} in {delay} seconds.")
+        # Accounts being moved off the dead worker are released by its exit
+        for account_name, (source_index, target_index) in list(self.pending_moves.items()):
+            if source_index == worker.index:
+                del self.pending_moves[account_name]
+                self.assign(self.workers[target_index] if self.workers[target_index].alive else worker, account_name)
+        orphaned_accounts = sorted(worker.accounts)
+        worker.accounts.clear()
+        for account_name in orphaned_accounts:
+            target = self.least_loaded_worker(exclude=worker)
+            self.assign(target or worker, account_name)
+            if target is not None:
+                print(f"Moved account {account_name} to worker {target.index}.")
+
+    def rebalance(self):
+        if self.pending_moves:
+            return
+        live_workers = [worker for worker in self.workers if worker.alive]
+        if len(live_workers) < 2:
+            return
+        busiest = max(live_workers, key=lambda worker: len(worker.accounts))
+        idlest = min(live_workers, key=lambda worker: len(worker.accounts))
+        if len(busiest.accounts) - len(idlest.accounts) > 1:
+            account_name = sorted(busiest.accounts)[-1]
+            busiest.accounts.discard(account_name)
+            self.pending_moves[account_name] = (busiest.index, idlest.index)
+            busiest.command_queue.put((WORKER_COMMAND_REMOVE, account_name, None))
+
+    def handle_event(self, event: tuple, now: float):
+        event_type, worker_index, pid, account_name, data = event
+        worker = self.workers[worker_index]
+        if worker.process is None or worker.process.pid != pid:
+            return # from an exited incarnation of the worker
+        worker.last_heartbeat = now
+        if event_type == WORKER_EVENT_CHECK:
+            worker.checks += 1
+            worker.check_seconds += data["seconds"]
+            worker.trades_tracked[account_name] = data["trades"]
+            worker.accounts_restarting.discard(account_name)
+        elif event_type == WORKER_EVENT_HEARTBEAT:
+            worker.accounts_restarting = set(data.get("restarting", ()))
+        elif event_type == WORKER_EVENT_ACCOUNT_CRASHED:
+            worker.account_crashes += 1
+            worker.accounts_restarting.add(account_name)
+            worker.trades_tracked.pop(account_name, None)
+            print(f"Worker {worker.index}: account {account_name} crashed ({data['error']}), restarting it in {data['restart_in']} seconds.")
+        elif event_type == WORKER_EVENT_RELEASED and account_name in self.pending_moves:
+            _, target_index = self.pending_moves.pop(account_name)
+            worker.trades_tracked.pop(account_name, None)
+            worker.accounts_restarting.discard(account_name)
+            target = self.workers[target_index] if self.workers[target_index].alive else self.least_loaded_worker()
+            self.assign(target or worker, account_name)
+            print(f"Moved account {account_name} to worker {(target or worker).index}.")
+
+    # Restarted workers start with the reloaded config, the running ones apply it on the fly
+    def reload(self, config: dict):
+        report_restart_changes(self.config, config)
+        self.config = self.reloader.config = config
+        account_configs = account_configs_by_name(config)
+        self.account_configs.update({account_name: account_config for account_name, account_config in account_configs.items() if account_name in self.account_configs})
+        for worker in self.workers:
+            if worker.alive:
+                worker.command_queue.put((WORKER_COMMAND_RELOAD, None, config))
+
+    def report(self, window_seconds: float):
+        now = time.monotonic()
+        total_checks = sum(worker.checks for worker in self.workers)
+        print(f"Supervisor: {sum(worker.alive for worker in self.workers)}/{len(self.workers)} workers alive, {total_checks} checks in the last {window_seconds:.0f}s.")
+        for worker in self.workers:
+            if worker.alive:
+                status = f"pid {worker.process.pid}, heartbeat {now - worker.last_heartbeat:.0f}s ago"
+            else:
+                status = f"down, restart in {max(0.0, (worker.restart_at or now) - now):.0f}s"
+            average_check = f"{worker.check_seconds / worker.checks:.2f}s" if worker.checks else "-"
+            print(f"  Worker {worker.index}: {status}, {len(worker.accounts)} accounts ({len(worker.accounts_restarting)} restarting), {worker.restarts} restarts, "
+                  f"{worker.account_crashes} account crashes, {worker.checks} checks (avg {average_check}), {sum(worker.trades_tracked.values())} trades tracked")
+            worker.account_crashes = 0
+            worker.checks = 0
+            worker.check_seconds = 0.0
+
+    async def run(self):
+        print(f"Supervisor: running {len(self.account_configs)} accounts on {len(self.workers)} worker processes.")
+        for worker in self.workers:
+            self.start_worker(worker)
+        reported_at = watched_at = time.monotonic()
+        config_watch_seconds = self.config.get('config_watch_seconds')
+        if config_watch_seconds is None:
+            config_watch_seconds = CONFIG_WATCH_SECONDS
+        try:
+            while True:
+                await asyncio.sleep(1)
+                now = time.monotonic()
+                if config_watch_seconds and now - watched_at >= config_watch_seconds:
+                    watched_at = now
+                    config = self.reloader.read()
+                    if config is not None:
+                        self.reload(config)
+                while True:
+                    try:
+                        event = self.event_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.handle_event(event, now)
+                for worker in self.workers:
+                    if worker.process is not None and not worker.process.is_alive():
+                        self.handle_dead_worker(worker, now)
+                    elif worker.alive and now - worker.last_heartbeat > WORKER_HEARTBEAT_TIMEOUT_SECONDS:
+                        print(f"Worker {worker.index} sent no heartbeat for {now - worker.last_heartbeat:.0f} seconds, killing it.")
+                        worker.process.kill()
+                    elif worker.process is None and worker.restart_at is not None and now >= worker.restart_at:
+                        worker.restarts += 1
+                        self.start_worker(worker)
+                self.rebalance()
+                if now - reported_at >= SUPERVISOR_REPORT_SECONDS:
+                    self.report(now - reported_at)
+                    reported_at = now
+        finally:
+            for worker in self.workers:
+                if worker.alive:
+                    worker.command_queue.put((WORKER_COMMAND_STOP, None, None))
+            for worker in self.workers:
+                if worker.process is not None:
+                    await asyncio.to_thread(worker.process.join, 30)
+                    if worker.process.is_alive():
+                        worker.process.terminate()
+
+async def main():
+    config = load_steam_config()  # Загрузка конфигурации
+    retry_engine.apply_config(config.get('retry_policies'))
+    single_flight.apply_config(config.get('single_flight_fresh_seconds'))
+    account_configs = load_account_configs(config)
+    account_names = [account_config.get('account_name') or account_config['steam_login'] for account_config in account_configs]
+    config_watch_seconds = config.get('config_watch_seconds')
+    if config_watch_seconds is None:
+        config_watch_seconds = CONFIG_WATCH_SECONDS
+    if config.get('accounts') and len(set(account_names)) != len(account_names):
+        print("Error: account names in \"accounts\" must be unique, set \"account_name\" for accounts sharing a login.")
+        return
+    worker_processes=config.get('worker_processes')
+    if config.get('accounts') and worker_processes and worker_processes > 1:
+        await WorkerSupervisor(config, dict(zip(account_names, account_configs)), worker_processes).run()
+        return
+    metrics_runner = None
+    if config.get('metrics_port'):
+        metrics.enable()
+        metrics_runner = await start_metrics_server(config['metrics_port'], config.get('metrics_host') or "127.0.0.1")
+    control_runner = None
+    if config.get('control_port') or config.get('control_socket'):
+        control_runner = await start_control_server(config.get('control_port'), config.get('control_host') or "127.0.0.1", config.get('control_socket'), config.get('control_token'))
+    # CSFloat requests of all accounts share one session and connection pool, Steam sessions stay per account
+    http_transport.apply_config(config)
+    reloader = ConfigReloader(config, make_csfloat_session(config))
+    http_transport.warm_up_soon(config.get('client_proxy'), HTTP_WARM_UP_URLS[SERVICE_CSFLOAT])
+    watch_task = asyncio.create_task(reloader.watch(config_watch_seconds)) if config_watch_seconds else None
+    try:
+        if not config.get('accounts'):
+            await run_account(config, reloader.session)
+            return
+        print(f"Multi-account mode: running {len(account_configs)} accounts.")
+        results = await asyncio.gather(*(run_account(account_config, reloader.session, account_name) for account_config, account_name in zip(account_configs, account_names)), return_exceptions=True)
+        for account_name, result in zip(account_names, results):
+            if isinstance(result, BaseException):
+                print(f"Account {account_name} stopped: {result}")
+    finally:
+        if watch_task is not None:
+            watch_task.cancel()
+            await asyncio.gather(watch_task, return_exceptions=True)
+        await reloader.close()
+        await http_transport.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if control_runner is not None:
+            await control_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
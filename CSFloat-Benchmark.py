@@ -0,0 +1,465 @@
+import argparse
+import asyncio
+import base64
+import json
+import statistics
+import subprocess
+import aiohttp
+import tracemalloc
+import importlib.util
+import os,random,socket,sys,tempfile,time
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+from pathlib import Path
+
+# Benchmarks for the hot paths of CSFloat-Auto-Trade.py, run on synthetic data without network access.
+# Usage: python CSFloat-Benchmark.py grouping|reconciliation|parse|load|startup
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BOT_SCRIPT = Path(rf"{SCRIPT_DIR}/CSFloat-Auto-Trade.py")
+SIMULATOR_SCRIPT = Path(rf"{SCRIPT_DIR}/CSFloat-Simulator.py")
+MY_STEAM_ID = 76561198000000000
+
+def load_script(name: str, path: Path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_bot():
+    return load_script("csfloat_auto_trade", BOT_SCRIPT)
+
+def make_synthetic_trades(trades_count: int, buyers_count: int | None = None, item_names_count: int = 50, seed: int = 1, full_payload: bool = False):
+    rnd = random.Random(seed)
+    if not buyers_count:
+        buyers_count = max(1, trades_count // 5)
+    trades = []
+    for i in range(trades_count):
+        trades.append({
+            "id": str(800000000000000000 + i),
+            "seller_id": str(MY_STEAM_ID),
+            "buyer_id": str(76561198100000000 + rnd.randrange(buyers_count)),
+            "state": "pending",
+            "accepted_at": "2026-01-01T00:00:00.000000Z",
+            "verify_sale_at": None,
+            "wait_for_cancel_ping": False,
+            "trade_token": "abcdefgh",
+            "trade_url": None,
+            "contract": {"item": {"asset_id": str(30000000000 + i), "market_hash_name": f"Item {rnd.randrange(item_names_count)}"}},
+        })
+        if full_payload:
+            # Roughly the size and shape of a real /me/trades entry.
+            trades[-1]["contract"]["item"].update({
+                "def_index": rnd.randrange(1, 600), "paint_index": rnd.randrange(1, 1000), "paint_seed": rnd.randrange(1000),
+                "float_value": rnd.random(), "icon_url": "-9a81dlWLwJ2UUGcVs_nsVtzdOEdtWwKGZZLQHTxDZ7I56KU0Zwwo4NUX4oFJZEHLbXH5ApeO4YmlhxYQknCRvCo04DEVlxkKgpot7HxfDhjxszJemkV09-5lpKKqPrxN7LEmyVQ7MEpiLuSrYmnjQO3-UdsZGHyd4_Bd1RvNQ7T_FDrw-_ng5Pu75iY1zI97bhLsvQz" * 2,
+                "d_param": str(rnd.getrandbits(60)), "is_stattrak": False, "is_souvenir": False, "rarity": 5, "quality": 4,
+                "stickers": [{"stickerId": rnd.randrange(5000), "slot": s, "icon_url": "columbus2016/nv_holo.png", "name": f"Sticker {s}", "reference": {"price": 12, "quantity": 100}} for s in range(4)],
+                "tradable": 0, "inspect_link": f"steam://rungame/730/76561202255233023/+csgo_econ_action_preview%20S{MY_STEAM_ID}A{30000000000 + i}D{rnd.getrandbits(60)}",
+                "has_screenshot": True, "scm": {"price": 1234, "volume": 56}, "item_name": "Item", "wear_name": "Field-Tested",
+                "description": "A long item description that is shipped with every trade of the response. " * 3, "collection": "The Collection",
+            })
+            trades[-1]["contract"].update({"id": str(700000000000000000 + i), "created_at": "2026-01-01T00:00:00.000000Z", "type": "buy_now", "price": rnd.randrange(100, 100000), "state": "sold", "seller": {"steam_id": str(MY_STEAM_ID), "username": "seller", "avatar": "https://avatars.steamstatic.com/" + "a" * 40 + "_full.jpg"}})
+            trades[-1]["buyer"] = {"steam_id": trades[-1]["buyer_id"], "username": f"buyer{i}", "avatar": "https://avatars.steamstatic.com/" + "b" * 40 + "_full.jpg", "statistics": {"total_trades": 12, "median_trade_time": 300}}
+    return trades
+
+# The grouping loop of check_actionable_trades before group_trades_for_offers, kept for comparison.
+def group_trades_legacy(trades_list_sell_accepted):
+    index_excluded=[]
+    offer_maker=[]
+    for i in range(len(trades_list_sell_accepted)):
+        if i not in index_excluded:
+            asset_id_list_temp=[]
+            for ii in range(len(trades_list_sell_accepted)):
+                if trades_list_sell_accepted[ii]['buyer_id']==trades_list_sell_accepted[i]['buyer_id'] and trades_list_sell_accepted[ii]["contract"]["item"]["market_hash_name"]==trades_list_sell_accepted[i]["contract"]["item"]["market_hash_name"]:
+                    asset_id_list_temp.append(int(trades_list_sell_accepted[ii]["contract"]["item"]["asset_id"]))
+                    index_excluded.append(ii)
+            offer_maker.append({"trade_id":int(trades_list_sell_accepted[i]["id"]),"buyer_id":int(trades_list_sell_accepted[i]["buyer_id"]),"asset_id":asset_id_list_temp})
+    return offer_maker
+
+def make_synthetic_sent_offers(bot, trades, history_count: int, seed: int = 2):
+    rnd = random.Random(seed)
+    statuses = list(bot.TradeOfferStatus)
+    offers = []
+    for i in range(history_count):
+        offers.append(SimpleNamespace(
+            trade_offer_id=7000000000 + i,
+            partner_id=rnd.randrange(10000000, 90000000),
+            status=rnd.choice(statuses),
+            items_to_give=[SimpleNamespace(asset_id=20000000000 + i)],
+        ))
+    # Half of the current trades already have an offer waiting for confirmation.
+    for i, trade in enumerate(trades[::2]):
+        offers.append(SimpleNamespace(
+            trade_offer_id=6000000000 + i,
+            partner_id=bot.to_account_id(int(trade["buyer_id"])),
+            status=bot.TradeOfferStatus.CONFIRMATION_NEED,
+            items_to_give=[SimpleNamespace(asset_id=int(trade["contract"]["item"]["asset_id"]))],
+        ))
+    return offers
+
+# The reconciliation loop of check_actionable_trades before SentOfferIndex, kept for comparison (confirmation calls removed).
+def reconcile_legacy(bot, offer_maker, sentto):
+    for omi in range(len(offer_maker)):
+        asset_id_sent=[]
+        for toi in range(len(sentto)):
+            if sentto[toi].partner_id >76561197960265728:
+                sentto[toi].partner_id-=76561197960265728
+            if offer_maker[omi].buyer_id >76561197960265728:
+                offer_maker[omi].buyer_id-=76561197960265728
+            if sentto[toi].status in (bot.TradeOfferStatus.ACCEPTED,bot.TradeOfferStatus.ACTIVE,bot.TradeOfferStatus.CONFIRMATION_NEED) and sentto[toi].partner_id==offer_maker[omi].buyer_id:
+                for itg in sentto[toi].items_to_give:
+                    asset_id_sent.append(itg.asset_id)
+                if sentto[toi].status == bot.TradeOfferStatus.CONFIRMATION_NEED:
+                    asset_id_sent_check=asset_id_sent
+                    for itgom in offer_maker[omi].asset_id:
+                        asset_id_sent_check=list(filter(lambda c: c!=itgom,asset_id_sent_check))
+        if asset_id_sent:
+            for i in asset_id_sent:
+                offer_maker[omi].asset_id=list(filter(lambda c: c!=i,offer_maker[omi].asset_id))
+    return offer_maker
+
+def reconcile_indexed(bot, offer_maker, sentto):
+    sent_offer_index = bot.SentOfferIndex(sentto)
+    for group in offer_maker:
+        group.asset_id = sent_offer_index.reconcile(group).missing_asset_ids
+    return offer_maker
+
+class SyntheticStreamResponse:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.content = self
+
+    async def iter_chunked(self, chunk_size: int):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+            await asyncio.sleep(0)
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_chunked(64 * 1024)])
+
+    async def json(self):
+        return json.loads((await self.read()).decode())
+
+# The trades path of get_trades and get_actionable_trades_sell before parse_trades_stream, kept for comparison.
+async def parse_trades_legacy(bot, response):
+    trades_info = await response.json()
+    trades_list = trades_info.get('trades', [])
+    return list(filter(lambda c: int(c['seller_id']) ==MY_STEAM_ID and not bot.any2bool(c['wait_for_cancel_ping']), trades_list))
+
+# Wall time is measured without tracemalloc, which slows allocations down.
+def measure_async(coro_factory):
+    start = time.perf_counter()
+    result = asyncio.run(coro_factory())
+    elapsed = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = asyncio.run(coro_factory())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def time_call(func, *args, repeat: int = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_grouping(bot, args):
+    print(f"{'trades':>8} {'groups':>8} {'legacy ms':>12} {'grouped ms':>12} {'us/trade':>10}")
+    for trades_count in args.sizes:
+        trades = make_synthetic_trades(trades_count)
+        records = [bot.Trade.from_json(trade) for trade in trades]
+        groups = bot.group_trades_for_offers(records)
+        if not args.skip_legacy and trades_count <= args.legacy_max:
+            legacy = group_trades_legacy(trades)
+            assert sorted(sorted(g["asset_id"]) for g in legacy) == sorted(sorted(g.asset_id) for g in groups)
+            legacy_ms = f"{time_call(group_trades_legacy, trades, repeat=1) * 1000:.1f}"
+        else:
+            legacy_ms = "-"
+        grouped = time_call(bot.group_trades_for_offers, records)
+        print(f"{trades_count:>8} {len(groups):>8} {legacy_ms:>12} {grouped * 1000:>12.2f} {grouped / trades_count * 1e6:>10.2f}")
+
+def bench_reconciliation(bot, args):
+    print(f"{'trades':>8} {'history':>8} {'groups':>8} {'legacy ms':>12} {'indexed ms':>12}")
+    for trades_count in args.sizes:
+        trades = make_synthetic_trades(trades_count)
+        records = [bot.Trade.from_json(trade) for trade in trades]
+        sentto = make_synthetic_sent_offers(bot, trades, args.history)
+        if not args.skip_legacy and trades_count <= args.legacy_max:
+            start = time.perf_counter()
+            legacy = reconcile_legacy(bot, bot.group_trades_for_offers(records), [SimpleNamespace(**vars(o)) for o in sentto])
+            legacy_ms = f"{(time.perf_counter() - start) * 1000:.1f}"
+        else:
+            legacy, legacy_ms = None, "-"
+        start = time.perf_counter()
+        indexed = reconcile_indexed(bot, bot.group_trades_for_offers(records), sentto)
+        indexed_ms = (time.perf_counter() - start) * 1000
+        if legacy is not None:
+            assert [sorted(g.asset_id) for g in legacy] == [sorted(g.asset_id) for g in indexed]
+        print(f"{trades_count:>8} {len(sentto):>8} {len(indexed):>8} {legacy_ms:>12} {indexed_ms:>12.2f}")
+
+def bench_parse(bot, args):
+    print(f"{'trades':>8} {'body MB':>8} {'legacy ms':>10} {'legacy peak MB':>15} {'stream ms':>10} {'stream peak MB':>15}")
+    for trades_count in args.sizes:
+        trades = make_synthetic_trades(trades_count, full_payload=True)
+        # Every fifth trade belongs to another seller and is filtered out.
+        for trade in trades[::5]:
+            trade["seller_id"] = str(MY_STEAM_ID + 1)
+        body = json.dumps({"trades": trades, "count": len(trades)}).encode()
+        del trades
+        legacy, legacy_time, legacy_peak = measure_async(lambda: parse_trades_legacy(bot, SyntheticStreamResponse(body)))
+        legacy_count = len(legacy)
+        del legacy
+        streamed, stream_time, stream_peak = measure_async(lambda: bot.parse_trades_stream(SyntheticStreamResponse(body), MY_STEAM_ID, args.chunk_size))
+        assert legacy_count == len(streamed)
+        print(f"{trades_count:>8} {len(body) / 2**20:>8.1f} {legacy_time * 1000:>10.1f} {legacy_peak / 2**20:>15.1f} {stream_time * 1000:>10.1f} {stream_peak / 2**20:>15.1f}")
+
+# Load scenarios of the end-to-end benchmark: trades waiting, inventory size, sent offer history, new trades per cycle
+LOAD_SCENARIOS = {
+    "small": (100, 500, 200, 10),
+    "medium": (1000, 1500, 2000, 50),
+    "large": (3000, 3000, 5000, 200),
+}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# The simulator runs in its own process, so the bot's wall time and memory are not mixed with the server's.
+async def start_simulator(args, trades_count: int, inventory_count: int, history_count: int):
+    port = free_port()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, str(SIMULATOR_SCRIPT), "--port", str(port),
+        "--trades", str(trades_count), "--inventory", str(inventory_count), "--history", str(history_count),
+        "--latency-ms", str(args.latency_ms), "--error-rate", str(args.error_rate),
+        "--csfloat-rps", str(args.csfloat_rps), "--steam-rps", str(args.steam_rps), "--accept-failure-rate", str(args.accept_failure_rate),
+        "--missing-item-rate", str(args.missing_item_rate),
+        stdout=asyncio.subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    async with aiohttp.ClientSession() as session:
+        for _ in range(300):
+            try:
+                async with session.get(f"{base_url}/sim/stats") as response:
+                    if response.status == 200:
+                        return process, base_url
+            except aiohttp.ClientConnectionError:
+                pass
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The simulator did not start.")
+
+CSFLOAT_URL = "https://csfloat.com"
+CSFLOAT_API_CONSTANTS = ("API_USER_INFO", "API_TRADES", "API_ACCEPT_TRADE", "API_ACCEPT_TRADES_BULK")
+
+def point_bot_to_simulator(bot, base_url: str):
+    if not hasattr(bot, "CSFLOAT_API_URLS"):
+        bot.CSFLOAT_API_URLS = {name: getattr(bot, name) for name in CSFLOAT_API_CONSTANTS}
+    for name, url in bot.CSFLOAT_API_URLS.items():
+        setattr(bot, name, url.replace(CSFLOAT_URL, base_url))
+
+def count_requests(before: dict, after: dict, prefix: str) -> int:
+    return sum(count - before.get(route, 0) for route, count in after.items() if route.split(" ")[1].startswith(prefix))
+
+# Runs check cycles against the simulator. With `traced`, the peak memory of every cycle is measured as well.
+async def run_load_cycles(bot, simulator, base_url: str, cycles: int, arrivals: int, concurrency: int, traced: bool, accept_chunk_size: int, accept_concurrency: int) -> list[dict]:
+    results = []
+    rate_limiters = {bot.SERVICE_CSFLOAT: bot.TokenBucket(0), bot.SERVICE_STEAM: bot.TokenBucket(0)}
+    point_bot_to_simulator(bot, base_url)
+    async with aiohttp.ClientSession() as control, aiohttp.ClientSession() as session:
+        async def sim_stats():
+            async with control.get(f"{base_url}/sim/stats") as response:
+                return await response.json()
+        async with control.post(f"{base_url}/sim/reset") as response:
+            response.raise_for_status()
+        client = bot.SingleFlightSteamClient(simulator.SimulatedSteamClient(base_url, session, MY_STEAM_ID))
+        with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, "w") as devnull:
+            trade_state_store = bot.TradeStateStore(Path(tmp_dir) / "trade_state.sqlite3")
+            trades_snapshot = bot.TradesSnapshot(session, "simulated-key", MY_STEAM_ID, rate_limiters[bot.SERVICE_CSFLOAT])
+            missing_asset_cache = bot.MissingAssetCache()
+            for cycle in range(cycles):
+                before = await sim_stats()
+                if traced:
+                    tracemalloc.reset_peak()
+                start = time.perf_counter()
+                with redirect_stdout(devnull):
+                    await bot.check_actionable_trades(session, "simulated-key", client, None, None, trade_state_store, 300, MY_STEAM_ID,
+                                                      rate_limiters=rate_limiters, dispatch_concurrency=concurrency, trades_snapshot=trades_snapshot,
+                                                      accept_chunk_size=accept_chunk_size, accept_concurrency=accept_concurrency, missing_asset_cache=missing_asset_cache)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1] if traced else None
+                after = await sim_stats()
+                results.append({
+                    "cycle": cycle + 1,
+                    "seconds": elapsed,
+                    "peak": peak,
+                    "csfloat_requests": count_requests(before["requests"], after["requests"], "/api/"),
+                    "steam_requests": count_requests(before["requests"], after["requests"], "/steam/"),
+                    "rejected": count_requests(before["rate_limited"], after["rate_limited"], "/") + count_requests(before["errors"], after["errors"], "/"),
+                    "actionable_trades": after["actionable_trades"],
+                })
+                if arrivals:
+                    async with control.post(f"{base_url}/sim/arrivals", json={"count": arrivals}) as response:
+                        response.raise_for_status()
+            trade_state_store.close()
+    return results
+
+def bench_load(bot, args):
+    simulator = load_script("csfloat_simulator", SIMULATOR_SCRIPT)
+    bot.ACCEPT_DELAY_SECONDS = (0, 0)
+    # Retries keep their shape but wait in fractions of a second.
+    bot.ACCEPT_RETRY_DELAY_SECONDS = 0.1
+    # Cycles run back to back here, a result must not be reused by the next cycle.
+    bot.single_flight.apply_config(0)
+    bot.retry_engine.apply_config({endpoint: {"base_delay": 0.1, "max_delay": 2, "rate_limited_delay": 1} for endpoint in bot.retry_engine.policies})
+    print(f"{'scenario':>8} {'cycle':>5} {'trades':>7} {'wall ms':>9} {'csfloat req':>11} {'steam req':>9} {'429/5xx':>7} {'peak MB':>8} {'left':>6}")
+    async def run_scenario(name: str):
+        trades_count, inventory_count, history_count, arrivals = LOAD_SCENARIOS[name]
+        process, base_url = await start_simulator(args, trades_count, inventory_count, history_count)
+        try:
+            timed = await run_load_cycles(bot, simulator, base_url, args.cycles, arrivals, args.concurrency, False, args.accept_chunk_size, args.accept_concurrency)
+            tracemalloc.start()
+            try:
+                traced = await run_load_cycles(bot, simulator, base_url, args.cycles, arrivals, args.concurrency, True, args.accept_chunk_size, args.accept_concurrency)
+            finally:
+                tracemalloc.stop()
+        finally:
+            process.kill()
+            await process.wait()
+        for result, traced_result in zip(timed, traced):
+            trades = trades_count if result["cycle"] == 1 else arrivals
+            print(f"{name:>8} {result['cycle']:>5} {trades:>7} {result['seconds'] * 1000:>9.1f} {result['csfloat_requests']:>11} {result['steam_requests']:>9} "
+                  f"{result['rejected']:>7} {traced_result['peak'] / 2**20:>8.1f} {result['actionable_trades']:>6}")
+    for name in args.scenarios:
+        asyncio.run(run_scenario(name))
+
+# Loads the bot in a fresh interpreter and prints how long the module took to import.
+IMPORT_PROBE = f"""
+import importlib.util, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("csfloat_auto_trade", {str(BOT_SCRIPT)!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(time.perf_counter() - start)
+"""
+
+def make_access_token(steam_id: int, expires_in: float) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+    now = int(time.time())
+    payload = {"iss": "r:0", "sub": str(steam_id), "aud": ["web:community"], "exp": now + int(expires_in), "nbf": now, "iat": now}
+    return f"{encode({'typ': 'JWT', 'alg': 'EdDSA'})}.{encode(payload)}.signature"
+
+# Builds a SteamClient the way run_account does. Requests to Steam are replaced by a sleep of `rtt` seconds and counted.
+def make_startup_client(bot, round_trips: list, rtt: float):
+    class StartupSteamClient(bot.SteamClient):
+        async def is_session_alive(self, *args, **kwargs):
+            round_trips.append("is_session_alive")
+            await asyncio.sleep(rtt)
+            return True
+
+        async def get_confirmations(self, *args, **kwargs):
+            round_trips.append("get_confirmations")
+            await asyncio.sleep(rtt)
+            return []
+    return StartupSteamClient(steam_id=MY_STEAM_ID, username="bench", password="bench", shared_secret="c2VjcmV0", identity_secret="c2VjcmV0", session=bot.http_transport.session(raise_for_status=True))
+
+async def run_startup_scenario(bot, fast_start: bool, expires_in: float, rtt: float, repeat: int) -> dict:
+    results = {"construct": [], "restore": [], "first_use": [], "startup_trips": 0, "first_use_trips": 0}
+    for _ in range(repeat):
+        round_trips = []
+        start = time.perf_counter()
+        client = make_startup_client(bot, round_trips, rtt)
+        results["construct"].append(time.perf_counter() - start)
+        try:
+            client.access_token = make_access_token(MY_STEAM_ID, expires_in)
+            cookies = bot.get_jsonable_cookies(client.session)
+            client.session.cookie_jar.clear()
+            start = time.perf_counter()
+            if fast_start:
+                unverified = await bot.restore_steam_session(cookies, client, fast_start=True)
+            else:
+                unverified = await bot.restore_from_cookies_retry(cookies, client) and False
+            results["restore"].append(time.perf_counter() - start)
+            results["startup_trips"] = len(round_trips)
+            check_client = bot.LazySteamClient(client) if unverified else client
+            start = time.perf_counter()
+            await check_client.get_confirmations()
+            results["first_use"].append(time.perf_counter() - start)
+            results["first_use_trips"] = len(round_trips) - results["startup_trips"]
+        finally:
+            await client.session.close()
+    await bot.http_transport.close()
+    return results
+
+def bench_startup(bot, args):
+    imports = []
+    for _ in range(args.repeat):
+        result = subprocess.run([sys.executable, "-c", IMPORT_PROBE], capture_output=True, text=True, check=True)
+        imports.append(float(result.stdout.strip().splitlines()[-1]))
+    print(f"Bot module import in a fresh interpreter: median {statistics.median(imports) * 1000:.0f} ms, min {min(imports) * 1000:.0f} ms ({args.repeat} runs).")
+    rtt = args.steam_rtt_ms / 1000
+    scenarios = {
+        "full restore": (False, 86400),
+        "fast start": (True, 86400),
+        "fast, expired": (True, -60),
+    }
+    print(f"Steam session restore with a simulated round trip of {args.steam_rtt_ms:.0f} ms:")
+    print(f"{'scenario':>14} {'client ms':>9} {'restore ms':>10} {'trips':>5} {'1st call ms':>11} {'trips':>5}")
+    with open(os.devnull, "w") as devnull:
+        for name, (fast_start, expires_in) in scenarios.items():
+            with redirect_stdout(devnull):
+                results = asyncio.run(run_startup_scenario(bot, fast_start, expires_in, rtt, args.repeat))
+            print(f"{name:>14} {statistics.median(results['construct']) * 1000:>9.2f} {statistics.median(results['restore']) * 1000:>10.1f} {results['startup_trips']:>5} "
+                  f"{statistics.median(results['first_use']) * 1000:>11.1f} {results['first_use_trips']:>5}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for CSFloat-Auto-Trade.py")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    grouping = subparsers.add_parser("grouping", help="Group accepted trades into trade offers.")
+    grouping.add_argument("--sizes", type=int, nargs="+", default=[250, 500, 1000, 2000, 3000, 4000, 8000])
+    grouping.add_argument("--legacy-max", type=int, default=4000, help="Largest size to run the legacy O(n²) loop on.")
+    grouping.add_argument("--skip-legacy", action="store_true")
+    grouping.set_defaults(func=bench_grouping)
+
+    reconciliation = subparsers.add_parser("reconciliation", help="Match offer groups against the sent trade offer history.")
+    reconciliation.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 1000, 3000])
+    reconciliation.add_argument("--history", type=int, default=5000, help="Number of older sent trade offers.")
+    reconciliation.add_argument("--legacy-max", type=int, default=1000, help="Largest size to run the legacy loop on.")
+    reconciliation.add_argument("--skip-legacy", action="store_true")
+    reconciliation.set_defaults(func=bench_reconciliation)
+
+    parse = subparsers.add_parser("parse", help="Parse and filter a synthetic /me/trades response.")
+    parse.add_argument("--sizes", type=int, nargs="+", default=[500, 3000])
+    parse.add_argument("--chunk-size", type=int, default=64 * 1024)
+    parse.set_defaults(func=bench_parse)
+
+    load = subparsers.add_parser("load", help="Run full check cycles against the local CSFloat/Steam simulator.")
+    load.add_argument("--scenarios", nargs="+", choices=list(LOAD_SCENARIOS), default=list(LOAD_SCENARIOS))
+    load.add_argument("--cycles", type=int, default=3)
+    load.add_argument("--concurrency", type=int, default=4, help="dispatch_concurrency of the bot.")
+    load.add_argument("--accept-chunk-size", type=int, default=50, help="accept_chunk_size of the bot.")
+    load.add_argument("--accept-concurrency", type=int, default=2, help="accept_concurrency of the bot.")
+    load.add_argument("--latency-ms", type=float, default=20.0, help="Simulated latency of every request.")
+    load.add_argument("--error-rate", type=float, default=0.0, help="Share of simulated requests answered with HTTP 500.")
+    load.add_argument("--csfloat-rps", type=float, default=0.0, help="Simulated CSFloat rate limit, 0 disables it.")
+    load.add_argument("--steam-rps", type=float, default=0.0, help="Simulated Steam rate limit, 0 disables it.")
+    load.add_argument("--accept-failure-rate", type=float, default=0.0, help="Share of trades the simulated bulk accept leaves unaccepted.")
+    load.add_argument("--missing-item-rate", type=float, default=0.0, help="Share of simulated trades whose item is not in the inventory.")
+    load.set_defaults(func=bench_load)
+
+    startup = subparsers.add_parser("startup", help="Import the bot and restore a cached Steam session, with and without the fast start path.")
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.add_argument("--steam-rtt-ms", type=float, default=300.0, help="Simulated duration of one request to Steam.")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    bot = load_bot()
+    args.func(bot, args)
+
+if __name__ == "__main__":
+    main()
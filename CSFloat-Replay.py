@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import cProfile
+import pstats
+import tracemalloc
+import importlib.util
+import os,sys,tempfile,time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+# Replays a check cycle recorded with the "record_dir" option through check_actionable_trades, offline and deterministically,
+# optionally under cProfile or tracemalloc to find hot spots on real data.
+# Usage: python CSFloat-Replay.py recordings/cycle_20260101T000000000000Z.jsonl.gz --profile
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BOT_SCRIPT = Path(rf"{SCRIPT_DIR}/CSFloat-Auto-Trade.py")
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location("csfloat_auto_trade", BOT_SCRIPT)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+async def replay_cycle(bot, header: dict, entries: list[dict], quiet: bool):
+    replay_log = bot.ReplayLog(entries)
+    my_steam_id = header["my_steam_id"]
+    settings = header.get("settings") or {}
+    timings = bot.StageTimings()
+    rate_limiters = {bot.SERVICE_CSFLOAT: bot.TokenBucket(0), bot.SERVICE_STEAM: bot.TokenBucket(0)}
+    steam_client = bot.ReplaySteamClient(replay_log, my_steam_id)
+    sent_offer_cache = bot.SentOfferCache(steam_client)
+    if header.get("sent_offers"):
+        sent_offer_cache.restore(header["sent_offers"])
+    missing_asset_cache = bot.MissingAssetCache()
+    if header.get("missing_assets"):
+        missing_asset_cache.restore(header["missing_assets"])
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, "w") as devnull:
+        trade_state_store = bot.TradeStateStore(Path(tmp_dir) / "trade_state.sqlite3")
+        if header.get("outbox"):
+            trade_state_store.outbox_restore(header["outbox"])
+        try:
+            with redirect_stdout(devnull if quiet else sys.stdout):
+                await bot.check_actionable_trades(
+                    bot.ReplaySession(replay_log), "replay", steam_client, None, None, trade_state_store, 300, my_steam_id,
+                    inventory_cache_ttl_seconds=settings.get("inventory_cache_ttl_seconds", 120),
+                    offer_group_by=settings.get("offer_group_by", bot.OFFER_GROUP_BY_BUYER_ITEM),
+                    rate_limiters=rate_limiters,
+                    dispatch_concurrency=settings.get("dispatch_concurrency", 4),
+                    accept_chunk_size=settings.get("accept_chunk_size", bot.ACCEPT_CHUNK_SIZE),
+                    accept_concurrency=settings.get("accept_concurrency", bot.ACCEPT_CONCURRENCY),
+                    dispatch_budget_seconds=settings.get("dispatch_budget_seconds", bot.OFFER_DISPATCH_BUDGET_SECONDS),
+                    timings=timings,
+                    user_info=header.get("user_info"),
+                    sent_offer_cache=sent_offer_cache,
+                    missing_asset_cache=missing_asset_cache,
+                )
+        finally:
+            trade_state_store.close()
+    return timings, replay_log
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded CSFloat-Auto-Trade.py check cycle offline.")
+    parser.add_argument("recording", type=Path)
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the cycle this many times.")
+    parser.add_argument("--profile", action="store_true", help="Run the replay under cProfile.")
+    parser.add_argument("--profile-output", type=Path, help="Save the cProfile stats to this file.")
+    parser.add_argument("--profile-top", type=int, default=30, help="Number of functions to print, by cumulative time.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Report peak memory and the top allocation sites.")
+    parser.add_argument("--tracemalloc-top", type=int, default=15)
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's output.")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    header, entries = bot.load_recording(args.recording)
+    print(f"Recording from {header['recorded_at']}: {len(entries)} calls, recorded time {sum(entry.get('elapsed', 0) for entry in entries):.2f}s.")
+    # Nothing waits in a replay: no pauses before accepting and no delay between retries.
+    bot.ACCEPT_DELAY_SECONDS = (0, 0)
+    bot.ACCEPT_RETRY_DELAY_SECONDS = 0
+    # Repeated runs must not reuse the results of the previous one.
+    bot.single_flight.apply_config(0)
+    bot.retry_engine.apply_config({endpoint: {"base_delay": 0, "max_delay": 0, "rate_limited_delay": 0, "jitter": 0} for endpoint in bot.retry_engine.policies})
+
+    profiler = cProfile.Profile() if args.profile or args.profile_output else None
+    if args.tracemalloc:
+        tracemalloc.start(25)
+    for run in range(args.repeat):
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        timings, replay_log = asyncio.run(replay_cycle(bot, header, entries, quiet=not args.verbose))
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+        print(f"Replay {run + 1}: {elapsed * 1000:.1f} ms, {replay_log.remaining()} recorded calls unused, {len(replay_log.unmatched)} calls without a recorded answer.")
+        timings.report()
+        for key in replay_log.unmatched[:10]:
+            print(f"  No recorded answer for {key}")
+    if args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Peak traced memory: {peak / 2**20:.1f} MB. Top allocation sites still alive:")
+        for stat in snapshot.statistics("lineno")[:args.tracemalloc_top]:
+            print(f"  {stat}")
+    if profiler is not None:
+        if args.profile_output:
+            profiler.dump_stats(args.profile_output)
+            print(f"cProfile stats saved to {args.profile_output}.")
+        pstats.Stats(profiler).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(args.profile_top)
+
+if __name__ == "__main__":
+    main()
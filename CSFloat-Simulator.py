@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import aiohttp
+import random,time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from aiohttp import web
+from aiosteampy.constants import TradeOfferStatus, ConfirmationType
+
+# Local stand-in for the CSFloat API and the Steam calls of CSFloat-Auto-Trade.py, for load tests without live accounts.
+# CSFloat endpoints mirror the real API paths, Steam inventory, trade offer and confirmation calls are served as plain JSON
+# under /steam and used through SimulatedSteamClient. Latency, error rate and 429 behaviour are configurable per service.
+# Usage: python CSFloat-Simulator.py --port 8080 --trades 3000 --inventory 2000 --history 5000 --latency-ms 50
+
+MY_STEAM_ID = 76561198000000000
+STEAM_ID64_BASE = 76561197960265728
+SERVICE_CSFLOAT = "csfloat"
+SERVICE_STEAM = "steam"
+SERVICE_CONTROL = "sim"
+OFFERS_PAGE_SIZE = 500 # sent trade offers per GetTradeOffers page, newest first
+OFFER_STATUSES_ACTIVE = (TradeOfferStatus.ACTIVE.value, TradeOfferStatus.CONFIRMATION_NEED.value)
+
+def utc_now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+# Trades, inventory and sent trade offers of one simulated seller account.
+class SimulatorState:
+    def __init__(self, trades_count: int = 3000, inventory_count: int = 2000, history_count: int = 5000, buyers_count: int | None = None, item_names_count: int = 50, accept_offers: bool = True, steam_id: int = MY_STEAM_ID, seed: int = 1, missing_item_rate: float = 0.0):
+        self.rnd = random.Random(seed)
+        self.missing_item_rate = missing_item_rate # share of new trades whose item has left the inventory (traded away elsewhere)
+        self.steam_id = steam_id
+        self.buyers_count = buyers_count or max(1, trades_count // 5)
+        self.item_names_count = item_names_count
+        self.accept_offers = accept_offers # buyers accept confirmed offers right away, CSFloat then verifies the trades
+        self.trades: dict[str, dict] = {}
+        self.trades_by_asset: dict[int, dict] = {}
+        self.inventory: dict[int, dict] = {}
+        self.offers: dict[int, dict] = {}
+        self.next_trade_id = 800000000000000000
+        self.next_asset_id = 30000000000
+        self.next_offer_id = 7000000000
+        self.add_trades(trades_count)
+        while len(self.inventory) < inventory_count:
+            self.add_item(f"Item {self.rnd.randrange(item_names_count)}")
+        # History offers are an hour apart, the newest an hour old.
+        history_started_at = int(time.time()) - history_count * 3600
+        for index in range(history_count):
+            offer_id = self.new_offer_id()
+            self.offers[offer_id] = {
+                "time_created": history_started_at + index * 3600,
+                "time_updated": history_started_at + index * 3600,
+                "trade_offer_id": offer_id,
+                "partner_id": self.rnd.randrange(10000000, 90000000),
+                "status": self.rnd.choice((TradeOfferStatus.ACCEPTED, TradeOfferStatus.DECLINED, TradeOfferStatus.CANCELED, TradeOfferStatus.EXPIRED)).value,
+                "items_to_give": [{"asset_id": 20000000000 + offer_id, "market_hash_name": "Old item"}],
+                "message": "",
+            }
+
+    def new_offer_id(self) -> int:
+        self.next_offer_id += 1
+        return self.next_offer_id
+
+    def add_item(self, market_hash_name: str) -> dict:
+        self.next_asset_id += 1
+        item = {"asset_id": self.next_asset_id, "market_hash_name": market_hash_name}
+        self.inventory[item["asset_id"]] = item
+        return item
+
+    # New sales waiting to be accepted by the seller, their items are added to the inventory.
+    def add_trades(self, count: int):
+        for _ in range(count):
+            self.next_trade_id += 1
+            item = self.add_item(f"Item {self.rnd.randrange(self.item_names_count)}")
+            if self.rnd.random() < self.missing_item_rate:
+                del self.inventory[item["asset_id"]]
+            trade = {
+                "id": str(self.next_trade_id),
+                "created_at": utc_now_iso(),
+                "seller_id": str(self.steam_id),
+                "buyer_id": str(76561198100000000 + self.rnd.randrange(self.buyers_count)),
+                "state": "queued",
+                "accepted_at": None,
+                "verify_sale_at": None,
+                "wait_for_cancel_ping": False,
+                "trade_token": "abcdefgh",
+                "trade_url": None,
+                "contract": {
+                    "id": str(self.next_trade_id - 100000000000000000),
+                    "price": self.rnd.randrange(100, 100000),
+                    "item": {"asset_id": str(item["asset_id"]), "market_hash_name": item["market_hash_name"], "float_value": self.rnd.random(), "paint_seed": self.rnd.randrange(1000)},
+                },
+            }
+            self.trades[trade["id"]] = trade
+            self.trades_by_asset[item["asset_id"]] = trade
+
+    def actionable_trades(self) -> list[dict]:
+        return [trade for trade in self.trades.values() if trade["state"] in ("queued", "pending")]
+
+    def accept(self, trade_ids: list[str]) -> list[dict]:
+        accepted = []
+        for trade_id in trade_ids:
+            trade = self.trades.get(str(trade_id))
+            if trade is not None and trade["state"] == "queued":
+                trade["state"] = "pending"
+                trade["accepted_at"] = utc_now_iso()
+                accepted.append(trade)
+        return accepted
+
+    def create_offer(self, partner_steam_id: int, asset_ids: list[int], message: str) -> int | None:
+        if not asset_ids or any(asset_id not in self.inventory for asset_id in asset_ids):
+            return None
+        offer_id = self.new_offer_id()
+        self.offers[offer_id] = {
+            "time_created": int(time.time()),
+            "time_updated": int(time.time()),
+            "trade_offer_id": offer_id,
+            "partner_id": partner_steam_id - STEAM_ID64_BASE if partner_steam_id > STEAM_ID64_BASE else partner_steam_id,
+            "status": TradeOfferStatus.CONFIRMATION_NEED.value,
+            "items_to_give": [self.inventory[asset_id] for asset_id in asset_ids],
+            "message": message,
+        }
+        return offer_id
+
+    def confirmations(self) -> list[dict]:
+        return [{"id": offer_id, "nonce": str(offer_id * 7), "creator_id": offer_id, "type": ConfirmationType.TRADE.value}
+                for offer_id, offer in self.offers.items() if offer["status"] == TradeOfferStatus.CONFIRMATION_NEED.value]
+
+    def confirm(self, offer_ids: list[int]) -> list[int]:
+        confirmed = []
+        for offer_id in offer_ids:
+            offer = self.offers.get(int(offer_id))
+            if offer is None or offer["status"] != TradeOfferStatus.CONFIRMATION_NEED.value:
+                continue
+            offer["status"] = TradeOfferStatus.ACTIVE.value
+            offer["time_updated"] = int(time.time())
+            confirmed.append(offer["trade_offer_id"])
+            if self.accept_offers:
+                offer["status"] = TradeOfferStatus.ACCEPTED.value
+                for item in offer["items_to_give"]:
+                    self.inventory.pop(item["asset_id"], None)
+                    trade = self.trades_by_asset.get(item["asset_id"])
+                    if trade is not None:
+                        trade["state"] = "verified"
+                        trade["verify_sale_at"] = utc_now_iso()
+        return confirmed
+
+    # Sent offers the way GetTradeOffers pages them: newest first, active_only keeps the active ones and those changed since the cutoff.
+    def offers_page(self, active_only: bool, time_historical_cutoff: int | None, cursor: int, page_size: int = OFFERS_PAGE_SIZE) -> tuple[list[dict], int]:
+        offers = sorted(self.offers.values(), key=lambda offer: offer["trade_offer_id"], reverse=True)
+        if active_only:
+            offers = [offer for offer in offers if offer["status"] in OFFER_STATUSES_ACTIVE or (time_historical_cutoff is not None and offer["time_updated"] >= time_historical_cutoff)]
+        page = offers[cursor:cursor + page_size]
+        return page, cursor + page_size if cursor + page_size < len(offers) else 0
+
+# Latency, errors and 429 responses injected into one service.
+@dataclass
+class FaultProfile:
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    requests_per_second: float = 0.0 # requests over this rate get 429, 0 disables it
+    retry_after_seconds: int = 1
+
+class Simulator:
+    def __init__(self, state_options: dict, faults: dict[str, FaultProfile], seed: int = 1, accept_failure_rate: float = 0.0):
+        self.state_options = state_options
+        self.faults = faults
+        self.accept_failure_rate = accept_failure_rate # share of trades left unaccepted by a successful bulk accept
+        self.rnd = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.state = SimulatorState(**self.state_options)
+        self.requests: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.rate_limited: dict[str, int] = {}
+        self.buckets = {service: (max(1.0, fault.requests_per_second), time.monotonic()) for service, fault in self.faults.items()}
+
+    @staticmethod
+    def count(counters: dict[str, int], key: str):
+        counters[key] = counters.get(key, 0) + 1
+
+    def over_rate_limit(self, service: str, fault: FaultProfile) -> bool:
+        if fault.requests_per_second <= 0:
+            return False
+        tokens, updated_at = self.buckets[service]
+        now = time.monotonic()
+        tokens = min(max(1.0, fault.requests_per_second), tokens + (now - updated_at) * fault.requests_per_second)
+        if tokens < 1:
+            self.buckets[service] = (tokens, now)
+            return True
+        self.buckets[service] = (tokens - 1, now)
+        return False
+
+    @web.middleware
+    async def fault_middleware(self, request: web.Request, handler):
+        route = f"{request.method} {request.match_info.route.resource.canonical if request.match_info.route.resource else request.path}"
+        service = request.path.split("/")[1]
+        service = SERVICE_CSFLOAT if service == "api" else service
+        if service == SERVICE_CONTROL:
+            return await handler(request)
+        self.count(self.requests, route)
+        fault = self.faults.get(service, FaultProfile())
+        latency = fault.latency_ms + self.rnd.uniform(-fault.latency_jitter_ms, fault.latency_jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+        if self.over_rate_limit(service, fault):
+            self.count(self.rate_limited, route)
+            return web.json_response({"message": "Too Many Requests"}, status=429, headers={"Retry-After": str(fault.retry_after_seconds)})
+        if fault.error_rate and self.rnd.random() < fault.error_rate:
+            self.count(self.errors, route)
+            return web.json_response({"message": "Internal Server Error"}, status=500)
+        return await handler(request)
+
+    # CSFloat API
+
+    async def csfloat_me(self, request: web.Request):
+        return web.json_response({"user": {"steam_id": str(self.state.steam_id), "username": "simulated"}, "actionable_trades": len(self.state.actionable_trades())})
+
+    async def csfloat_trades(self, request: web.Request):
+        states = set(request.query.get("state", "queued,pending").split(","))
+        limit = int(request.query.get("limit", 3000))
+        trades = [trade for trade in self.state.trades.values() if trade["state"] in states]
+        return web.json_response({"trades": trades[:limit], "count": len(trades)})
+
+    async def csfloat_accept_bulk(self, request: web.Request):
+        payload = await request.json()
+        trade_ids = [trade_id for trade_id in payload.get("trade_ids", []) if not self.accept_failure_rate or self.rnd.random() >= self.accept_failure_rate]
+        return web.json_response({"trades": self.state.accept(trade_ids)})
+
+    async def csfloat_accept(self, request: web.Request):
+        accepted = self.state.accept([request.match_info["trade_id"]])
+        if not accepted:
+            return web.json_response({"message": "Trade can't be accepted"}, status=400)
+        return web.json_response(accepted[0])
+
+    # Steam
+
+    async def steam_inventory(self, request: web.Request):
+        count = int(request.query.get("count", 2000))
+        items = list(self.state.inventory.values())
+        return web.json_response({"assets": items[:count], "total": len(items)})
+
+    async def steam_make_trade_offer(self, request: web.Request):
+        payload = await request.json()
+        offer_id = self.state.create_offer(int(payload["partner"]), [int(asset_id) for asset_id in payload.get("asset_ids", [])], payload.get("message", ""))
+        if offer_id is None:
+            return web.json_response({"strError": "There was an error sending your trade offer."}, status=500)
+        return web.json_response({"tradeofferid": str(offer_id)})
+
+    async def steam_trade_offers(self, request: web.Request):
+        cutoff = request.query.get("time_historical_cutoff")
+        offers, next_cursor = self.state.offers_page(request.query.get("active_only") == "1", int(cutoff) if cutoff else None, int(request.query.get("cursor", 0)))
+        return web.json_response({"offers": offers, "next_cursor": next_cursor})
+
+    async def steam_trade_offer(self, request: web.Request):
+        offer = self.state.offers.get(int(request.match_info["offer_id"]))
+        if offer is None:
+            return web.json_response({"message": "Not found"}, status=404)
+        return web.json_response(offer)
+
+    async def steam_confirmations(self, request: web.Request):
+        return web.json_response({"success": True, "conf": self.state.confirmations()})
+
+    async def steam_allow_confirmations(self, request: web.Request):
+        payload = await request.json()
+        return web.json_response({"success": True, "confirmed": self.state.confirm(payload.get("ids", []))})
+
+    # Simulator control
+
+    async def control_stats(self, request: web.Request):
+        return web.json_response({"requests": self.requests, "errors": self.errors, "rate_limited": self.rate_limited,
+                                  "trades": len(self.state.trades), "actionable_trades": len(self.state.actionable_trades()),
+                                  "inventory": len(self.state.inventory), "offers": len(self.state.offers)})
+
+    async def control_arrivals(self, request: web.Request):
+        payload = await request.json()
+        self.state.add_trades(int(payload.get("count", 0)))
+        return web.json_response({"trades": len(self.state.trades)})
+
+    async def control_reset(self, request: web.Request):
+        self.reset()
+        return web.json_response({"trades": len(self.state.trades)})
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.fault_middleware])
+        app.router.add_get("/api/v1/me", self.csfloat_me)
+        app.router.add_get("/api/v1/me/trades", self.csfloat_trades)
+        app.router.add_post("/api/v1/trades/bulk/accept", self.csfloat_accept_bulk)
+        app.router.add_post("/api/v1/trades/{trade_id}/accept", self.csfloat_accept)
+        app.router.add_get("/steam/inventory", self.steam_inventory)
+        app.router.add_post("/steam/trade_offers", self.steam_make_trade_offer)
+        app.router.add_get("/steam/trade_offers", self.steam_trade_offers)
+        app.router.add_get("/steam/trade_offers/{offer_id}", self.steam_trade_offer)
+        app.router.add_get("/steam/confirmations", self.steam_confirmations)
+        app.router.add_post("/steam/confirmations", self.steam_allow_confirmations)
+        app.router.add_get("/sim/stats", self.control_stats)
+        app.router.add_post("/sim/arrivals", self.control_arrivals)
+        app.router.add_post("/sim/reset", self.control_reset)
+        return app
+
+# Objects shaped like the aiosteampy models the bot reads.
+@dataclass
+class SimulatedItem:
+    asset_id: int
+    market_hash_name: str
+
+@dataclass
+class SimulatedTradeOffer:
+    trade_offer_id: int
+    partner_id: int
+    status: TradeOfferStatus
+    items_to_give: list[SimulatedItem]
+    message: str = ""
+    time_created: datetime | None = None
+    time_updated: datetime | None = None
+
+    @classmethod
+    def from_json(cls, data: dict) -> "SimulatedTradeOffer":
+        return cls(data["trade_offer_id"], data["partner_id"], TradeOfferStatus(data["status"]), [SimulatedItem(**item) for item in data["items_to_give"]], data.get("message", ""),
+                   datetime.fromtimestamp(data["time_created"], timezone.utc), datetime.fromtimestamp(data["time_updated"], timezone.utc))
+
+@dataclass
+class SimulatedConfirmation:
+    id: int
+    nonce: str
+    creator_id: int
+    type: ConfirmationType
+
+# Implements the SteamClient calls the bot makes against the simulator's /steam endpoints.
+class SimulatedSteamClient:
+    def __init__(self, base_url: str, session: aiohttp.ClientSession, steam_id: int = MY_STEAM_ID):
+        self.base_url = base_url.rstrip("/")
+        self.session = session
+        self.steam_id = steam_id
+        self.username = "simulated"
+
+    async def request_json(self, method: str, path: str, **kwargs):
+        async with self.session.request(method, f"{self.base_url}{path}", **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def get_inventory(self, app_context=None, count: int = 2000, **kwargs):
+        data = await self.request_json("GET", "/steam/inventory", params={"count": count})
+        return [SimulatedItem(**item) for item in data["assets"]], data["total"], None
+
+    async def make_trade_offer(self, obj, to_give=(), to_receive=(), message: str = "", *, token: str | None = None, confirm: bool = True, **kwargs):
+        if isinstance(obj, str):
+            partner = int(parse_qs(urlparse(obj).query)["partner"][0]) + STEAM_ID64_BASE
+        else:
+            partner = int(obj)
+        data = await self.request_json("POST", "/steam/trade_offers", json={"partner": partner, "asset_ids": [item.asset_id for item in to_give], "message": message, "token": token})
+        offer_id = int(data["tradeofferid"])
+        if confirm:
+            await self.confirm_trade_offer(offer_id)
+        return offer_id
+
+    async def get_trade_offers(self, active_only: bool = True, time_historical_cutoff=None, historical_only: bool = False, sent: bool = True, received: bool = True, cursor: int = 0, **kwargs):
+        params = {"active_only": int(active_only and not historical_only), "cursor": cursor}
+        if active_only and time_historical_cutoff is not None:
+            params["time_historical_cutoff"] = int(time_historical_cutoff.timestamp()) if isinstance(time_historical_cutoff, datetime) else time_historical_cutoff
+        data = await self.request_json("GET", "/steam/trade_offers", params=params)
+        offers = [SimulatedTradeOffer.from_json(offer) for offer in data["offers"]] if sent else []
+        return offers, [], data["next_cursor"]
+
+    async def get_trade_offer(self, offer_id: int, **kwargs):
+        return SimulatedTradeOffer.from_json(await self.request_json("GET", f"/steam/trade_offers/{offer_id}"))
+
+    async def get_confirmations(self, update_listings: bool = True):
+        data = await self.request_json("GET", "/steam/confirmations")
+        return [SimulatedConfirmation(conf["id"], conf["nonce"], conf["creator_id"], ConfirmationType(conf["type"])) for conf in data["conf"]]
+
+    async def allow_multiple_confirmations(self, confirmations):
+        await self.request_json("POST", "/steam/confirmations", json={"ids": [conf.creator_id for conf in confirmations]})
+
+    async def confirm_trade_offer(self, offer_id: int):
+        await self.request_json("POST", "/steam/confirmations", json={"ids": [offer_id]})
+
+def add_simulator_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--trades", type=int, default=3000, help="Trades waiting to be accepted.")
+    parser.add_argument("--inventory", type=int, default=2000, help="Steam inventory size, at least one item per trade.")
+    parser.add_argument("--history", type=int, default=5000, help="Older sent trade offers.")
+    parser.add_argument("--buyers", type=int, default=None, help="Distinct buyers, trades/5 by default.")
+    parser.add_argument("--no-accept-offers", action="store_true", help="Leave confirmed offers active instead of accepting them.")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Added latency of every CSFloat and Steam request.")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with HTTP 500.")
+    parser.add_argument("--csfloat-rps", type=float, default=0.0, help="CSFloat requests per second above which 429 is returned, 0 disables it.")
+    parser.add_argument("--steam-rps", type=float, default=0.0, help="Steam requests per second above which 429 is returned, 0 disables it.")
+    parser.add_argument("--accept-failure-rate", type=float, default=0.0, help="Share of trades a bulk accept leaves unaccepted while still answering 200.")
+    parser.add_argument("--missing-item-rate", type=float, default=0.0, help="Share of trades whose item is not in the inventory.")
+    parser.add_argument("--seed", type=int, default=1)
+
+def make_simulator(args) -> Simulator:
+    state_options = {"trades_count": args.trades, "inventory_count": args.inventory, "history_count": args.history, "buyers_count": args.buyers, "accept_offers": not args.no_accept_offers, "seed": args.seed, "missing_item_rate": args.missing_item_rate}
+    faults = {
+        SERVICE_CSFLOAT: FaultProfile(args.latency_ms, args.latency_jitter_ms, args.error_rate, args.csfloat_rps),
+        SERVICE_STEAM: FaultProfile(args.latency_ms, args.latency_jitter_ms, args.error_rate, args.steam_rps),
+    }
+    return Simulator(state_options, faults, args.seed, args.accept_failure_rate)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local CSFloat/Steam simulator for CSFloat-Auto-Trade.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+    simulator = make_simulator(args)
+    print(f"Simulating {args.trades} trades, {args.inventory} inventory items and {args.history} sent offers on http://{args.host}:{args.port}")
+    web.run_app(simulator.make_app(), host=args.host, port=args.port, print=None, access_log=None)
+
+if __name__ == "__main__":
+    main()